@@ -10,7 +10,7 @@ create database wheels owner "pgAdmin" encoding 'UTF8';
 
 -- generating SQL for bloguser:
 create table users (
- u_id varchar(50) not null,
+ u_id bigint not null,
  email varchar(50) not null,
  password varchar(50) not null,
  admin boolean not null,
@@ -24,8 +24,8 @@ create table users (
 
 -- generating SQL for blogs:
 create table blogs (
- b_id varchar(50) not null,
- u_id varchar(50) not null,
+ b_id bigint not null,
+ u_id bigint not null,
  user_name varchar(50) not null,
  user_image varchar(500) not null,
  name varchar(50) not null,
@@ -38,9 +38,9 @@ create table blogs (
 
 -- generating SQL for comments:
 create table comments (
- c_id varchar(50) not null,
- b_id varchar(50) not null,
- u_id varchar(50) not null,
+ c_id bigint not null,
+ b_id bigint not null,
+ u_id bigint not null,
  user_name varchar(50) not null,
  user_image varchar(500) not null,
  content text not null,
@@ -49,11 +49,25 @@ create table comments (
 );
 
 
+-- indexes of the models, see sync_indexes.py to create the missing ones on a live database.
+-- users_email_key is made by unique(email).
+create index users_created_at on users (created_at,u_id);
+create index blogs_u_id_idx on blogs (u_id);
+create index blogs_created_at on blogs (created_at,b_id);
+create index comments_u_id_idx on comments (u_id);
+create index comments_b_id_created_at_idx on comments (b_id,created_at);
+
+
+-- every process claims the node of its integer ids from the sequence, see db.set_id_node().
+create sequence id_node_seq;
+
+
 grant select, insert, update, delete on users, blogs, comments to "pgAdmin";
+grant usage on sequence id_node_seq to "pgAdmin";
 
 -- insert admin information
 
 insert into users (u_id, email, password, admin, name, image,created_at)
- values ('0014753981349889e4b6bc4a1b94d7080c70d061053e65f000',
+ values (232061340174585856,
  'admin@example.com', 'test_pw',
  'true', 'Administrator', 'not a image', 1475398130.941814);
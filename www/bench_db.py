@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+__author__ = 'guti'
+
+'''
+Benchmarks of the database operations.
+
+usage:
+python bench_db.py [--sqlite[=path]] [benchmark name ...]
+
+--sqlite runs the benchmarks in process on SQLite (in memory by default) instead of the configured PostgreSQL.
+'''
+
+import gc
+import sys
+import time
+import logging
+import StringIO
+
+from transwarp import db
+from config import configs
+
+
+def _timeit(label, n, func, *args, **kwargs):
+    start = time.time()
+    func(*args, **kwargs)
+    t = time.time() - start
+    print '%-40s %10.3f s %12.1f ops/s' % (label, t, n / t if t else float('inf'))
+    return t
+
+
+def bench_insert_many(n=20000):
+    """
+    Compare the per-row insert() with the batched insert_many() by VALUES and COPY.
+    """
+    def rows():
+        return [dict(id=i, name='name-%s' % i, content='content ' * 20, created_at=time.time()) for i in range(n)]
+
+    def per_row():
+        for r in rows():
+            db.insert('bench_insert', **r)
+
+    def batched(method):
+        db.insert_many('bench_insert', rows(), method=method)
+
+    for label, func, args in (('insert() per row', per_row, ()),
+                              ('insert_many() by VALUES', batched, ('values',)),
+                              ('insert_many() by COPY', batched, ('copy',))):
+        db.update('drop table if exists bench_insert')
+        db.update('create table bench_insert (id bigint primary key, name varchar(50), content text, created_at real)')
+        _timeit(label, n, func, *args)
+    db.update('drop table if exists bench_insert')
+
+
+def bench_orm(n=2000):
+    """
+    Insert, get, find and update the models.
+    """
+    from models import User
+
+    users = [User(name='user-%s' % i, email='user-%s@example.com' % i, password='x' * 32, admin=False,
+                  image='about:blank') for i in range(n)]
+
+    def insert():
+        for u in users:
+            u.insert()
+
+    def get():
+        for u in users:
+            User.get(u.u_id)
+
+    def find_first():
+        for u in users:
+            User.find_first('email=%s', u.email)
+
+    def update():
+        for u in users:
+            u.name = u.name.upper()
+            u.update()
+
+    _timeit('Model.insert()', n, insert)
+    _timeit('Model.get()', n, get)
+    _timeit('Model.find_first()', n, find_first)
+    _timeit('Model.find_all() x 10', 10 * n, lambda: [User.find_all() for _ in range(10)])
+    _timeit('Model.update()', n, update)
+
+
+def bench_deferred(n=2000, rounds=20):
+    """
+    Compare the list of blogs with and without the deferred content.
+    """
+    from models import Blog
+
+    if Blog.count_all() < n:
+        Blog.insert_all([Blog(u_id=0, user_name='user', user_image='about:blank', name='blog-%s' % i,
+                              summary='summary ' * 20, content='content ' * 1000) for i in range(n)])
+    fields = [f.name for f in Blog.__mappings__.values()]
+    _timeit('Blog.find_all() with content', rounds * n, lambda: [Blog.find_all(fields) for _ in range(rounds)])
+    _timeit('Blog.find_all() deferred content', rounds * n, lambda: [Blog.find_all() for _ in range(rounds)])
+
+
+def bench_wsgi(n=200):
+    """
+    Call the JSON api GET /api/users through the WSGI application, without a web server.
+    """
+    import os
+    import urls
+    from models import User
+    from transwarp.web import WSGIApplication
+
+    if User.count_all() == 0:
+        User.insert_all([User(name='user-%s' % i, email='user-%s@example.com' % i, password='x' * 32,
+                              admin=False, image='about:blank') for i in range(100)])
+    wsgi_app = WSGIApplication(os.path.dirname(os.path.abspath(__file__)))
+    wsgi_app.add_module(urls)
+    wsgi_app.add_interceptor(urls.identity_map_interceptor)
+    wsgi_app.add_interceptor(urls.user_interceptor)
+    application = wsgi_app.get_wsgi_application()
+    environ = dict(REQUEST_METHOD='GET', PATH_INFO='/api/users', QUERY_STRING='', SERVER_NAME='localhost',
+                   SERVER_PORT='80', SERVER_PROTOCOL='HTTP/1.1', HTTP_HOST='localhost')
+    environ['wsgi.input'] = StringIO.StringIO()
+
+    def start_response(status, headers):
+        if not status.startswith('200'):
+            raise StandardError('GET /api/users: %s' % status)
+
+    def call():
+        for _ in range(n):
+            ''.join(application(dict(environ), start_response))
+
+    _timeit('GET /api/users', n, call)
+
+
+def bench_overhead(n=20000):
+    """
+    Per call overhead of Model.insert(), update() and get() over the raw statements they execute.
+    """
+    from models import Comment
+
+    pk = Comment.__primary_key__.name
+    cols = [f.name for f in sorted(Comment.__mappings__.values(), key=lambda f: f.order)]
+    comments = [Comment(c_id=db.next_int_id(), b_id=i, u_id=i, user_name='user', user_image='about:blank',
+                        content='content', created_at=time.time()) for i in xrange(n)]
+    sqls = ('insert into %s (%s) values (%s)' % (Comment.__table__, ','.join(cols), ','.join(['%s'] * len(cols))),
+            'update %s set content=%%s where %s=%%s' % (Comment.__table__, pk),
+            'select * from %s where %s=%%s' % (Comment.__table__, pk))
+
+    def raw_insert():
+        for c in comments:
+            db.update(sqls[0], *[c[k] for k in cols])
+
+    def raw_update():
+        for c in comments:
+            db.update(sqls[1], c.content, c[pk])
+
+    def raw_get():
+        for c in comments:
+            db.select_one(sqls[2], c[pk])
+
+    def orm_insert():
+        for c in comments:
+            c.insert()
+
+    def orm_update():
+        for c in loaded:
+            c.content = 'changed'
+            c.update()
+
+    def orm_get():
+        for c in comments:
+            Comment.get(c[pk])
+
+    for label, raw, orm in (('insert()', raw_insert, orm_insert), ('update()', raw_update, orm_update),
+                            ('get()', raw_get, orm_get)):
+        db.update('delete from %s' % Comment.__table__)
+        if label != 'insert()':
+            raw_insert()
+            loaded = [Comment.get(c[pk]) for c in comments]
+        t_raw = _timeit('raw statement of %s' % label, n, raw)
+        if label == 'insert()':
+            db.update('delete from %s' % Comment.__table__)
+        t_orm = _timeit('Model.%s' % label, n, orm)
+        print '%-40s %10.2f us per call' % ('  overhead of Model.%s' % label, (t_orm - t_raw) * 1e6 / n)
+    db.update('delete from %s' % Comment.__table__)
+
+
+def _object_size(obj):
+    """
+    Get bytes of the object and its instance dict, without the values of the fields.
+    """
+    # the instance dict is made on the first use of obj.__dict__, find it without making it.
+    return sys.getsizeof(obj) + sum(sys.getsizeof(r) for r in gc.get_referents(obj) if type(r) is dict)
+
+
+def bench_lean(n=100000, rounds=10):
+    """
+    Compare the memory and the field reads of the blogs by Model and LeanModel.
+    """
+    import copy
+    from models import Blog
+    from transwarp.orm import Model
+
+    attrs = dict((k, copy.copy(f)) for k, f in Blog.__mappings__.iteritems())
+    attrs['__table__'] = Blog.__table__
+    DictBlog = type('DictBlog', (Model,), attrs)
+    fields = [f.name for f in Blog.__mappings__.values()]
+    db.update('delete from %s' % Blog.__table__)
+    db.insert_many(Blog.__table__, [dict(b_id=db.next_int_id(), u_id=i, user_name='user', user_image='about:blank',
+                                         name='blog-%s' % i, summary='summary', content='content',
+                                         created_at=time.time()) for i in xrange(n)])
+    for label, model in (('Model', DictBlog), ('LeanModel', Blog)):
+        blogs = model.find_all(fields)
+        print '%-40s %10.1f bytes per object' % ('%s objects' % label, sum(_object_size(b) for b in blogs) / float(n))
+        _timeit('%s field reads' % label, rounds * n * 3,
+                lambda: [(b.name, b.u_id, b.created_at) for _ in xrange(rounds) for b in blogs])
+        _timeit('%s.find_all()' % label, n, model.find_all, fields)
+        blogs = model.find_all()
+        print '%-40s %10.1f bytes per object' % ('%s objects by find_all()' % label,
+                                                 sum(_object_size(b) for b in blogs) / float(n))
+        blogs = None
+    db.update('delete from %s' % Blog.__table__)
+
+
+def _table_sizes(table):
+    """
+    Get bytes of the table and its indexes.
+    """
+    if db.get_backend().name == 'sqlite':
+        return (db.select_int('select sum(pgsize) from dbstat where name=%s', table),
+                db.select_int("select coalesce(sum(pgsize), 0) from dbstat where name like %s",
+                              'sqlite_autoindex_%s_%%' % table))
+    return (db.select_int('select pg_relation_size(%s)', table), db.select_int('select pg_indexes_size(%s)', table))
+
+
+def bench_ids(n=50000):
+    """
+    Compare the varchar(50) ids of next_id() with the bigint ids of next_int_id():
+    making ids, inserting rows and the sizes of table and primary key index.
+    """
+    _timeit('next_id()', n, lambda: [db.next_id() for _ in xrange(n)])
+    _timeit('next_int_id()', n, lambda: [db.next_int_id() for _ in xrange(n)])
+    for label, ddl, make_id in (('varchar(50) ids', 'varchar(50)', db.next_id),
+                                ('bigint ids', 'bigint', db.next_int_id)):
+        db.update('drop table if exists bench_ids')
+        db.update('create table bench_ids (id %s not null, name varchar(50) not null, primary key(id))' % ddl)
+        rows = [dict(id=make_id(), name='name-%s' % i) for i in xrange(n)]
+        _timeit('insert_many() of %s' % label, n, db.insert_many, 'bench_ids', rows)
+        table, index = _table_sizes('bench_ids')
+        print '%-40s %10.1f KB table %8.1f KB index' % ('  size of %s' % label, table / 1024.0, index / 1024.0)
+    db.update('drop table if exists bench_ids')
+
+
+_BENCHMARKS = (
+    ('insert_many', bench_insert_many),
+    ('ids', bench_ids),
+    ('orm', bench_orm),
+    ('overhead', bench_overhead),
+    ('deferred', bench_deferred),
+    ('lean', bench_lean),
+    ('wsgi', bench_wsgi),
+)
+
+
+def _create_sqlite_engine(database=None):
+    """
+    Create the SQLite engine and the tables of the models.
+    """
+    from models import User, Blog, Comment
+    from transwarp.orm import sync_indexes
+
+    db.create_engine(database=database, backend='sqlite')
+    for model in (User, Blog, Comment):
+        db.update('drop table if exists %s' % model.__table__)
+        # the first line of the generated sql is a comment
+        db.update(model().__sql__(with_indexes=False).split('\n', 1)[1])
+    sync_indexes((User, Blog, Comment))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    args = sys.argv[1:]
+    sqlite = [a for a in args if a.startswith('--sqlite')]
+    if sqlite:
+        _create_sqlite_engine(sqlite[0].partition('=')[2] or None)
+    else:
+        db.create_engine(**configs.db)
+    db.set_id_node(configs.id_node)
+    names = [a for a in args if not a.startswith('--')] or [name for name, _ in _BENCHMARKS]
+    for name, bench in _BENCHMARKS:
+        if name in names:
+            print '== %s ==' % name
+            bench()
@@ -13,6 +13,29 @@ configs = {
         'password': 'test_pw',
         'database': 'test_db'
     },
+    # node of the integer ids of every process: 'sequence' to claim it from the database,
+    # int for a single process, or None to read the environment variable TRANSWARP_ID_NODE
+    'id_node': 'sequence',
+    'query_cache': {
+        'max_entries': 1000,
+        'ttl': 60,
+        'max_bytes': 16 * 1024 * 1024,
+        # seconds after a table written, in which the results read from the replicas are not cached
+        'replica_lag': 1.0
+    },
+    'count_cache': {
+        'max_entries': 10000,
+        'ttl': 60
+    },
+    'n_plus_one': {
+        # log the statements executed more than threshold times in one request, for debugging
+        'enabled': False,
+        'threshold': 10
+    },
+    'instrumentation': {
+        'sample_rate': 1.0,
+        'slow_threshold': 0.1
+    },
     'session': {
         'secret': '0IH9c71HS86KSnqmQFAbBiwnEUqMYEo9vAQFb+DA9Ns='
     }
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+__author__ = 'guti'
+
+'''
+Migrate the varchar(50) ids made by db.next_id() to the bigint ids made by db.next_int_id().
+
+Every table is rebuilt from its model, in one transaction on PostgreSQL. The new ids keep the order
+of the old ones, since both start with the time they were made. The grants are not kept, re-run the
+grant statements of schema.sql after migration.
+
+usage:
+python migrate_ids.py [--sqlite=path]
+'''
+
+import sys
+import logging
+
+from transwarp import db
+from transwarp.orm import sync_indexes
+from models import User, Blog, Comment
+from config import configs
+
+
+# model -> id columns to migrate, primary key first
+_MIGRATIONS = (
+    (User, ('u_id',)),
+    (Blog, ('b_id', 'u_id')),
+    (Comment, ('c_id', 'b_id', 'u_id')),
+)
+
+
+def _old_time(old_id, created_at):
+    """
+    Get the time of the id made by db.next_id(), or created_at if it is not.
+
+    >>> _old_time('0014753981349889e4b6bc4a1b94d7080c70d061053e65f000', 0.0)
+    1475398134.988
+    >>> _old_time('admin', 1475398130.5)
+    1475398130.5
+    """
+    if len(old_id) == 50 and old_id[:15].isdigit():
+        return int(old_id[:15]) / 1000.0
+    return created_at
+
+
+def _is_migrated():
+    pk = _MIGRATIONS[0][1][0]
+    row = db.select_one('select %s from %s limit 1' % (pk, _MIGRATIONS[0][0].__table__))
+    return row is not None and not isinstance(row[pk], basestring)
+
+
+def _map_ids():
+    """
+    Make the new id of every old primary key in the table id_map.
+    """
+    old = []
+    for model, cols in _MIGRATIONS:
+        old.extend(db.select('select %s as old_id, created_at from %s' % (cols[0], model.__table__)))
+    old.sort(key=lambda r: (_old_time(r.old_id, r.created_at), r.old_id))
+    db.update('create table id_map (old_id varchar(50) primary key, new_id bigint not null)')
+    db.insert_many('id_map', [dict(old_id=r.old_id, new_id=db.next_int_id(_old_time(r.old_id, r.created_at)))
+                              for r in old])
+    return len(old)
+
+
+def _rebuild(model, cols):
+    table = model.__table__
+    db.update('alter table %s rename to %s_old' % (table, table))
+    # the indexes are created after the old tables dropped, which keep the names.
+    db.update(model().__sql__(with_indexes=False))
+    names = [f.name for f in sorted(model.__mappings__.values(), key=lambda f: f.order)]
+    # the dangling references get id 0, as the default of IntegerField.
+    values = ['coalesce((select new_id from id_map where old_id=o.%s), 0)' % n if n in cols else 'o.%s' % n
+              for n in names]
+    return db.update('insert into %s (%s) select %s from %s_old o' % (table, ','.join(names), ','.join(values), table))
+
+
+def migrate():
+    if _is_migrated():
+        print 'Already migrated.'
+        return
+    if db.get_backend().name == 'postgresql':
+        # the nodes of the new ids are claimed from the sequence, see db.set_id_node().
+        db.update('create sequence if not exists id_node_seq')
+    with db.transaction():
+        print 'Map %d ids.' % _map_ids()
+        for model, cols in _MIGRATIONS:
+            print 'Rebuild %s: %d rows.' % (model.__table__, _rebuild(model, cols))
+        for model, _ in _MIGRATIONS:
+            db.update('drop table %s_old' % model.__table__)
+        sync_indexes([model for model, _ in _MIGRATIONS], concurrently=False)
+        db.update('drop table id_map')
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    sqlite = [a for a in sys.argv[1:] if a.startswith('--sqlite')]
+    if sqlite:
+        db.create_engine(database=sqlite[0].partition('=')[2] or None, backend='sqlite')
+    else:
+        db.create_engine(**configs.db)
+    db.set_id_node(configs.id_node)
+    migrate()
@@ -7,46 +7,63 @@ Database orm models.
 
 import time
 
-from transwarp.db import next_id
-from transwarp.orm import Model, StringField, BooleanField, FloatField, TextField
+from transwarp.db import next_int_id
+from transwarp.orm import Model, LeanModel, StringField, BooleanField, FloatField, TextField, IntegerField
+from transwarp.orm import ForeignKey, HasMany, Index
 
 
 class User(Model):
     __table__ = 'users'
+    __cache__ = True
+    __indexes__ = (Index('created_at', 'u_id', name='users_created_at'),)
 
-    u_id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
-    email = StringField(updatable=True, ddl='varchar(50)')
+    u_id = IntegerField(primary_key=True, default=next_int_id)
+    email = StringField(updatable=True, ddl='varchar(50)', unique=True)
     password = StringField(ddl='varchar(50)')
     admin = BooleanField()
     name = StringField(ddl='varchar(50)')
     image = StringField(ddl='varchar(500)')
     created_at = FloatField(updatable=False, default=time.time)
 
+    blogs = HasMany('Blog', 'u_id', order_by='created_at desc')
 
-class Blog(Model):
+
+class Blog(LeanModel):
     __table__ = 'blogs'
+    __cache__ = True
+    __count_cache__ = True
+    __indexes__ = (Index('created_at', 'b_id', name='blogs_created_at'),)
 
-    b_id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
-    u_id = StringField(updatable=False, ddl='varchar(50)')
+    b_id = IntegerField(primary_key=True, default=next_int_id)
+    u_id = IntegerField(updatable=False, index=True)
     user_name = StringField(ddl='varchar(50)')
     user_image = StringField(ddl='varchar(500)')
     name = StringField(ddl='varchar(50)')
     summary = StringField(ddl='varchar(200)')
-    content = TextField()
+    content = TextField(deferred=True)
     created_at = FloatField(updatable=False, default=time.time)
 
+    user = ForeignKey('User', 'u_id')
+    comments = HasMany('Comment', 'b_id', order_by='created_at')
 
-class Comment(Model):
+
+class Comment(LeanModel):
     __table__ = 'comments'
+    __count_cache__ = True
+    # the comments of a blog in order
+    __indexes__ = (Index('b_id', 'created_at'),)
 
-    c_id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
-    b_id = StringField(updatable=False, ddl='varchar(50)')
-    u_id = StringField(updatable=False, ddl='varchar(50)')
+    c_id = IntegerField(primary_key=True, default=next_int_id)
+    b_id = IntegerField(updatable=False)
+    u_id = IntegerField(updatable=False, index=True)
     user_name = StringField(ddl='varchar(50)')
     user_image = StringField(ddl='varchar(500)')
     content = TextField()
     created_at = FloatField(updatable=False, default=time.time)
 
+    blog = ForeignKey('Blog', 'b_id')
+    user = ForeignKey('User', 'u_id')
+
 
 if __name__ == '__main__':
     '''
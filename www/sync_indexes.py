@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+__author__ = 'guti'
+
+'''
+Create the indexes of the models missing in the database.
+
+The indexes are compared by name with the ones of the tables, the existing ones are kept as they are.
+On PostgreSQL the indexes are created concurrently, so the live database keeps serving the writes.
+
+usage:
+python sync_indexes.py [--dry-run] [--sqlite=path]
+'''
+
+import sys
+import logging
+
+from transwarp import db
+from transwarp.orm import sync_indexes
+from models import User, Blog, Comment
+from config import configs
+
+
+_MODELS = (User, Blog, Comment)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    args = sys.argv[1:]
+    sqlite = [a for a in args if a.startswith('--sqlite')]
+    if sqlite:
+        db.create_engine(database=sqlite[0].partition('=')[2] or None, backend='sqlite')
+    else:
+        db.create_engine(**configs.db)
+    dry_run = '--dry-run' in args
+    statements = sync_indexes(_MODELS, dry_run=dry_run)
+    for sql in statements:
+        print '%s%s;' % ('-- ' if dry_run else '', sql)
+    print '%d missing indexes%s.' % (len(statements), '' if dry_run else ' created')
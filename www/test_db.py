@@ -8,6 +8,7 @@ from transwarp import db
 
 # TODO: change the database info by config
 db.create_engine(user='test_user', password='test_pw', database='wheels')
+db.set_id_node('sequence')
 
 u = User(name='Test', email='test@example.com', password='1234567890', image='about:blank')
 
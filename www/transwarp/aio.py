@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = 'guti'
+
+'''
+Cooperative database module.
+
+Python 2 has no asyncio, so the database operations run concurrently in gevent greenlets.
+After install(), psycopg2 waits for the socket of the connection through gevent, a greenlet waiting
+for the database yields to the others, and all the greenlets share the connections of the engine pool.
+
+The connection context of transwarp.db is greenlet local only if threading is patched by gevent
+before transwarp.db is imported. COPY is not supported by psycopg2 in this mode.
+
+In a transaction of the current greenlet, the operations run at once on the connection of the transaction
+instead of new greenlets, see transaction().
+
+usage:
+from gevent import monkey
+monkey.patch_all()
+from transwarp import db, aio
+db.create_engine(...)
+aio.install()
+blog, comments = aio.gather(aio.select_one('select * from blogs where b_id=%s', b_id),
+                            aio.select('select * from comments where b_id=%s', b_id))
+'''
+
+import sys
+
+import db
+
+
+def _wait_callback(conn):
+    """
+    Wait callback of psycopg2, wait for the socket of the connection by gevent.
+    """
+    from gevent.socket import wait_read, wait_write
+    from psycopg2 import extensions, OperationalError
+    while True:
+        state = conn.poll()
+        if state == extensions.POLL_OK:
+            break
+        elif state == extensions.POLL_READ:
+            wait_read(conn.fileno())
+        elif state == extensions.POLL_WRITE:
+            wait_write(conn.fileno())
+        else:
+            raise OperationalError('Bad result from poll: %r' % state)
+
+
+def install():
+    """
+    Make psycopg2 cooperative with gevent.
+    """
+    import gevent.local
+    import psycopg2.extensions
+    if not issubclass(db._DbContext, gevent.local.local):
+        raise db.DBError('Call gevent.monkey.patch_all() before importing transwarp.db.')
+    psycopg2.extensions.set_wait_callback(_wait_callback)
+
+
+def spawn(func, *args, **kwargs):
+    """
+    Run the function in a new greenlet, or at once in the transaction of the current greenlet.
+    :return: greenlet object, or AsyncResult object in transaction,
+    get() returns the result or raises the exception of the function.
+    """
+    import gevent
+    if db.in_transaction():
+        from gevent.event import AsyncResult
+        result = AsyncResult()
+        try:
+            result.set(func(*args, **kwargs))
+        except Exception, e:
+            result.set_exception(e)
+        return result
+    return gevent.spawn(func, *args, **kwargs)
+
+
+def gather(*greenlets, **kwargs):
+    """
+    Wait for the greenlets.
+    :param greenlets: greenlet objects.
+    :param timeout: keyword argument, seconds to wait, default is None to wait forever.
+    :return: list of the results in the order of the greenlets.
+
+    >>> r = db.update('create table testaio (id int primary key, name text)')
+    >>> gather(insert('testaio', id=1, name='a'), insert('testaio', id=2, name='b'))
+    [1, 1]
+    >>> n, row = gather(select_int('select count(*) from testaio'), select_one('select * from testaio where id=%s', 2))
+    >>> n, row.name
+    (2, u'b')
+    >>> gather(update('update testaio set name=%s where id=%s', 'x', 0), spawn(lambda: 1 / 0))
+    Traceback (most recent call last):
+      ...
+    ZeroDivisionError: integer division or modulo by zero
+    """
+    import gevent
+    gevent.joinall(greenlets, timeout=kwargs.get('timeout'), raise_error=True)
+    return [g.get(block=False) for g in greenlets]
+
+
+def select(sql, *args):
+    """
+    Execute select SQL in a new greenlet, see db.select().
+
+    >>> [r.name for r in select('select name from testaio order by id').get()]
+    [u'a', u'b']
+    """
+    return spawn(db.select, sql, *args)
+
+
+def select_one(sql, *args):
+    """
+    Execute select SQL expected one result in a new greenlet, see db.select_one().
+    """
+    return spawn(db.select_one, sql, *args)
+
+
+def select_int(sql, *args):
+    """
+    Execute select SQL expected one int in a new greenlet, see db.select_int().
+    """
+    return spawn(db.select_int, sql, *args)
+
+
+def update(sql, *args):
+    """
+    Execute update SQL in a new greenlet, see db.update().
+    """
+    return spawn(db.update, sql, *args)
+
+
+def insert(table, **kwargs):
+    """
+    Execute insert SQL in a new greenlet, see db.insert().
+    """
+    return spawn(db.insert, table, **kwargs)
+
+
+class _TransactionContext(object):
+    """
+    Transaction context of the current greenlet
+
+    Borrow a connection from the pool when entered, waiting for it cooperatively, and hold it for the block.
+    The operations of this module called in the block run at once on the connection, one after another,
+    so gather() of them inside the transaction returns at once.
+    """
+    def __enter__(self):
+        self._transaction = db.transaction()
+        self._transaction.__enter__()
+        try:
+            # wait for the pool here rather than in the middle of the block.
+            db._db_ctx.connection.get()
+        except Exception:
+            self._transaction.__exit__(*sys.exc_info())
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return self._transaction.__exit__(exc_type, exc_val, exc_tb)
+
+
+def transaction():
+    """
+    Get the transaction context of the current greenlet.
+    :return: _TransactionContext object
+
+    usage:
+    def transfer(a, b):
+        with aio.transaction():
+            aio.gather(aio.update('update accounts set balance=balance-1 where id=%s', a),
+                       aio.update('update accounts set balance=balance+1 where id=%s', b))
+    aio.gather(aio.spawn(transfer, 1, 2), aio.spawn(transfer, 3, 4))
+
+    >>> def rename(pk, name):
+    ...     with transaction():
+    ...         gather(update('update testaio set name=%s where id=%s', name, pk))
+    ...         return select_one('select name from testaio where id=%s', pk).get().name
+    >>> gather(spawn(rename, 1, 'x'), spawn(rename, 2, 'y'))
+    [u'x', u'y']
+    >>> def fail():
+    ...     with transaction():
+    ...         update('update testaio set name=%s where id=%s', 'z', 1).get()
+    ...         raise ValueError('rolled back')
+    >>> spawn(fail).get()
+    Traceback (most recent call last):
+      ...
+    ValueError: rolled back
+    >>> select_one('select name from testaio where id=%s', 1).get().name
+    u'x'
+    """
+    return _TransactionContext()
+
+
+if __name__ == '__main__':
+    import logging
+    from gevent import monkey
+    logging.basicConfig(level=logging.WARNING)
+    monkey.patch_all()
+    # the connection context is greenlet local only if transwarp.db is loaded after threading patched.
+    db = reload(db)
+    # the in-memory SQLite database lives in one connection, shared by the greenlets in turn.
+    db.create_engine(backend='sqlite')
+    import doctest
+    doctest.testmod()
@@ -9,12 +9,53 @@ import re
 import json
 import logging
 import functools
+import types
 
 from web import context
 
 
+# integers beyond 2 ** 53 lose precision in javascript numbers
+_MAX_SAFE_INTEGER = 2 ** 53 - 1
+_JSON_SCALARS = frozenset([str, unicode, float, bool, types.NoneType])
+
+
+def _js_safe(obj):
+    """
+    Convert the integers javascript can not hold, such as the 64-bit ids, to strings.
+
+    >>> _js_safe(dict(id=1560859145070481408, n=[1, True, 2 ** 53 - 1, -2 ** 60]))
+    {'id': '1560859145070481408', 'n': [1, True, 9007199254740991, '-1152921504606846976']}
+    """
+    t = type(obj)
+    if t is int or t is long:
+        return obj if -_MAX_SAFE_INTEGER <= obj <= _MAX_SAFE_INTEGER else str(obj)
+    if isinstance(obj, dict):
+        # the values of the rows are mostly scalars, check them inline.
+        d = dict()
+        for k, v in obj.iteritems():
+            t = type(v)
+            if t in _JSON_SCALARS or (t is int or t is long) and -_MAX_SAFE_INTEGER <= v <= _MAX_SAFE_INTEGER:
+                d[k] = v
+            else:
+                d[k] = _js_safe(v)
+        return d
+    if isinstance(obj, (list, tuple)):
+        return [_js_safe(v) for v in obj]
+    return obj
+
+
+def _json_default(obj):
+    """
+    Dump the objects with items but not dicts, such as the orm.LeanModel objects.
+    """
+    iteritems = getattr(obj, 'iteritems', None)
+    if iteritems is None:
+        raise TypeError('%r is not JSON serializable' % obj)
+    return _js_safe(dict(iteritems()))
+
+
 def json_dump(obj):
-    return json.dumps(obj)
+    return json.dumps(_js_safe(obj), default=_json_default)
 
 
 class APIError(StandardError):
@@ -6,25 +6,749 @@ __author__ = 'guti'
 Database base module.
 '''
 
+import os
+import re
+import sys
+import json
+import bisect
+import random
+import socket
 import threading
+import collections
 import logging
 import functools
+import itertools
+import operator
 import time
 import traceback
 import uuid
 
 
+class _StatementCache(object):
+    """
+    Prepared statements of a connection
+
+    Count the executions of every sql, the sql executed threshold times is PREPAREd on the connection
+    and EXECUTEd afterwards. The prepared statements are kept in a bounded LRU, the least recently used
+    one is DEALLOCATEd when the cache is full. The cache lives and dies with its connection.
+
+    >>> cache = _StatementCache(capacity=2, threshold=2)
+    >>> cache.is_hot('select 1'), cache.is_hot('select 1')
+    (False, True)
+    >>> cache.add('select 1', ()), cache.add('select 2', ()), cache.lookup('select 1')
+    (('transwarp_stmt_0', None), ('transwarp_stmt_1', None), ('transwarp_stmt_0', ()))
+    >>> cache.add('select 3', ())
+    ('transwarp_stmt_2', 'transwarp_stmt_1')
+    >>> cache.forget('select 3'), cache.stale, cache.lookup('select 3')
+    ('transwarp_stmt_2', ['transwarp_stmt_2'], None)
+    """
+    def __init__(self, capacity=100, threshold=5):
+        self.capacity = capacity
+        self.threshold = threshold
+        # sql -> (statement name, types of parameters), the most recently used at the end.
+        self._prepared = collections.OrderedDict()
+        # sql -> numbers of executions, bounded to avoid growing by ad hoc sql.
+        self._seen = collections.OrderedDict()
+        # sql which failed to be prepared.
+        self._failed = set()
+        # names of the statements forgotten but still prepared on the connection.
+        self.stale = list()
+        self._ids = itertools.count()
+
+    def lookup(self, sql):
+        """
+        Get the prepared statement of the sql.
+        :return: tuple of (statement name, types of parameters) or None.
+        """
+        stmt = self._prepared.pop(sql, None)
+        if stmt is not None:
+            self._prepared[sql] = stmt
+        return stmt
+
+    def is_hot(self, sql):
+        """
+        Count the execution of the unprepared sql.
+        :return: True if the sql should be prepared.
+        """
+        if sql in self._failed:
+            return False
+        n = self._seen.pop(sql, 0) + 1
+        if n >= self.threshold:
+            return True
+        self._seen[sql] = n
+        if len(self._seen) > self.capacity * 4:
+            self._seen.popitem(last=False)
+        return False
+
+    def add(self, sql, types):
+        """
+        Record the sql prepared.
+        :param types: tuple of the types of parameters.
+        :return: tuple of the new statement name and the name of the evicted statement or None.
+        """
+        evicted = None
+        if len(self._prepared) >= self.capacity:
+            evicted = self._prepared.popitem(last=False)[1][0]
+        name = 'transwarp_stmt_%d' % next(self._ids)
+        self._prepared[sql] = (name, types)
+        return name, evicted
+
+    def forget(self, sql, failed=False):
+        """
+        Forget the statement of the sql, which is DEALLOCATEd later.
+        :param failed: True to never prepare the sql again on the connection.
+        :return: name of the statement forgotten or None.
+        """
+        stmt = self._prepared.pop(sql, None)
+        if failed:
+            self._failed.add(sql)
+        if stmt is None:
+            return None
+        self.stale.append(stmt[0])
+        return stmt[0]
+
+
+class _PooledConnection(object):
+    """
+    Connection in the pool
+
+    Wrap the raw DB-API connection and record the times used by the pool to expire it.
+    """
+    def __init__(self, raw, statements=None):
+        self.raw = raw
+        self.created_at = time.time()
+        self.last_used = self.created_at
+        # the pool the connection belongs to.
+        self.pool = None
+        # seconds waited for the connection at the last checkout.
+        self.wait = 0.0
+        # _StatementCache object, None if the prepared statements are disabled.
+        self.statements = statements
+
+    def cursor(self, *args, **kwargs):
+        return self.raw.cursor(*args, **kwargs)
+
+    def commit(self):
+        self.raw.commit()
+
+    def rollback(self):
+        self.raw.rollback()
+
+    def close(self):
+        try:
+            self.raw.close()
+        except Exception, e:
+            logging.warning('Close connection id(%s) failed: %s' % (hex(id(self.raw)), e))
+
+    def ping(self):
+        """
+        Check the connection is still alive by a cheap round trip.
+        :return: True if the connection can be used.
+        """
+        cursor = None
+        try:
+            cursor = self.raw.cursor()
+            cursor.execute('select 1')
+            cursor.fetchone()
+            self.raw.rollback()
+            return True
+        except Exception:
+            return False
+        finally:
+            if cursor:
+                try:
+                    cursor.close()
+                except Exception:
+                    pass
+
+
+class _ConnectionPool(object):
+    """
+    Thread-safe pool of database connections
+
+    Connections are opened lazily up to max_size and kept for reuse after release.
+    Idle connections are closed after idle_timeout seconds while more than min_size are open,
+    and every connection is retired after max_lifetime seconds.
+    A checkout blocks up to timeout seconds when all the connections are in use.
+    With pre_ping, a connection idle more than pre_ping_after seconds is pinged before checkout,
+    the broken one is replaced by a new connection.
+
+    >>> class FakeCursor(object):
+    ...     def execute(self, sql): pass
+    ...     def fetchone(self): return (1,)
+    ...     def close(self): pass
+    >>> class FakeRaw(object):
+    ...     def __init__(self):
+    ...         self.broken = False
+    ...         self.pings = 0
+    ...     def cursor(self):
+    ...         if self.broken:
+    ...             raise IOError('connection closed')
+    ...         self.pings += 1
+    ...         return FakeCursor()
+    ...     def rollback(self):
+    ...         if self.broken:
+    ...             raise IOError('connection closed')
+    ...     def close(self): pass
+    >>> pool = _ConnectionPool(lambda: _PooledConnection(FakeRaw()), min_size=0, max_size=2, idle_timeout=60.0,
+    ...                        max_lifetime=600.0, pre_ping_after=1.0, timeout=0.01)
+    >>> a, b = pool.checkout(), pool.checkout()
+    >>> pool.checkout()
+    Traceback (most recent call last):
+      ...
+    PoolTimeoutError: No connection available in 0.01 seconds.
+    >>> s = pool.stats()
+    >>> s.size, s.in_use, s.idle, s.checkouts, s.timeouts
+    (2, 2, 0, 2, 1)
+    >>> pool.release(b)
+    >>> c = pool.checkout()
+    >>> c is b, c.raw.pings
+    (True, 0)
+    >>> pool.release(c)
+    >>> c.last_used -= 10
+    >>> pool.checkout() is c, c.raw.pings
+    (True, 1)
+    >>> pool.release(c)
+    >>> c.last_used -= 10
+    >>> c.raw.broken = True
+    >>> d = pool.checkout()
+    >>> d is c, pool.stats().size
+    (False, 2)
+    >>> d.raw.broken = True
+    >>> pool.release(d)
+    >>> s = pool.stats()
+    >>> s.size, s.in_use, s.idle
+    (1, 1, 0)
+    >>> pool.release(a)
+    >>> a.last_used -= 100
+    >>> e = pool.checkout()
+    >>> e is a, pool.stats().size
+    (False, 1)
+    >>> e.created_at -= 1000
+    >>> pool.release(e)
+    >>> s = pool.stats()
+    >>> s.size, s.in_use, s.idle, s.checkouts, s.timeouts
+    (0, 0, 0, 6, 1)
+    """
+    def __init__(self, connect, min_size=1, max_size=10, idle_timeout=300.0, max_lifetime=3600.0,
+                 pre_ping=True, pre_ping_after=1.0, timeout=30.0):
+        if max_size < 1 or min_size < 0 or min_size > max_size:
+            raise ValueError('Invalid pool size: min_size=%s, max_size=%s' % (min_size, max_size))
+        self._connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.max_lifetime = max_lifetime
+        self.pre_ping = pre_ping
+        self.pre_ping_after = pre_ping_after
+        self.timeout = timeout
+        self._cond = threading.Condition()
+        # idle connections, the most recently used at the right.
+        self._idle = collections.deque()
+        # numbers of the opened connections, including the connections being opened.
+        self._size = 0
+        self._in_use = 0
+        self._waiting = 0
+        # statistics of checkout.
+        self._checkouts = 0
+        self._timeouts = 0
+        self._wait_time = 0.0
+        self._max_wait = 0.0
+
+    def _is_expired(self, conn, now):
+        return self.max_lifetime is not None and now - conn.created_at > self.max_lifetime
+
+    def _prune(self, now):
+        """
+        Remove the expired and long idle connections, must be called with the lock held.
+        :return: list of connections to be closed.
+        """
+        expired = list()
+        for conn in list(self._idle):
+            idle_too_long = self.idle_timeout is not None and now - conn.last_used > self.idle_timeout \
+                and self._size - len(expired) > self.min_size
+            if idle_too_long or self._is_expired(conn, now):
+                self._idle.remove(conn)
+                expired.append(conn)
+        self._size -= len(expired)
+        return expired
+
+    def _open(self):
+        conn = self._connect()
+        conn.pool = self
+        logging.info('Open connection id(%#x)', id(conn.raw))
+        return conn
+
+    def _discard(self, conn):
+        logging.info('Close connection id(%#x)', id(conn.raw))
+        conn.close()
+
+    def checkout(self, timeout=None):
+        """
+        Borrow a connection from the pool.
+        :param timeout: seconds to wait for a free connection, default is the pool timeout.
+        :return: _PooledConnection object.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        start = time.time()
+        conn = None
+        expired = list()
+        with self._cond:
+            while True:
+                expired.extend(self._prune(time.time()))
+                if self._idle:
+                    conn = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    break
+                remaining = start + timeout - time.time()
+                if remaining <= 0:
+                    self._timeouts += 1
+                    raise PoolTimeoutError('No connection available in %s seconds.' % timeout)
+                self._waiting += 1
+                try:
+                    self._cond.wait(remaining)
+                finally:
+                    self._waiting -= 1
+            self._in_use += 1
+            wait = time.time() - start
+            if conn is not None:
+                conn.wait = wait
+            self._checkouts += 1
+            self._wait_time += wait
+            self._max_wait = max(self._max_wait, wait)
+        for c in expired:
+            self._discard(c)
+        try:
+            if conn is not None and self.pre_ping and time.time() - conn.last_used > self.pre_ping_after \
+                    and not conn.ping():
+                logging.warning('Connection id(%s) is broken, reconnecting...' % hex(id(conn.raw)))
+                self._discard(conn)
+                conn = None
+            if conn is None:
+                conn = self._open()
+                conn.wait = wait
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+        return conn
+
+    def release(self, conn):
+        """
+        Return a connection to the pool.
+
+        Any transaction left open is rolled back, a connection failing to roll back is closed.
+        :param conn: _PooledConnection object got by checkout().
+        """
+        try:
+            conn.rollback()
+            reusable = True
+        except Exception, e:
+            logging.warning('Rollback connection id(%s) failed: %s' % (hex(id(conn.raw)), e))
+            reusable = False
+        now = time.time()
+        with self._cond:
+            self._in_use -= 1
+            if reusable and not self._is_expired(conn, now):
+                conn.last_used = now
+                self._idle.append(conn)
+            else:
+                self._size -= 1
+                reusable = False
+            self._cond.notify()
+        if not reusable:
+            self._discard(conn)
+
+    def close(self):
+        """
+        Close all the idle connections.
+        """
+        with self._cond:
+            idle = list(self._idle)
+            self._idle.clear()
+            self._size -= len(idle)
+        for conn in idle:
+            self._discard(conn)
+
+    @property
+    def in_use(self):
+        return self._in_use
+
+    def stats(self):
+        """
+        Get the statistics of the pool.
+        :return: Dict object.
+        """
+        with self._cond:
+            return Dict(size=self._size, in_use=self._in_use, idle=len(self._idle), waiting=self._waiting,
+                        checkouts=self._checkouts, timeouts=self._timeouts, wait_time=self._wait_time,
+                        max_wait=self._max_wait,
+                        avg_wait=self._wait_time / self._checkouts if self._checkouts else 0.0)
+
+
+class _Backend(object):
+    """
+    SQL backend
+
+    Describe how to connect the database, the paramstyle, the DDL types and the features of the database.
+    """
+    name = None
+    # the backend supports named (server-side) cursors
+    server_cursors = False
+    # the backend supports PREPARE and EXECUTE
+    prepared_statements = False
+    # the backend supports COPY FROM STDIN
+    copy = False
+    # the backend supports json_agg, so the selects of a batch can be sent in one statement
+    json_batch = False
+    # the backend supports multi-row VALUES with many parameters
+    multirow_values = True
+    # the backend supports CREATE INDEX CONCURRENTLY, which does not block the writes of the table
+    concurrent_index = False
+
+    def connector(self, params):
+        """
+        Get the function opening a connection.
+        :param params: dict of connection parameters.
+        """
+        raise NotImplementedError
+
+    def engine_params(self, params, engine_params):
+        """
+        Adjust the keyword arguments of _Engine for the backend.
+        """
+        return engine_params
+
+    def translate(self, sql):
+        """
+        Translate the sql with '%s' parameters to the paramstyle of the backend.
+        """
+        return sql
+
+    def ddl(self, ddl):
+        """
+        Translate the ddl type of Field to the type of the backend.
+        """
+        return ddl
+
+    def estimate_rows(self, table):
+        """
+        Get the estimated numbers of rows of the table by the statistics of the database, None if unknown.
+        """
+        return None
+
+    def any(self, column, values):
+        """
+        Get the condition of the column equal to any of the values, and the parameters of the condition.
+
+        >>> _Backend().any('id', [1, 2])
+        ('id in (%s,%s)', [1, 2])
+        """
+        return '%s in (%s)' % (column, ','.join(['%s'] * len(values))), list(values)
+
+    def index_names(self, table):
+        """
+        Get the set of the names of the valid indexes of the table.
+        """
+        raise NotImplementedError
+
+    def claim_id_node(self, raw):
+        """
+        Claim a node of the integer ids by the raw connection, see set_id_node().
+        """
+        raise NotImplementedError
+
+    def autocommit(self, raw, on):
+        """
+        Turn on or off the autocommit of the raw connection.
+        """
+        pass
+
+
+class _PostgresBackend(_Backend):
+    """
+    PostgreSQL backend by psycopg2.
+    """
+    name = 'postgresql'
+    server_cursors = True
+    prepared_statements = True
+    copy = True
+    json_batch = True
+    concurrent_index = True
+
+    def connector(self, params):
+        import psycopg2
+        # set psycopg2 module select unicode result
+        psycopg2.extensions.register_type(psycopg2.extensions.UNICODE, None)
+        params = dict(params)
+        defaults = dict(host='127.0.0.1', port=5432, client_encoding='UTF8', connection_factory=None,
+                        cursor_factory=None, async=False)
+        for k, v in defaults.items():
+            if params.get(k) is None:
+                params[k] = v
+        return functools.partial(psycopg2.connect, **params)
+
+    def estimate_rows(self, table):
+        # reltuples is -1 or 0 before the table is vacuumed or analyzed
+        n = select_int('select reltuples::bigint from pg_class where oid=%s::regclass', table)
+        return n if n > 0 else None
+
+    def any(self, column, values):
+        """
+        The array parameter keeps one statement for any numbers of values.
+
+        >>> _PostgresBackend().any('id', (1, 2))
+        ('id = any(%s)', [[1, 2]])
+        """
+        return '%s = any(%%s)' % column, [list(values)]
+
+    def index_names(self, table):
+        # an index failed to be created concurrently is left invalid
+        return set(r.relname for r in select('select c.relname from pg_index i join pg_class c on c.oid=i.indexrelid '
+                                             'where i.indrelid=%s::regclass and i.indisvalid', table))
+
+    def claim_id_node(self, raw):
+        cursor = raw.cursor()
+        try:
+            cursor.execute("select nextval('id_node_seq')")
+            return int(cursor.fetchone()[0] & _ID_NODE_MASK)
+        finally:
+            cursor.close()
+
+    def autocommit(self, raw, on):
+        raw.autocommit = on
+
+
+class _SqliteBackend(_Backend):
+    """
+    SQLite backend by sqlite3, the database is a file or ':memory:'.
+
+    The in-memory database lives in one connection, so the pool keeps exactly one connection forever.
+    """
+    name = 'sqlite'
+    multirow_values = False
+
+    def __init__(self):
+        # sql -> translated sql
+        self._translated = dict()
+
+    def connector(self, params):
+        import sqlite3
+        sqlite3.register_converter('boolean', lambda v: v not in ('0', ''))
+        return functools.partial(sqlite3.connect, params.get('database') or ':memory:',
+                                 detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False)
+
+    def engine_params(self, params, engine_params):
+        engine_params['statement_cache_size'] = 0
+        if params.get('database') in (None, ':memory:'):
+            engine_params.update(min_size=1, max_size=1, idle_timeout=None, max_lifetime=None)
+        return engine_params
+
+    def translate(self, sql):
+        """
+        >>> _SqliteBackend().translate("select * from t where a=%s and b like 'x%%'")
+        "select * from t where a=? and b like 'x%'"
+        """
+        q = self._translated.get(sql)
+        if q is None:
+            q = _RE_PARAM.sub(lambda m: '%' if m.group(1) == '%' else '?', sql)
+            if len(self._translated) >= _FINGERPRINTS_LIMIT:
+                self._translated.clear()
+            self._translated[sql] = q
+        return q
+
+    def ddl(self, ddl):
+        """
+        >>> [_SqliteBackend().ddl(t) for t in ('varchar(50)', 'bigint', 'boolean', 'real', 'text')]
+        ['text', 'integer', 'boolean', 'real', 'text']
+        """
+        t = ddl.lower()
+        if t.startswith('varchar') or t.startswith('char'):
+            return 'text'
+        if t in ('bigint', 'smallint', 'int'):
+            return 'integer'
+        return ddl
+
+    def index_names(self, table):
+        return set(r.name for r in select("select name from sqlite_master where type='index' and tbl_name=%s", table))
+
+    def claim_id_node(self, raw):
+        """
+        Claim the node from the counter file next to the database, the only writer of the database
+        may be the transaction of the caller.
+        """
+        path = raw.execute('pragma database_list').fetchone()[2]
+        if not path:
+            # the in-memory database lives in this process only, any node is unique in it.
+            return 0
+        import fcntl
+        with open(path + '-id-node', 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            node = int(f.read() or 0)
+            f.truncate(0)
+            f.write(str(node + 1))
+        return node & _ID_NODE_MASK
+
+    def autocommit(self, raw, on):
+        raw.isolation_level = None if on else ''
+
+
+class _ReplicaSet(object):
+    """
+    Read replicas of the engine
+
+    Choose the pool of a replica by round robin or least connections.
+    A replica failing to give a connection is ejected for retry_interval seconds, then tried again.
+
+    >>> class FakePool(object):
+    ...     def __init__(self, name):
+    ...         self.name, self.in_use, self.down = name, 0, False
+    ...     def checkout(self):
+    ...         if self.down:
+    ...             raise IOError('%s is down' % self.name)
+    ...         self.in_use += 1
+    ...         return self.name
+    ...     def stats(self):
+    ...         return Dict(name=self.name)
+    >>> pools = [FakePool('a'), FakePool('b')]
+    >>> replicas = _ReplicaSet(pools, retry_interval=0.05)
+    >>> [replicas.checkout() for i in range(4)]
+    ['a', 'b', 'a', 'b']
+    >>> pools[0].in_use = 5
+    >>> _ReplicaSet(pools, 'least_connections').checkout()
+    'b'
+    >>> pools[0].down = True
+    >>> [replicas.checkout() for i in range(3)]
+    ['b', 'b', 'b']
+    >>> [d.down for d in replicas.stats()]
+    [True, False]
+    >>> pools[1].down = True
+    >>> replicas.checkout() is None
+    True
+    >>> pools[0].down = pools[1].down = False
+    >>> time.sleep(0.06)
+    >>> sorted([replicas.checkout() for i in range(2)])
+    ['a', 'b']
+    >>> [d.down for d in replicas.stats()]
+    [False, False]
+    """
+    def __init__(self, pools, strategy='round_robin', retry_interval=30.0):
+        if strategy not in ('round_robin', 'least_connections'):
+            raise ValueError('Invalid replica strategy: %s' % strategy)
+        self.pools = pools
+        self.strategy = strategy
+        self.retry_interval = retry_interval
+        # id of the ejected pool -> time to retry.
+        self._down = dict()
+        self._next = itertools.count()
+
+    def _candidates(self):
+        now = time.time()
+        pools = [p for p in self.pools if self._down.get(id(p), 0) <= now]
+        if self.strategy == 'least_connections':
+            return sorted(pools, key=lambda p: p.in_use)
+        if pools:
+            i = next(self._next) % len(pools)
+            pools = pools[i:] + pools[:i]
+        return pools
+
+    def checkout(self):
+        """
+        Borrow a connection from a healthy replica.
+        :return: _PooledConnection object or None if no replica available.
+        """
+        for pool in self._candidates():
+            try:
+                conn = pool.checkout()
+                self._down.pop(id(pool), None)
+                return conn
+            except PoolTimeoutError:
+                continue
+            except Exception, e:
+                self.eject(pool, e)
+        return None
+
+    def eject(self, pool, error=None):
+        logging.warning('Eject replica <%s> for %s seconds: %s' % (hex(id(pool)), self.retry_interval, error))
+        self._down[id(pool)] = time.time() + self.retry_interval
+
+    def stats(self):
+        now = time.time()
+        result = list()
+        for pool in self.pools:
+            d = pool.stats()
+            d.down = self._down.get(id(pool), 0) > now
+            result.append(d)
+        return result
+
+
 class _Engine(object):
     """
     Class database engine
 
-    Used to connect the database.
+    Used to connect the database, the connections are borrowed from and returned to the pool.
+    The engine may have read replicas, reads out of transaction are routed to them.
     """
-    def __init__(self, connect):
+    def __init__(self, connect, backend=None, replicas=(), replica_strategy='round_robin',
+                 replica_retry_interval=30.0, row_factory='dict', statement_cache_size=100, prepare_threshold=5,
+                 **pool_params):
         self._connect = connect
+        self.backend = backend or _BACKENDS['postgresql']
+        self.row_factory = _ROW_FACTORIES[row_factory] if isinstance(row_factory, basestring) else row_factory
+        self.statement_cache_size = statement_cache_size
+        self.prepare_threshold = prepare_threshold
+        self.pool = _ConnectionPool(functools.partial(self._open, connect), **pool_params)
+        self.replicas = None
+        if replicas:
+            self.replicas = _ReplicaSet([_ConnectionPool(functools.partial(self._open, c), **pool_params)
+                                         for c in replicas], replica_strategy, replica_retry_interval)
+
+    def _open(self, connect):
+        statements = None
+        if self.statement_cache_size > 0:
+            statements = _StatementCache(self.statement_cache_size, self.prepare_threshold)
+        return _PooledConnection(connect(), statements)
 
     def connect(self):
-        return self._connect()
+        return self.pool.checkout()
+
+    def claim_id_node(self):
+        """
+        Claim a node of the integer ids on a new connection to the primary, out of the pool and
+        the transactions of the caller, so the claim is committed at once.
+        """
+        raw = self._connect()
+        try:
+            node = self.backend.claim_id_node(raw)
+            raw.commit()
+            return node
+        finally:
+            raw.close()
+
+    def connect_replica(self):
+        """
+        Borrow a connection from a read replica.
+        :return: _PooledConnection object or None if there is no replica available.
+        """
+        if self.replicas is None:
+            return None
+        return self.replicas.checkout()
+
+    def release(self, conn):
+        conn.pool.release(conn)
+
+    def eject(self, conn, error=None):
+        """
+        Eject the replica of the broken connection and release the connection.
+        """
+        if self.replicas is not None:
+            self.replicas.eject(conn.pool, error)
+        self.release(conn)
 
 
 class _DbContext(threading.local):
@@ -39,6 +763,12 @@ class _DbContext(threading.local):
         self.connection = None
         # record the numbers of transactions
         self.transactions = 0
+        # record the numbers of use_primary() contexts, it lives out of the connection
+        self.primary_only = 0
+        # record the numbers of cached() contexts
+        self.cache_reads = 0
+        # tables written in the transaction, notified again when the transaction ends
+        self.written_tables = set()
 
     def is_init(self):
         return self.connection is not None
@@ -55,6 +785,39 @@ class _DbContext(threading.local):
     def cursor(self):
         return self.connection.cursor()
 
+    def is_cacheable(self):
+        """
+        Check the reads can use the query cache: in cached() context, not in transaction nor use_primary() context.
+        """
+        return self.cache_reads > 0 and self.transactions == 0 and self.primary_only == 0
+
+    def written(self, tables):
+        """
+        Invalidate the tables in the query cache and notify the write listeners after written.
+        :param tables: table names, None if unknown.
+        """
+        if _query_cache is None and not _write_listeners:
+            return
+        _notify_written(tables)
+        if self.transactions > 0:
+            if tables is None:
+                self.written_tables.add(None)
+            else:
+                self.written_tables.update(tables)
+
+    def end_transaction(self):
+        # other threads may cache the rows before the transaction ends
+        if self.written_tables:
+            tables = self.written_tables
+            _notify_written(None if None in tables else tables)
+        self.written_tables = set()
+
+    def is_read_routable(self):
+        """
+        Check the reads can be routed to a replica: not in transaction nor use_primary() context.
+        """
+        return self.transactions == 0 and self.primary_only == 0 and engine.replicas is not None
+
 
 class _ConnectionInThread(object):
     """
@@ -66,27 +829,60 @@ class _ConnectionInThread(object):
     """
     def __init__(self):
         self.connection = None
+        # connection to a read replica
+        self.replica = None
+        # seconds waited for the connections from the pools
+        self.wait_time = 0.0
 
     def clean(self):
-        if self.connection:
-            conn = self.connection
-            self.connection = None
-            logging.info('Close connection id(%s)' % hex(id(conn)))
-            conn.close()
+        for conn in (self.connection, self.replica):
+            if conn:
+                logging.info('Release connection id(%#x)', id(conn.raw))
+                engine.release(conn)
+        self.connection = None
+        self.replica = None
 
-    def cursor(self):
-        # get the connection only when want get the cursor
+    def get(self):
+        """
+        Get the connection to the primary, borrow it from the pool only when want use it.
+        :return: _PooledConnection object.
+        """
         if self.connection is None:
             conn = engine.connect()
-            logging.info('Open connection id(%s)' % hex(id(conn)))
+            logging.info('Borrow connection id(%#x)', id(conn.raw))
+            self.wait_time += conn.wait
             self.connection = conn
-        return self.connection.cursor()
+        return self.connection
+
+    def get_replica(self):
+        """
+        Get the connection to a read replica.
+        :return: _PooledConnection object or None if there is no replica available.
+        """
+        if self.replica is None:
+            conn = engine.connect_replica()
+            if conn is not None:
+                logging.info('Borrow replica connection id(%#x)', id(conn.raw))
+                self.wait_time += conn.wait
+            self.replica = conn
+        return self.replica
+
+    def eject_replica(self, error=None):
+        conn = self.replica
+        self.replica = None
+        if conn:
+            engine.eject(conn, error)
+
+    def cursor(self):
+        return self.get().cursor()
 
     def commit(self):
-        self.connection.commit()
+        if self.connection:
+            self.connection.commit()
 
     def rollback(self):
-        self.connection.rollback()
+        if self.connection:
+            self.connection.rollback()
 
 
 class _ConnectionContext(object):
@@ -144,11 +940,14 @@ class _TransactionContext(object):
         _db_ctx.transactions -= 1
         try:
             if _db_ctx.transactions == 0:
-                if exc_type is None:
-                    # exit without exception
-                    self.commit()
-                else:
-                    self.rollback()
+                try:
+                    if exc_type is None:
+                        # exit without exception
+                        self.commit()
+                    else:
+                        self.rollback()
+                finally:
+                    _db_ctx.end_transaction()
         finally:
             if self.is_closable:
                 if exc_type is not None:
@@ -178,6 +977,567 @@ class _TransactionContext(object):
         logging.info('Rollback finished')
 
 
+class _CacheContext(object):
+    """
+    Query cache context
+
+    Selects in _CacheContext are answered by the query cache if it is enabled by enable_query_cache().
+    Selects in transaction or in _PrimaryContext always bypass the cache.
+
+    usage:
+    with _CacheContext():
+        # selects of the rows rarely changed
+        pass
+    """
+    def __enter__(self):
+        global _db_ctx
+        _db_ctx.cache_reads += 1
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        global _db_ctx
+        _db_ctx.cache_reads -= 1
+
+
+class _QueryCache(object):
+    """
+    Result cache of select sql
+
+    The raw results are keyed by (sql, first, args) and evicted by LRU when there are more than max_entries
+    entries or more than max_bytes bytes, and expired after ttl seconds.
+    Every entry is tagged with the tables it reads, and dropped when the tables are written.
+    The results read from a replica less than replica_lag seconds after the tables written are not cached,
+    the replica may not have the writes yet.
+
+    >>> cache = _QueryCache(replica_lag=0.05)
+    >>> result = (('id',), [(1,)])
+    >>> cache.invalidate(['t'])
+    >>> cache.put('k', ('t',), result, replica=True)
+    >>> cache.get('k') is None
+    True
+    >>> cache.put('k', ('t',), result)
+    >>> cache.get('k')
+    (('id',), [(1,)])
+    >>> time.sleep(0.06)
+    >>> cache.put('k2', ('t',), result, replica=True)
+    >>> cache.get('k2')
+    (('id',), [(1,)])
+    >>> cache.invalidate()
+    >>> cache.put('k3', ('u',), result, replica=True)
+    >>> cache.stats().entries
+    0
+    """
+    def __init__(self, max_entries=1000, ttl=60.0, max_bytes=16 * 1024 * 1024, replica_lag=1.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.replica_lag = replica_lag
+        self._lock = threading.Lock()
+        # key -> (expires, tables, size, result), the most recently used at the end.
+        self._entries = collections.OrderedDict()
+        # table -> set of keys
+        self._tables = collections.defaultdict(set)
+        # table -> time the table was written last, and the time all the tables were written last.
+        self._written = dict()
+        self._written_all = 0.0
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+        self._invalidations = 0
+
+    @staticmethod
+    def key(sql, first, args):
+        """
+        Get the cache key of the select, None if the args are unhashable.
+        """
+        key = (sql, first, args)
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    @staticmethod
+    def _size(result):
+        names, values = result
+        if values is None:
+            return 64
+        rows = [values] if isinstance(values, tuple) else values
+        size = sys.getsizeof(rows)
+        for row in rows:
+            size += sys.getsizeof(row) + sum([sys.getsizeof(v) for v in row])
+        return size
+
+    def _remove(self, key):
+        expires, tables, size, result = self._entries.pop(key)
+        self._bytes -= size
+        for t in tables:
+            keys = self._tables.get(t)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tables[t]
+
+    def get(self, key):
+        """
+        Get the raw result.
+        :return: tuple of (column names, values) or None if not cached.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self._misses += 1
+                return None
+            self._entries[key] = entry
+            if entry[0] < time.time():
+                self._remove(key)
+                self._expirations += 1
+                self._misses += 1
+                return None
+            self._hits += 1
+            return entry[3]
+
+    def _is_lagging(self, tables, now):
+        """
+        Check the tables are written less than replica_lag seconds ago, must be called with the lock held.
+        """
+        since = now - self.replica_lag
+        return self._written_all > since or any(self._written.get(t, 0.0) > since for t in tables)
+
+    def put(self, key, tables, result, replica=False):
+        """
+        Cache the raw result.
+        :param replica: True if the result is read from a replica.
+        """
+        size = self._size(result)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if replica and self._is_lagging(tables, time.time()):
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.time() + self.ttl, tables, size, result)
+            self._bytes += size
+            for t in tables:
+                self._tables[t].add(key)
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self._evictions += 1
+
+    def invalidate(self, tables=None):
+        """
+        Drop the entries reading the tables.
+        :param tables: table names, None to drop all the entries.
+        """
+        with self._lock:
+            now = time.time()
+            if tables is None:
+                self._written_all = now
+                self._invalidations += len(self._entries)
+                self._entries.clear()
+                self._tables.clear()
+                self._bytes = 0
+                return
+            for t in tables:
+                self._written[t] = now
+                for key in list(self._tables.get(t, ())):
+                    self._remove(key)
+                    self._invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            n = self._hits + self._misses
+            return Dict(entries=len(self._entries), bytes=self._bytes, hits=self._hits, misses=self._misses,
+                        hit_ratio=float(self._hits) / n if n else 0.0, evictions=self._evictions,
+                        expirations=self._expirations, invalidations=self._invalidations)
+
+
+class _PrimaryContext(object):
+    """
+    Primary database context
+
+    Reads in _PrimaryContext are not routed to the read replicas, so the writes can be read back at once.
+
+    usage:
+    with _PrimaryContext():
+        # reads of the writes just done
+        pass
+    """
+    def __enter__(self):
+        global _db_ctx
+        _db_ctx.primary_only += 1
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        global _db_ctx
+        _db_ctx.primary_only -= 1
+
+
+class Deferred(object):
+    """
+    Deferred result of the sql queued in a batch, resolved when the batch is flushed.
+    """
+    def __init__(self):
+        self._resolved = False
+        self._value = None
+
+    def resolve(self, value):
+        self._value = value
+        self._resolved = True
+
+    @property
+    def resolved(self):
+        return self._resolved
+
+    @property
+    def value(self):
+        if not self._resolved:
+            raise DBError('Batch is not flushed.')
+        return self._value
+
+    def get(self):
+        return self.value
+
+
+class _BatchContext(object):
+    """
+    Database batch context
+
+    Selects and updates queued in _BatchContext are sent to the database in one statement when the batch
+    is flushed, at the exit of the context or by flush(). Every queued sql gets a Deferred result.
+    The selects are aggregated as json and the updates run as data-modifying WITH queries, so the sql
+    of one statement see the same snapshot. A select queued after an update starts the next statement
+    of the flush, so it sees the update. The updates between two selects should not depend on each other.
+    A select should not have duplicate column names.
+
+    usage:
+    with _BatchContext() as b:
+        blog = b.select_one('select * from blogs where b_id=%s', b_id)
+        comments = b.select('select * from comments where b_id=%s', b_id)
+    blog.value, comments.value
+    """
+    def __enter__(self):
+        self._conn_ctx = _ConnectionContext()
+        self._conn_ctx.__enter__()
+        self._queue = list()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            if exc_type is None:
+                self.flush()
+        finally:
+            self._conn_ctx.__exit__(exc_type, exc_val, exc_tb)
+
+    def _add(self, kind, sql, args):
+        d = Deferred()
+        self._queue.append((kind, sql, args, d))
+        return d
+
+    def select(self, sql, *args):
+        """
+        Queue select SQL, the Deferred value is the list of rows.
+        """
+        return self._add('select', sql, args)
+
+    def select_one(self, sql, *args):
+        """
+        Queue select SQL expected one result, the Deferred value is the row or None.
+        """
+        return self._add('select_one', sql, args)
+
+    def select_int(self, sql, *args):
+        """
+        Queue select SQL expected one int, the Deferred value is the int.
+        """
+        return self._add('select_int', sql, args)
+
+    def update(self, sql, *args):
+        """
+        Queue update, insert or delete SQL, the Deferred value is the numbers of rows.
+        """
+        return self._add('update', sql, args)
+
+    def flush(self):
+        """
+        Send the queued sql in one round trip and resolve their Deferred results.
+        """
+        queue, self._queue = self._queue, list()
+        statement = list()
+        written = False
+        for item in queue:
+            if written and item[0] != 'update':
+                # the updates are not seen by the selects of the same statement.
+                _flush_batch(statement)
+                statement, written = list(), False
+            statement.append(item)
+            written = written or item[0] == 'update'
+        if statement:
+            _flush_batch(statement)
+
+
+class _Histogram(object):
+    """
+    Histogram of the durations of a statement fingerprint
+
+    The durations are counted in the buckets of _HISTOGRAM_BOUNDS, the percentiles are
+    the upper bounds of the buckets capped by the max duration.
+
+    >>> h = _Histogram()
+    >>> for d in [0.0005] * 90 + [0.015] * 9 + [0.3]:
+    ...     h.add(d, 2, 0.0)
+    >>> h.percentile(0.5), h.percentile(0.95), h.percentile(0.99), h.percentile(1.0)
+    (0.001, 0.02, 0.02, 0.3)
+    >>> d = h.to_dict()
+    >>> d.count, d.rows, d.max
+    (100, 200, 0.3)
+    >>> _Histogram().percentile(0.5)
+    0.0
+    """
+    def __init__(self):
+        self.buckets = [0] * (len(_HISTOGRAM_BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.rows = 0
+        self.wait = 0.0
+
+    def add(self, duration, rows, wait):
+        self.buckets[bisect.bisect_left(_HISTOGRAM_BOUNDS, duration)] += 1
+        self.count += 1
+        self.total += duration
+        self.max = max(self.max, duration)
+        self.rows += rows
+        self.wait += wait
+
+    def percentile(self, p):
+        n = self.count * p
+        seen = 0
+        for i, c in enumerate(self.buckets):
+            seen += c
+            if c and seen >= n:
+                return min(_HISTOGRAM_BOUNDS[i], self.max) if i < len(_HISTOGRAM_BOUNDS) else self.max
+        return 0.0
+
+    def to_dict(self):
+        return Dict(count=self.count, total=self.total, avg=self.total / self.count if self.count else 0.0,
+                    max=self.max, p50=self.percentile(0.5), p95=self.percentile(0.95), p99=self.percentile(0.99),
+                    rows=self.rows, wait=self.wait)
+
+
+class _Instrumentation(object):
+    """
+    Query instrumentation
+
+    Every query is timed, the queries slower than slow_threshold seconds are logged.
+    Queries sampled by sample_rate are recorded in the histograms of their fingerprints
+    and passed to the listeners as Dict events.
+
+    >>> events = []
+    >>> inst = _Instrumentation(listeners=[lambda e: 1 / 0, events.append])
+    >>> inst.record('select * from t where id=%s', (1,), 0.002, 1, 0.0)
+    >>> inst.record('select * from t where id=%s', (2,), 0.004, 0, 0.001)
+    >>> [(e.fingerprint, e.args, e.rows) for e in events]
+    [('select * from t where id=?', (1,), 1), ('select * from t where id=?', (2,), 0)]
+    >>> s = inst.stats()['select * from t where id=?']
+    >>> s.count, s.rows, s.p50, s.max, s.wait
+    (2, 1, 0.002, 0.004, 0.001)
+
+    Only the sampled queries are recorded, but every slow query is logged:
+
+    >>> class Records(logging.Handler):
+    ...     def __init__(self):
+    ...         logging.Handler.__init__(self)
+    ...         self.messages = []
+    ...     def emit(self, record):
+    ...         self.messages.append(record.getMessage())
+    >>> records = Records()
+    >>> logging.getLogger().addHandler(records)
+    >>> inst = _Instrumentation(sample_rate=0.0, slow_threshold=0.1, listeners=[events.append])
+    >>> inst.record('select 1', (), 0.05, 1, 0.0)
+    >>> inst.record('select 2', (), 0.15, 1, 0.0)
+    >>> logging.getLogger().removeHandler(records)
+    >>> records.messages
+    ['[SLOW QUERY] 0.150s, SQL: select 2, ARGS: ()']
+    >>> inst.stats(), len(events)
+    ({}, 2)
+    >>> inst = _Instrumentation(sample_rate=0.5)
+    >>> for i in xrange(1000):
+    ...     inst.record('select 1', (), 0.001, 1, 0.0)
+    >>> 400 < inst.stats()['select ?'].count < 600
+    True
+    """
+    def __init__(self, sample_rate=1.0, slow_threshold=0.1, listeners=()):
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+        self.listeners = list(listeners)
+        self._lock = threading.Lock()
+        # fingerprint -> _Histogram object
+        self._histograms = dict()
+
+    def record(self, sql, args, duration, rows, wait):
+        if self.slow_threshold is not None and duration >= self.slow_threshold:
+            logging.warning('[SLOW QUERY] %.3fs, SQL: %s, ARGS: %s', duration, sql, args)
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return
+        fp = fingerprint(sql)
+        with self._lock:
+            h = self._histograms.get(fp)
+            if h is None:
+                h = self._histograms[fp] = _Histogram()
+            h.add(duration, rows, wait)
+        if self.listeners:
+            event = Dict(sql=sql, fingerprint=fp, args=args, duration=duration, rows=rows, wait=wait)
+            for listener in self.listeners:
+                try:
+                    listener(event)
+                except Exception:
+                    logging.exception('Query listener %s failed.', listener)
+
+    def stats(self):
+        with self._lock:
+            return dict((fp, h.to_dict()) for fp, h in self._histograms.iteritems())
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+
+
+class _IdGenerator(object):
+    """
+    Generator of 64-bit k-sortable ids
+
+    An id is made of 41 bits of milliseconds since _ID_EPOCH, 10 bits of node and 12 bits of sequence
+    in the millisecond, so ids are unique across the nodes and ordered by time.
+    Every process generating ids needs a node of its own, see set_id_node() for the sources of the node.
+    When the sequence of the current millisecond is used up, the generator waits for the next one.
+    The ids of an explicit timestamp are numbered by the sequence of its millisecond, and are unique
+    among the last _ID_TIMESTAMPS_LIMIT milliseconds used.
+
+    >>> g = _IdGenerator(1)
+    >>> t = 1475398134.988
+    >>> ids = [g.next(t) for i in xrange(4096)]
+    >>> len(set(ids)), int_id_time(max(ids))
+    (4096, 1475398134.988)
+    >>> g.next(t)
+    Traceback (most recent call last):
+      ...
+    DBError: Ids of timestamp 1475398134.988 are used up.
+    >>> len(set(ids + [g.next(t + 0.001) for i in xrange(5)]))
+    4101
+    >>> g._pid = -1  # as if the process is forked
+    >>> g.next()
+    Traceback (most recent call last):
+      ...
+    DBError: Id node 1 is set in another process, set the node of the forked process, see set_id_node().
+    >>> g.node = None
+    >>> g.next()
+    Traceback (most recent call last):
+      ...
+    DBError: Id node is not set, see set_id_node().
+    >>> os.environ['TRANSWARP_ID_NODE'] = '7'
+    >>> (g.next() >> 12) & _ID_NODE_MASK
+    7
+    >>> del os.environ['TRANSWARP_ID_NODE']
+    >>> g.node = 'sequence'
+    >>> with transaction():
+    ...     0 <= g.node <= _ID_NODE_MASK
+    True
+    """
+    def __init__(self, node=None):
+        self._lock = threading.Lock()
+        self._node_lock = threading.Lock()
+        # int, 'sequence' or None, see set_id_node().
+        self._source = None
+        # the node and the process it belongs to.
+        self._node = None
+        self._pid = None
+        self._last = -1
+        # millisecond -> last sequence, the most recently used at the end.
+        self._sequences = collections.OrderedDict()
+        self.node = node
+
+    @property
+    def node(self):
+        pid = os.getpid()
+        if pid == self._pid:
+            return self._node
+        # the node is claimed without the lock of the ids, so a slow claim blocks only the threads needing it.
+        with self._node_lock:
+            if pid != self._pid:
+                node = self._resolve_node()
+                logging.info('Use id node %d in process %d.', node, pid)
+                self._node = node
+                # set after the node, the threads see the pid of this process only with its node.
+                self._pid = pid
+            return self._node
+
+    def _resolve_node(self):
+        if isinstance(self._source, (int, long)):
+            raise DBError('Id node %d is set in another process, set the node of the forked process, '
+                          'see set_id_node().' % self._source)
+        if self._source == 'sequence':
+            return engine.claim_id_node()
+        node = os.environ.get(_ID_NODE_ENV)
+        if node is None:
+            raise DBError('Id node is not set, see set_id_node().')
+        node = int(node)
+        if not 0 <= node <= _ID_NODE_MASK:
+            raise ValueError('Node must be in 0..%d: %s' % (_ID_NODE_MASK, node))
+        return node
+
+    @node.setter
+    def node(self, node):
+        if isinstance(node, (int, long)):
+            if not 0 <= node <= _ID_NODE_MASK:
+                raise ValueError('Node must be in 0..%d: %s' % (_ID_NODE_MASK, node))
+            self._node, self._pid = node, os.getpid()
+        elif node in (None, 'sequence'):
+            self._node, self._pid = None, None
+        else:
+            raise ValueError('Node must be int, \'sequence\' or None: %r' % node)
+        self._source = node
+
+    def next(self, t=None):
+        """
+        Get the next id of now, or of the timestamp t.
+        """
+        node = self.node
+        with self._lock:
+            if t is None:
+                while True:
+                    # never go back when the clock does.
+                    ms = max(int(time.time() * 1000) - _ID_EPOCH, self._last)
+                    sequence = self._next_sequence(ms)
+                    if sequence is not None:
+                        break
+                    time.sleep(0.0001)
+                self._last = ms
+            else:
+                ms = int(round(t * 1000)) - _ID_EPOCH
+                sequence = self._next_sequence(ms)
+                if sequence is None:
+                    raise DBError('Ids of timestamp %r are used up.' % t)
+            return (ms << 22) | (node << 12) | sequence
+
+    def _next_sequence(self, ms):
+        """
+        Get the next sequence of the millisecond, must be called with the lock held.
+        :return: int, or None if the sequence is used up.
+        """
+        sequence = self._sequences.pop(ms, -1) + 1
+        if sequence > _ID_SEQUENCE_MASK:
+            self._sequences[ms] = _ID_SEQUENCE_MASK
+            return None
+        self._sequences[ms] = sequence
+        if len(self._sequences) > _ID_TIMESTAMPS_LIMIT:
+            self._sequences.popitem(last=False)
+        return sequence
+
+
 class DBError(Exception):
     """
     Database error exception
@@ -196,6 +1556,15 @@ class MultiColumnsError(DBError):
     pass
 
 
+class PoolTimeoutError(DBError):
+    """
+    Pool timeout exception
+
+    DBError child class for describing no connection available in the pool before timeout.
+    """
+    pass
+
+
 class Dict(dict):
     """
     Dict support dict_object.key operation.
@@ -245,6 +1614,123 @@ class Dict(dict):
         self[key] = value
 
 
+class Row(tuple):
+    """
+    Compact row of select result.
+
+    Row is a read-only tuple support row.key and row['key'] operation, the subclass of Row is created
+    for every distinct columns by _row_class() and cached.
+
+    >>> R = _row_class(('a', 'b'))
+    >>> r = R((1, 'x'))
+    >>> r.a, r['b'], r[0]
+    (1, 'x', 1)
+    >>> _row_class(['a', 'b']) is R
+    True
+    >>> r.keys(), r.values()
+    (['a', 'b'], [1, 'x'])
+    >>> dict(**r) == dict(a=1, b='x')
+    True
+    >>> r.c
+    Traceback (most recent call last):
+    ...
+    AttributeError: 'Row' object has no attribute 'c'
+    >>> r['c']
+    Traceback (most recent call last):
+    ...
+    KeyError: 'c'
+    """
+    __slots__ = ()
+    _fields = ()
+    _index = {}
+
+    def __getitem__(self, key):
+        if isinstance(key, basestring):
+            return tuple.__getitem__(self, self._index[key])
+        return tuple.__getitem__(self, key)
+
+    def __getattr__(self, item):
+        raise AttributeError(r"'Row' object has no attribute '%s'" % item)
+
+    def __repr__(self):
+        return 'Row(%s)' % ', '.join(['%s=%r' % (k, v) for k, v in zip(self._fields, self)])
+
+    def get(self, key, default=None):
+        i = self._index.get(key)
+        return default if i is None else tuple.__getitem__(self, i)
+
+    def has_key(self, key):
+        return key in self._index
+
+    def keys(self):
+        return list(self._fields)
+
+    def values(self):
+        return list(self)
+
+    def items(self):
+        return zip(self._fields, self)
+
+    def iterkeys(self):
+        return iter(self._fields)
+
+    def itervalues(self):
+        return iter(self)
+
+    def iteritems(self):
+        return itertools.izip(self._fields, self)
+
+    def to_dict(self):
+        return Dict(self._fields, self)
+
+
+# names of the attributes of Row which cannot be shadowed by the columns, tuple's count and index can be.
+_ROW_RESERVED = frozenset(name for name in Row.__dict__ if not name.startswith('__'))
+
+# Row subclasses keyed by the tuple of column names
+_row_classes = dict()
+_ROW_CLASSES_LIMIT = 1024
+
+
+def _row_class(names):
+    """
+    Get the Row subclass of the columns, the class is created once and cached.
+    :param names: column names.
+    :return: Row subclass, calling it with the values tuple makes the row.
+    """
+    names = tuple(names)
+    cls = _row_classes.get(names)
+    if cls is None:
+        attrs = dict(__slots__=(), _fields=names, _index=dict((n, i) for i, n in enumerate(names)))
+        for i, n in enumerate(names):
+            if n not in _ROW_RESERVED:
+                attrs[n] = property(operator.itemgetter(i))
+        cls = type('Row', (Row,), attrs)
+        if len(_row_classes) >= _ROW_CLASSES_LIMIT:
+            _row_classes.clear()
+        cls = _row_classes.setdefault(names, cls)
+    return cls
+
+
+def _dict_row(names):
+    """
+    Row factory of Dict rows.
+    """
+    return functools.partial(Dict, names)
+
+
+def _tuple_row(names):
+    """
+    Row factory of plain tuple rows.
+    """
+    return tuple
+
+
+# row factories selectable by the row_factory argument of create_engine().
+# a row factory gets the column names and returns the function making the row from the values tuple.
+_ROW_FACTORIES = dict(dict=_dict_row, row=_row_class, tuple=_tuple_row)
+
+
 def next_id(t=None):
     """
     Get next id for database primary keys.
@@ -260,18 +1746,50 @@ def next_id(t=None):
     return '%015d%s000' % (int(t * 1000), uuid.uuid4().hex)
 
 
-def _profiling(start, sql=''):
+def next_int_id(t=None):
     """
-    Profile the database executing sql.
+    Get next 64-bit integer id for database primary keys, the ids are ordered by time.
+    It is unique across threads, and across processes and hosts of different nodes, see set_id_node().
+
+    :param t: timestamp, default is None and use time.time().
+    :return: next id as int, fits the bigint column.
 
-    :param start: start time.
-    :param sql: sql str.
+    >>> set_id_node(1)
+    >>> a, b = next_int_id(), next_int_id()
+    >>> a < b < 2 ** 63
+    True
+    >>> next_int_id(1475398134.988) < next_int_id(1475398134.989) < a
+    True
+    >>> int_id_time(next_int_id(1475398134.988))
+    1475398134.988
     """
-    t = time.time() - start
-    if t > 0.1:
-        logging.warning('[PROFILING] [DB] %s: %s' % (t, sql))
-    else:
-        logging.info('[PROFILING] [DB] %s: %s' % (t, sql))
+    return _id_generator.next(t)
+
+
+def int_id_time(int_id):
+    """
+    Get the timestamp when the integer id was generated.
+
+    :param int_id: id made by next_int_id().
+    :return: timestamp in seconds.
+    """
+    return ((int_id >> 22) + _ID_EPOCH) / 1000.0
+
+
+def set_id_node(node):
+    """
+    Set the node of the ids made by next_int_id(), every process generating ids needs a node of its own.
+
+    The node set as int belongs to this process, the ids made by a forked process raise DBError.
+    'sequence' claims a node from the database sequence id_node_seq in every process at its first id,
+    or from the counter file next to the database of SQLite, on a connection of its own committed at once,
+    the claimed nodes are unique among any 1024 processes started one after another.
+    None reads the node from the environment variable TRANSWARP_ID_NODE in every process,
+    the ids raise DBError if it is not set.
+
+    :param node: int in 0..1023, 'sequence' or None.
+    """
+    _id_generator.node = node
 
 
 def connection():
@@ -302,13 +1820,289 @@ def with_connection(func):
     @functools.wraps(func)
     def _wrapper(*args, **kwargs):
         with _ConnectionContext():
-            _start = time.time()
-            result = func(*args, **kwargs)
-            _profiling(_start)
-            return result
+            return func(*args, **kwargs)
     return _wrapper
 
 
+def cached():
+    """
+    Get query cache context object, selects in the context are answered by the query cache.
+    :return: _CacheContext object
+
+    usage:
+    with cached():
+        # selects of the rows rarely changed
+        pass
+    """
+    return _CacheContext()
+
+
+def enable_query_cache(max_entries=1000, ttl=60.0, max_bytes=16 * 1024 * 1024, replica_lag=1.0):
+    """
+    Enable the query cache used by the selects in cached() context.
+    :param max_entries: max numbers of cached results.
+    :param ttl: seconds the result is cached.
+    :param max_bytes: approximate max memory of the cached results.
+    :param replica_lag: seconds after the tables written, in which the results read from replicas are not cached.
+
+    >>> insert('testuser', id=400, name='Alice', email='alice400@test.org', password='pw', last_modified=0.0)
+    1
+    >>> enable_query_cache(ttl=10)
+    >>> with cached():
+    ...     select('select * from testuser where id=%s', 400)[0].name
+    ...     select('select * from testuser where id=%s', 400)[0].name
+    u'Alice'
+    u'Alice'
+    >>> query_cache_stats().hits
+    1
+    >>> update('update testuser set name=%s where id=%s', 'Alison', 400)
+    1
+    >>> with cached():
+    ...     select('select * from testuser where id=%s', 400)[0].name
+    u'Alison'
+    >>> disable_query_cache()
+    """
+    global _query_cache
+    _query_cache = _QueryCache(max_entries, ttl, max_bytes, replica_lag)
+
+
+def disable_query_cache():
+    global _query_cache
+    _query_cache = None
+
+
+def query_cache_stats():
+    """
+    Get the statistics of the query cache.
+    :return: Dict object with entries, bytes, hits, misses, hit_ratio, evictions, expirations and invalidations.
+    """
+    if _query_cache is None:
+        raise DBError('Query cache is not enabled.')
+    return _query_cache.stats()
+
+
+def invalidate(*tables):
+    """
+    Drop the cached results reading the tables, or all the cached results if no table given.
+    """
+    if _query_cache is not None:
+        _query_cache.invalidate(tables or None)
+
+
+def _read_tables(sql):
+    """
+    Get the tables read by the select sql.
+
+    >>> sorted(_read_tables('select * from blogs b join users u on b.u_id=u.u_id where b.b_id=%s'))
+    ['blogs', 'users']
+    >>> sorted(_read_tables('select count(*) from "Blogs" as b, comments c where b.b_id=c.b_id'))
+    ['blogs', 'comments']
+    """
+    tables = set()
+    for clause in _RE_READ_TABLES.findall(sql):
+        for item in clause.split(','):
+            tables.add(item.split()[0].strip('"').lower())
+    return frozenset(tables)
+
+
+def _written_tables(sql):
+    """
+    Get the tables written by the sql, None if unknown.
+
+    >>> _written_tables('insert into "users" (u_id) values (%s)')
+    ('users',)
+    >>> _written_tables('drop table users') is None
+    True
+    """
+    m = _RE_WRITE_TABLE.match(sql)
+    return (m.group(1).lower(),) if m else None
+
+
+def fingerprint(sql):
+    """
+    Get the fingerprint of the sql: the literals and parameters are replaced by '?'.
+
+    >>> fingerprint("SELECT * from users  where u_id=%s and name='Bob' and age > 20")
+    'select * from users where u_id=? and name=? and age > ?'
+    >>> fingerprint('select * from users where u_id in (%s, %s, %s)')
+    'select * from users where u_id in (...)'
+    """
+    fp = _fingerprints.get(sql)
+    if fp is None:
+        fp = _RE_FP_LITERAL.sub('?', sql)
+        fp = _RE_FP_SPACE.sub(' ', fp).strip().lower()
+        fp = _RE_FP_LIST.sub('(...)', fp)
+        if len(_fingerprints) >= _FINGERPRINTS_LIMIT:
+            _fingerprints.clear()
+        _fingerprints[sql] = fp
+    return fp
+
+
+def enable_instrumentation(sample_rate=1.0, slow_threshold=0.1):
+    """
+    Enable the query instrumentation.
+    :param sample_rate: ratio of the queries recorded in the histograms and passed to the listeners.
+    :param slow_threshold: seconds, the slower queries are logged as warning, None to disable.
+    """
+    global _instrumentation
+    listeners = _instrumentation.listeners if _instrumentation is not None else ()
+    _instrumentation = _Instrumentation(sample_rate, slow_threshold, listeners)
+
+
+def disable_instrumentation():
+    global _instrumentation
+    _instrumentation = None
+
+
+def add_query_listener(listener):
+    """
+    Add the listener of the queries, the instrumentation is enabled if not.
+    :param listener: function getting Dict event with sql, fingerprint, args, duration, rows and wait.
+    """
+    if _instrumentation is None:
+        enable_instrumentation()
+    _instrumentation.listeners.append(listener)
+
+
+def remove_query_listener(listener):
+    if _instrumentation is not None and listener in _instrumentation.listeners:
+        _instrumentation.listeners.remove(listener)
+
+
+def add_write_listener(listener):
+    """
+    Add the listener of the writes, called after the tables are written, and again when the transaction ends.
+    :param listener: function getting the written table names, None if unknown.
+    """
+    _write_listeners.append(listener)
+
+
+def remove_write_listener(listener):
+    if listener in _write_listeners:
+        _write_listeners.remove(listener)
+
+
+def _notify_written(tables):
+    if _query_cache is not None:
+        _query_cache.invalidate(tables)
+    for listener in _write_listeners:
+        listener(tables)
+
+
+def query_stats():
+    """
+    Get the statistics of the queries recorded by the instrumentation.
+    :return: dict of fingerprint -> Dict object with count, total, avg, max, p50, p95, p99, rows and wait.
+    """
+    if _instrumentation is None:
+        raise DBError('Instrumentation is not enabled.')
+    return _instrumentation.stats()
+
+
+def _record(sql, args, start, rows, wait):
+    _instrumentation.record(sql, args, time.time() - start, rows, _db_ctx.connection.wait_time - wait)
+
+
+def batch():
+    """
+    Get database batch context object, the sql queued in the context are sent in one round trip.
+    :return: _BatchContext object
+
+    usage:
+    with batch() as b:
+        blog = b.select_one('select * from blogs where b_id=%s', b_id)
+        comments = b.select('select * from comments where b_id=%s', b_id)
+        n = b.select_int('select count(*) from comments where b_id=%s', b_id)
+    render(blog.value, comments.value, n.value)
+
+    >>> insert_many('testuser', [dict(id=i, name=name, email='%s@test.org' % name, password='pw', last_modified=0.0)
+    ...                          for i, name in ((4000, 'Bea'), (4001, 'Bo'), (4002, 'Bud'))])
+    3
+    >>> with batch() as b:
+    ...     u = b.select_one('select * from testuser where id=%s', 4000)
+    ...     L = b.select('select id from testuser where id in (%s, %s) order by id', 4000, 4001)
+    ...     n = b.select_int('select count(*) from testuser where id=%s', 4000)
+    ...     r = b.update('update testuser set password=%s where id=%s', 'batched', 4002)
+    >>> u.value.name, [x.id for x in L.value], int(n.value), int(r.value)
+    (u'Bea', [4000, 4001], 1, 1)
+
+    The selects queued after an update see it:
+
+    >>> with batch() as b:
+    ...     r = b.update('update testuser set name=%s where id=%s', 'Bella', 4000)
+    ...     u = b.select_one('select * from testuser where id=%s', 4000)
+    ...     n = b.select_int('select count(*) from testuser where name=%s', 'Bella')
+    >>> int(r.value), u.value.name, int(n.value)
+    (1, u'Bella', 1)
+    """
+    return _BatchContext()
+
+
+def use_primary():
+    """
+    Get primary database context object, reads in the context are made on the primary.
+    :return: _PrimaryContext object
+
+    usage:
+    with use_primary():
+        # read your writes
+        pass
+
+    >>> class OperationalError(Exception):
+    ...     pass
+    >>> class FakeCursor(object):
+    ...     description = (('name',),)
+    ...     def __init__(self, raw):
+    ...         self.raw = raw
+    ...     def execute(self, sql, args):
+    ...         if self.raw.broken:
+    ...             raise OperationalError('server closed the connection unexpectedly')
+    ...     def fetchall(self):
+    ...         return [(u'replica',)]
+    ...     def close(self): pass
+    >>> class FakeReplica(object):
+    ...     broken = False
+    ...     def cursor(self):
+    ...         return FakeCursor(self)
+    ...     def rollback(self): pass
+    ...     def close(self): pass
+    >>> insert('testuser', id=500, name='primary', email='primary@test.org', password='pw', last_modified=0.0)
+    1
+    >>> engine.replicas = _ReplicaSet([_ConnectionPool(lambda: _PooledConnection(FakeReplica()), min_size=0)])
+    >>> sql = 'select name from testuser where id=%s'
+    >>> select(sql, 500)[0].name
+    u'replica'
+    >>> with use_primary():
+    ...     select(sql, 500)[0].name
+    u'primary'
+    >>> with transaction():
+    ...     select(sql, 500)[0].name
+    u'primary'
+
+    The results read from replicas just after written are not cached:
+
+    >>> enable_query_cache(replica_lag=60)
+    >>> update('update testuser set last_modified=%s where id=%s', 1.0, 500)
+    1
+    >>> with cached():
+    ...     select(sql, 500)[0].name
+    u'replica'
+    >>> query_cache_stats().entries
+    0
+    >>> disable_query_cache()
+
+    The broken replica is ejected and the select is made on the primary:
+
+    >>> FakeReplica.broken = True
+    >>> select(sql, 500)[0].name
+    u'primary'
+    >>> [d.down for d in pool_stats().replicas]
+    [True]
+    >>> engine.replicas = None
+    """
+    return _PrimaryContext()
+
+
 def transaction():
     """
     Get database transaction object
@@ -355,66 +2149,441 @@ def with_transaction(func):
     @functools.wraps(func)
     def _wrapper(*args, **kwargs):
         with _TransactionContext():
-            _start = time.time()
-            result = func(*args, **kwargs)
-            _profiling(_start)
-            return result
+            return func(*args, **kwargs)
     return _wrapper
 
+
+def in_transaction():
+    """
+    Check the current thread is in a transaction.
+    """
+    return _db_ctx.transactions > 0
+
 # global engine object
 engine = None
 
+# milliseconds of 2015-01-01 00:00:00 UTC, the epoch of the integer ids
+_ID_EPOCH = 1420070400000
+_ID_NODE_MASK = (1 << 10) - 1
+_ID_SEQUENCE_MASK = (1 << 12) - 1
+# numbers of the milliseconds whose sequences are kept
+_ID_TIMESTAMPS_LIMIT = 4096
+# environment variable of the id node, see set_id_node()
+_ID_NODE_ENV = 'TRANSWARP_ID_NODE'
+
+_id_generator = _IdGenerator()
+
+# backends by name
+_BACKENDS = dict(postgresql=_PostgresBackend(), sqlite=_SqliteBackend())
+
+# keyword arguments of create_engine() passed to the connection pool with 'pool_' prefix
+_POOL_PARAMS = ('min_size', 'max_size', 'idle_timeout', 'max_lifetime', 'pre_ping', 'pre_ping_after', 'timeout')
+
 # global database context object
 _db_ctx = _DbContext()
 
+# sequence of the names of server-side cursors
+_cursor_ids = itertools.count()
+
+# query cache, None if not enabled
+_query_cache = None
 
-def create_engine(user, password, database, host='127.0.0.1', port=5432, **kwargs):
+# query instrumentation, None if not enabled
+_instrumentation = None
+
+# functions called with the written tables
+_write_listeners = list()
+
+# upper bounds of the buckets of the histograms of query durations in seconds
+_HISTOGRAM_BOUNDS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0)
+
+# sql -> fingerprint
+_fingerprints = dict()
+_FINGERPRINTS_LIMIT = 4096
+
+# statistics of the prepared statements, updated with the lock held
+_statement_stats = dict(hits=0, misses=0, prepares=0, failures=0, evictions=0)
+_statement_lock = threading.Lock()
+
+# python types of the parameters -> types of the prepared statement parameters, bool before int
+_PARAM_TYPES = ((bool, 'boolean'), ((int, long), 'bigint'), (float, 'double precision'), (basestring, 'text'))
+
+# a compiled regular expression for the parameters and escaped '%' in sql.
+_RE_PARAM = re.compile(r'%(%|s)')
+# a compiled regular expression for the named parameters in sql.
+_RE_NAMED_PARAM = re.compile(r'%\(')
+# a compiled regular expression for the tables read by select sql.
+_RE_READ_TABLES = re.compile(r'\b(?:from|join)\s+("?[a-zA-Z_]\w*"?(?:\s+(?:as\s+)?\w+)?'
+                             r'(?:\s*,\s*"?[a-zA-Z_]\w*"?(?:\s+(?:as\s+)?\w+)?)*)', re.IGNORECASE)
+# a compiled regular expression for the table written by insert, update or delete sql.
+_RE_WRITE_TABLE = re.compile(r'^\s*(?:insert\s+into|update|delete\s+from)\s+"?([a-zA-Z_]\w*)"?', re.IGNORECASE)
+# compiled regular expressions for the literals, spaces and lists of literals in the fingerprint.
+_RE_FP_LITERAL = re.compile(r"'(?:[^']|'')*'|%s|\b\d+(?:\.\d+)?\b")
+_RE_FP_SPACE = re.compile(r'\s+')
+_RE_FP_LIST = re.compile(r'\(\?(?:\s*,\s*\?)+\)')
+# a compiled regular expression for the returning clause.
+_RE_RETURNING = re.compile(r'\breturning\b', re.IGNORECASE)
+# a compiled regular expression for the sql can be prepared.
+_RE_PREPARABLE = re.compile(r'^\s*(select|insert|update|delete)\s', re.IGNORECASE)
+
+
+def create_engine(user=None, password=None, database=None, host=None, port=None, **kwargs):
     """
     Create the engine connect the database.
-    Use postgreSQL database.
+    Use postgreSQL database by default, the keyword argument backend='sqlite' uses SQLite database
+    in the file of database, or in memory if database is None or ':memory:'.
+
+    The connections are kept in a pool, which can be configured by the keyword arguments:
+    pool_min_size, pool_max_size, pool_idle_timeout, pool_max_lifetime, pool_pre_ping, pool_pre_ping_after
+    and pool_timeout. The connections idle less than pool_pre_ping_after seconds (default 1) are not pinged.
+
+    The statements executed prepare_threshold times (default 5) are prepared on every connection,
+    statement_cache_size (default 100) bounds the prepared statements per connection, 0 to disable.
+
+    The keyword argument row_factory selects the type of select results: 'dict' for Dict rows (default),
+    'row' for compact cached Row tuples, or a function getting the column names and returning the row maker.
+
+    The keyword argument replicas is a list of dict of the connection parameters of read replicas
+    overriding the parameters of the primary, e.g. replicas=[dict(host='10.0.0.2'), dict(host='10.0.0.3')].
+    The selects out of transaction and use_primary() are routed to the replicas by replica_strategy,
+    'round_robin' (default) or 'least_connections'. A broken replica is ejected for
+    replica_retry_interval seconds (default 30).
     """
-    import psycopg2
     global engine
-    # set psycopg2 module select unicode result
-    psycopg2.extensions.register_type(psycopg2.extensions.UNICODE, None)
     if engine is not None:
         raise DBError('Engine is already initialized.')
+    backend = get_backend(kwargs.pop('backend', 'postgresql'))
+    replicas = kwargs.pop('replicas', ())
+    engine_params = dict(row_factory=kwargs.pop('row_factory', 'dict'))
+    for k in ('statement_cache_size', 'prepare_threshold', 'replica_strategy', 'replica_retry_interval'):
+        if k in kwargs:
+            engine_params[k] = kwargs.pop(k)
+    for k in _POOL_PARAMS:
+        if 'pool_' + k in kwargs:
+            engine_params[k] = kwargs.pop('pool_' + k)
     params = dict(user=user, password=password, database=database, host=host, port=port)
-    defaults = dict(client_encoding='UTF8', connection_factory=None, cursor_factory=None, async=False)
-    for k, v in defaults.items():
-        params[k] = kwargs.pop(k, v)
     params.update(kwargs)
-    engine = _Engine(lambda: psycopg2.connect(**params))
-    logging.info('Initialize postgreSQL engine <%s>' % hex(id(engine)))
+    engine_params = backend.engine_params(params, engine_params)
+    engine = _Engine(backend.connector(params), backend=backend,
+                     replicas=[backend.connector(dict(params, **r)) for r in replicas], **engine_params)
+    logging.info('Initialize %s engine <%#x>', backend.name, id(engine))
 
 
-def _select(sql, first, *args):
+def get_backend(name=None):
     """
-    Execute select sql
-    :param sql: select sql string, using '%s' represent parameter need to replaced.
-    :param first: boolean to check if getting one line or not.
-    :param args: parameters to replace the '%s' in sql string.
-    :return: list formed by Dict object.
+    Get the backend by name.
+    :param name: 'postgresql' or 'sqlite', default is the backend of the engine, or postgresql if no engine.
+    """
+    if name is None:
+        return engine.backend if engine is not None else _BACKENDS['postgresql']
+    if name not in _BACKENDS:
+        raise DBError('Unknown backend: %s' % name)
+    return _BACKENDS[name]
+
+
+def pool_stats():
+    """
+    Get the statistics of the connection pool of the engine.
+    :return: Dict object with size, in_use, idle, waiting, checkouts, timeouts, wait_time, max_wait and avg_wait,
+    and replicas, list of the statistics of the pools of the replicas with down flag.
+    """
+    if engine is None:
+        raise DBError('Engine is not initialized.')
+    d = engine.pool.stats()
+    d.replicas = engine.replicas.stats() if engine.replicas is not None else []
+    return d
+
+
+def statement_cache_stats():
+    """
+    Get the statistics of the prepared statements of all the connections.
+    :return: Dict object with hits, misses, prepares, failures and evictions.
+    """
+    with _statement_lock:
+        return Dict(**_statement_stats)
+
+
+def _count_statement(key):
+    with _statement_lock:
+        _statement_stats[key] += 1
+
+
+def _param_types(args):
+    """
+    Get the types of the parameters to prepare the statement with,
+    the untyped parameters of PREPARE would be text, e.g. 'select %s'.
+    :return: tuple of the type names, or None if any parameter is not of the known types.
+
+    >>> _param_types((1, 2L, True, 0.5, u'a', 'b'))
+    ('bigint', 'bigint', 'boolean', 'double precision', 'text', 'text')
+    >>> _param_types((1, None)) is None
+    True
+    """
+    if not isinstance(args, (tuple, list)):
+        return None
+    types = list()
+    for a in args:
+        for t, name in _PARAM_TYPES:
+            if isinstance(a, t):
+                types.append(name)
+                break
+        else:
+            return None
+    return tuple(types)
+
+
+def _prepared_sql(sql):
+    """
+    Convert the sql with '%s' parameters to the sql with '$n' parameters for PREPARE.
+
+    >>> _prepared_sql("select * from users where u_id=%s and name like 'a%%' and admin=%s")
+    ("select * from users where u_id=$1 and name like 'a%' and admin=$2", 2)
+    """
+    n = [0]
+
+    def replace(m):
+        if m.group(1) == '%':
+            return '%'
+        n[0] += 1
+        return '$%d' % n[0]
+    return _RE_PARAM.sub(replace, sql), n[0]
+
+
+def _execute(conn, cursor, sql, args):
+    """
+    Execute the sql by the cursor of the connection,
+    the hot statements are prepared and executed by the prepared statement cache of the connection.
+    A statement is prepared with the types of the parameters, and executed by the parameters of the same types.
+
+    >>> class FakeCursor(object):
+    ...     def __init__(self):
+    ...         self.executed = []
+    ...         self.fail = False
+    ...     def execute(self, sql, args=None):
+    ...         if sql.startswith('execute') and self.fail:
+    ...             raise IOError('cached plan must not change result type')
+    ...         self.executed.append(sql)
+    >>> class FakeRaw(object):
+    ...     def rollback(self): pass
+    >>> conn, cursor = _PooledConnection(FakeRaw(), _StatementCache(capacity=2, threshold=2)), FakeCursor()
+    >>> for i in (1, 2, 3):
+    ...     _execute(conn, cursor, 'select * from t where id=%s', (i,))
+    >>> _execute(conn, cursor, 'select * from t where id=%s', ('a',))
+    >>> for sql in cursor.executed[1:4]:
+    ...     print sql
+    prepare transwarp_stmt_0 (bigint) as select * from t where id=$1
+    execute transwarp_stmt_0 (%s)
+    execute transwarp_stmt_0 (%s)
+
+    The unprepared executions are translated by the backend like the others:
+
+    >>> cursor.executed[0] == cursor.executed[4] == engine.backend.translate('select * from t where id=%s')
+    True
+
+    The least recently used statement is deallocated when the cache is full:
+
+    >>> cursor.executed = []
+    >>> for sql in ('select 1', 'select 1', 'select 2', 'select 2'):
+    ...     _execute(conn, cursor, sql, ())
+    >>> cursor.executed[-3:]
+    ['deallocate transwarp_stmt_0', 'prepare transwarp_stmt_2 as select 2', 'execute transwarp_stmt_2']
+
+    The statement failed to execute is deallocated, and prepared again later:
+
+    >>> cursor.executed, cursor.fail = [], True
+    >>> _execute(conn, cursor, 'select 2', ())
+    Traceback (most recent call last):
+      ...
+    IOError: cached plan must not change result type
+    >>> cursor.fail = False
+    >>> for sql in ('select 2', 'select 2'):
+    ...     _execute(conn, cursor, sql, ())
+    >>> cursor.executed
+    ['deallocate transwarp_stmt_2', 'select 2', 'prepare transwarp_stmt_3 as select 2', 'execute transwarp_stmt_3']
+
+    The statements are prepared again on the connection replacing the broken one:
+
+    >>> conn, cursor = _PooledConnection(FakeRaw(), _StatementCache(capacity=2, threshold=2)), FakeCursor()
+    >>> for sql in ('select 1', 'select 1'):
+    ...     _execute(conn, cursor, sql, ())
+    >>> cursor.executed
+    ['select 1', 'prepare transwarp_stmt_0 as select 1', 'execute transwarp_stmt_0']
     """
     global _db_ctx
+    cache = conn.statements
+    if cache is None or not _RE_PREPARABLE.match(sql):
+        cursor.execute(engine.backend.translate(sql), args)
+        return
+    types = _param_types(args)
+    stmt = cache.lookup(sql)
+    if stmt is None and types is not None and _db_ctx.transactions == 0 and cache.is_hot(sql):
+        stmt = _prepare(conn, cursor, sql, types)
+    if stmt is None or stmt[1] != types:
+        _count_statement('misses')
+        cursor.execute(engine.backend.translate(sql), args)
+        return
+    _count_statement('hits')
+    name, types = stmt
+    try:
+        if types:
+            cursor.execute('execute %s (%s)' % (name, ','.join(['%s'] * len(types))), args)
+        else:
+            cursor.execute('execute %s' % name)
+    except Exception:
+        # e.g. the cached plan is invalid after the table altered, prepare it again later.
+        cache.forget(sql)
+        if _db_ctx.transactions == 0:
+            # the failed statement aborts the implicit transaction, which has nothing to keep.
+            conn.rollback()
+            _deallocate(conn, cursor)
+        raise
+
+
+def _deallocate(conn, cursor):
+    """
+    Deallocate the statements forgotten by the prepared statement cache of the connection,
+    must be called out of transaction.
+    """
+    cache = conn.statements
+    while cache.stale:
+        name = cache.stale.pop()
+        try:
+            cursor.execute('deallocate %s' % name)
+        except Exception, e:
+            # e.g. the statement is lost with the session of the server.
+            logging.warning('Deallocate statement %s failed: %s' % (name, e))
+            conn.rollback()
+
+
+def _prepare(conn, cursor, sql, types):
+    """
+    Prepare the sql on the connection, must be called out of transaction
+    because a failed PREPARE aborts the transaction.
+    :param types: tuple of the types of parameters.
+    :return: tuple of (statement name, types of parameters) or None if failed.
+    """
+    cache = conn.statements
+    if _RE_NAMED_PARAM.search(sql):
+        cache.forget(sql, failed=True)
+        return None
+    prepared, nargs = _prepared_sql(sql)
+    if nargs != len(types):
+        cache.forget(sql, failed=True)
+        return None
+    _deallocate(conn, cursor)
+    name, evicted = cache.add(sql, types)
+    try:
+        if evicted:
+            _count_statement('evictions')
+            cursor.execute('deallocate %s' % evicted)
+        if types:
+            cursor.execute('prepare %s (%s) as %s' % (name, ','.join(types), prepared))
+        else:
+            cursor.execute('prepare %s as %s' % (name, prepared))
+    except Exception, e:
+        logging.warning('Prepare statement failed: %s' % e)
+        _count_statement('failures')
+        cache.forget(sql, failed=True)
+        # the statement failed to prepare needs no deallocation.
+        cache.stale.remove(name)
+        conn.rollback()
+        return None
+    _count_statement('prepares')
+    return name, types
+
+
+def _is_disconnect(e):
+    """
+    Check the exception is raised by a broken connection.
+    """
+    return type(e).__name__ in ('OperationalError', 'InterfaceError')
+
+
+def _fetch(conn, sql, first, args):
+    """
+    Fetch the raw result of select sql.
+    :return: tuple of (column names, values), values is a tuple or None if first, else a list of tuples.
+    """
     cursor = None
-    logging.info('SQL: %s, ARGS: %s' % (sql, args))
     try:
-        cursor = _db_ctx.connection.cursor()
-        cursor.execute(sql, args)
-        if cursor.description:
-            names = [x[0] for x in cursor.description]
-            if first:
-                values = cursor.fetchone()
-                if not values:
-                    return None
-                return Dict(names, values)
-            return [Dict(names, x) for x in cursor.fetchall()]
+        cursor = conn.cursor()
+        _execute(conn, cursor, sql, args)
+        if not cursor.description:
+            return None, None
+        names = tuple([x[0] for x in cursor.description])
+        if first:
+            return names, cursor.fetchone()
+        return names, cursor.fetchall()
     finally:
         if cursor:
             cursor.close()
 
 
+def _make_rows(result, first, factory):
+    names, values = result
+    if names is None:
+        return None
+    make_row = (factory or engine.row_factory)(names)
+    if first:
+        return make_row(values) if values else None
+    return map(make_row, values)
+
+
+def _select(sql, first, factory, *args):
+    """
+    Execute select sql
+    :param sql: select sql string, using '%s' represent parameter need to replaced.
+    :param first: boolean to check if getting one line or not.
+    :param factory: row factory, None to use the row factory of the engine.
+    :param args: parameters to replace the '%s' in sql string.
+    :return: list formed by rows made by the row factory.
+    """
+    if _instrumentation is None:
+        return _make_rows(_select_raw(sql, first, args), first, factory)
+    start, wait = time.time(), _db_ctx.connection.wait_time
+    result = _select_raw(sql, first, args)
+    values = result[1]
+    _record(sql, args, start, (1 if values else 0) if first else len(values or ()), wait)
+    return _make_rows(result, first, factory)
+
+
+def _select_raw(sql, first, args):
+    """
+    Execute select sql and get the raw result
+
+    The select in cached() context is answered by the query cache if it is enabled.
+    The select out of transaction is made on a read replica if there is one,
+    the select failed by a broken replica is made again on the primary.
+    :return: tuple of (column names, values), see _fetch().
+    """
+    global _db_ctx
+    key = None
+    if _query_cache is not None and _db_ctx.is_cacheable():
+        key = _query_cache.key(sql, first, args)
+        if key is not None:
+            result = _query_cache.get(key)
+            if result is not None:
+                return result
+    result = None
+    replica = False
+    if _db_ctx.is_read_routable():
+        conn = _db_ctx.connection.get_replica()
+        if conn is not None:
+            try:
+                result = _fetch(conn, sql, first, args)
+                replica = True
+            except Exception, e:
+                if not _is_disconnect(e):
+                    raise
+                logging.warning('Select on replica failed, retry on primary: %s' % e)
+                _db_ctx.connection.eject_replica(e)
+    if result is None:
+        result = _fetch(_db_ctx.connection.get(), sql, first, args)
+    if key is not None:
+        _query_cache.put(key, _read_tables(sql), result, replica)
+    return result
+
+
 def _update(sql, *args):
     """
     Execute update or insert sql
@@ -424,13 +2593,18 @@ def _update(sql, *args):
     """
     global _db_ctx
     cursor = None
-    logging.info('SQL: %s, ARGS: %s' % (sql, args))
+    if _instrumentation is not None:
+        start, wait = time.time(), _db_ctx.connection.wait_time
     try:
-        cursor = _db_ctx.connection.cursor()
-        cursor.execute(sql, args)
+        conn = _db_ctx.connection.get()
+        cursor = conn.cursor()
+        _execute(conn, cursor, sql, args)
         row = cursor.rowcount
         if _db_ctx.transactions == 0:
-            _db_ctx.connection.commit()
+            conn.commit()
+        _db_ctx.written(_written_tables(sql))
+        if _instrumentation is not None:
+            _record(sql, args, start, row, wait)
         return row
     finally:
         if cursor:
@@ -456,7 +2630,7 @@ def select_one(sql, *args):
     >>> u2.name
     u'Alice'
     """
-    return _select(sql, True, *args)
+    return _select(sql, True, None, *args)
 
 
 @with_connection
@@ -484,10 +2658,10 @@ def select_int(sql, *args):
         ...
     MultiColumnsError: Expect only one column.
     """
-    d = _select(sql, True, *args)
+    d = _select(sql, True, _tuple_row, *args)
     if len(d) != 1:
         raise MultiColumnsError('Expect only one column.')
-    return d.values()[0]
+    return d[0]
 
 
 @with_connection
@@ -513,7 +2687,130 @@ def select(sql, *args):
     >>> L[1].name
     u'Wall.E'
     """
-    return _select(sql, False, *args)
+    return _select(sql, False, None, *args)
+
+
+def select_iter(sql, *args, **kwargs):
+    """
+    Execute select SQL and yield the results one by one.
+
+    The rows are fetched batch_size rows per round trip by a server-side cursor,
+    so the result set is never loaded into memory at once.
+    The connection is held until the generator is exhausted or closed.
+    :param sql: select sql string, using '%s' represent parameter need to replaced.
+    :param args: parameters to replace the '%s' in sql string.
+    :param batch_size: keyword argument, numbers of rows fetched per round trip, default is 1000.
+    :param factory: keyword argument, row factory, default is the row factory of the engine.
+    :return: generator of rows.
+
+    >>> u1 = dict(id=300, name='Iter', email='iter@test.org', password='iter-pw', last_modified=time.time())
+    >>> u2 = dict(id=301, name='Iter', email='iter2@test.org', password='iter-pw', last_modified=time.time())
+    >>> insert('testuser', **u1)
+    1
+    >>> insert('testuser', **u2)
+    1
+    >>> [u.id for u in select_iter('select * from testuser where name=%s order by id', 'Iter', batch_size=1)]
+    [300, 301]
+
+    The rows yielded are recorded by the instrumentation when the generator ends:
+
+    >>> enable_instrumentation()
+    >>> rows = select_iter('select * from testuser where name=%s', 'Iter', batch_size=1)
+    >>> next(rows).name
+    u'Iter'
+    >>> rows.close()
+    >>> len(list(select_iter('select * from testuser where name=%s', 'Iter')))
+    2
+    >>> s = query_stats()['select * from testuser where name=?']
+    >>> s.count, s.rows
+    (2, 3)
+    >>> disable_instrumentation()
+    """
+    batch_size = kwargs.pop('batch_size', 1000)
+    factory = kwargs.pop('factory', None)
+    if kwargs:
+        raise TypeError('Unexpected keyword arguments: %s' % ', '.join(kwargs))
+    global _db_ctx
+    instrumentation = _instrumentation
+    with _ConnectionContext():
+        cursor = None
+        # seconds of the execute and fetches, None if not instrumented.
+        duration = None
+        yielded = 0
+        try:
+            conn = None
+            if _db_ctx.is_read_routable():
+                conn = _db_ctx.connection.get_replica()
+            if conn is None:
+                conn = _db_ctx.connection.get()
+            if engine.backend.server_cursors:
+                # named cursor lives on the server side,
+                # a cursor declared WITH HOLD survives the commits of updates made while iterating.
+                cursor = conn.cursor('transwarp_cursor_%d' % next(_cursor_ids),
+                                     withhold=_db_ctx.transactions == 0)
+                cursor.itersize = batch_size
+            else:
+                # the rows of the other backends are stepped by fetchmany() in the process.
+                cursor = conn.cursor()
+            if instrumentation is not None:
+                start, wait = time.time(), _db_ctx.connection.wait_time
+                cursor.execute(engine.backend.translate(sql), args)
+                duration = time.time() - start
+            else:
+                cursor.execute(engine.backend.translate(sql), args)
+            make_row = None
+            while True:
+                if instrumentation is not None:
+                    start = time.time()
+                    rows = cursor.fetchmany(batch_size)
+                    duration += time.time() - start
+                else:
+                    rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                if make_row is None:
+                    make_row = (factory or engine.row_factory)([x[0] for x in cursor.description])
+                for values in rows:
+                    yielded += 1
+                    yield make_row(values)
+        finally:
+            if cursor:
+                cursor.close()
+            if duration is not None:
+                # the time of the database only, not of the consumer of the rows.
+                instrumentation.record(sql, args, duration, yielded, _db_ctx.connection.wait_time - wait)
+
+
+@with_connection
+def select_one_as(factory, sql, *args):
+    """
+    Execute select SQL and expected one result made by the row factory.
+    :param factory: function getting the column names and returning the function making the row from values.
+    :param sql: select sql string.
+    :param args: parameters to replace the '%s' in sql string.
+    :return: row or None.
+
+    >>> insert('testuser', id=3100, name='Ann', email='ann3100@test.org', password='pw', last_modified=0.0)
+    1
+    >>> select_one_as(_tuple_row, 'select id, name from testuser where id=%s', 3100)
+    (3100, u'Ann')
+    """
+    return _select(sql, True, factory, *args)
+
+
+@with_connection
+def select_as(factory, sql, *args):
+    """
+    Execute select SQL and return list of the rows made by the row factory.
+    :param factory: function getting the column names and returning the function making the row from values.
+    :param sql: select sql string.
+    :param args: parameters to replace the '%s' in sql string.
+    :return: list of rows.
+
+    >>> select_as(_row_class, 'select id, name from testuser where id=%s', 3000)
+    [Row(id=3000, name=u'Ann')]
+    """
+    return _select(sql, False, factory, *args)
 
 
 @with_connection
@@ -542,6 +2839,58 @@ def update(sql, *args):
     return _update(sql, *args)
 
 
+@with_connection
+def update_returning(sql, *args):
+    """
+    Execute update or insert SQL with returning clause on the primary, such as "insert ... returning id".
+    :return: list of the returned rows.
+
+    >>> update_returning('insert into testuser (id, name, email, password, last_modified) values (%s, %s, %s, %s, %s) '
+    ...                  'on conflict (id) do update set name=excluded.name returning id, name',
+    ...                  3200, 'Ann', 'ann3200@test.org', 'pw', 0.0)[0].name
+    u'Ann'
+    >>> update_returning('insert into testuser (id, name, email, password, last_modified) values (%s, %s, %s, %s, %s) '
+    ...                  'on conflict (id) do nothing returning id', 3200, 'Bob', 'bob3200@test.org', 'pw', 0.0)
+    []
+    >>> r = update('delete from testuser where id=%s', 3200)
+    """
+    global _db_ctx
+    if _instrumentation is not None:
+        start, wait = time.time(), _db_ctx.connection.wait_time
+    conn = _db_ctx.connection.get()
+    result = _fetch(conn, sql, False, args)
+    if _db_ctx.transactions == 0:
+        conn.commit()
+    _db_ctx.written(_written_tables(sql))
+    if _instrumentation is not None:
+        _record(sql, args, start, len(result[1] or ()), wait)
+    return _make_rows(result, False, None) or []
+
+
+@with_connection
+def update_autocommit(sql, *args):
+    """
+    Execute update SQL out of transaction block, such as "create index concurrently" of PostgreSQL.
+
+    >>> update_autocommit('create index testuser_name_idx on testuser (name)')
+    -1
+    >>> 'testuser_name_idx' in get_backend().index_names('testuser')
+    True
+    >>> update_autocommit('drop index testuser_name_idx')
+    -1
+    """
+    if _db_ctx.transactions:
+        raise DBError('Cannot execute out of transaction block in transaction.')
+    conn = _db_ctx.connection.get()
+    # the selects before may leave a transaction block open.
+    conn.commit()
+    engine.backend.autocommit(conn.raw, True)
+    try:
+        return _update(sql, *args)
+    finally:
+        engine.backend.autocommit(conn.raw, False)
+
+
 @with_connection
 def insert(table, **kwargs):
     """
@@ -570,10 +2919,213 @@ def insert(table, **kwargs):
     return r
 
 
+def _copy_value(value):
+    """
+    Format value as a field of the text format of COPY.
+    """
+    if value is None:
+        return '\\N'
+    if value is True:
+        return 't'
+    if value is False:
+        return 'f'
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    elif isinstance(value, float):
+        value = repr(value)
+    elif not isinstance(value, str):
+        value = str(value)
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def _insert_values(cursor, table, cols, batch):
+    row_sql = '(%s)' % ','.join(['%s' for _ in range(len(cols))])
+    sql = 'insert into %s (%s) values %s' % (table, ','.join(['"%s"' % col for col in cols]),
+                                             ','.join([row_sql for _ in range(len(batch))]))
+    cursor.execute(sql, [v for row in batch for v in row])
+    return cursor.rowcount
+
+
+def _insert_executemany(cursor, table, cols, batch):
+    sql = 'insert into %s (%s) values (%s)' % (table, ','.join(['"%s"' % col for col in cols]),
+                                               ','.join(['%s' for _ in range(len(cols))]))
+    cursor.executemany(engine.backend.translate(sql), batch)
+    return len(batch)
+
+
+def _insert_copy(cursor, table, cols, batch):
+    from cStringIO import StringIO
+    buf = StringIO()
+    for row in batch:
+        buf.write('\t'.join([_copy_value(v) for v in row]))
+        buf.write('\n')
+    buf.seek(0)
+    cursor.copy_expert('copy %s (%s) from stdin' % (table, ','.join(['"%s"' % col for col in cols])), buf)
+    return len(batch)
+
+
+@with_connection
+def insert_many(table, rows, batch_size=500, method='values'):
+    r"""
+    Execute insert SQL for many rows in batches.
+
+    All the rows are committed once at the end when not in a transaction.
+    :param table: the table name.
+    :param rows: iterable of dict of data to be inserted, every dict should have the same keys.
+    :param batch_size: numbers of rows sent per round trip.
+    :param method: 'values' to send multi-row VALUES statements, 'copy' to send by COPY FROM STDIN.
+    The backend without the method executes the insert SQL for every row by executemany().
+    :return: int number of inserted rows.
+
+    >>> u1 = dict(id=3000, name='Ann', email='ann@test.org', password='pw', last_modified=time.time())
+    >>> u2 = dict(id=3001, name='Ben', email='ben@test.org', password='pw', last_modified=time.time())
+    >>> u3 = dict(id=3002, name='Cat', email='cat@test.org', password='pw', last_modified=time.time())
+    >>> insert_many('testuser', [u1, u2, u3], batch_size=2)
+    3
+    >>> u4 = dict(id=3003, name='Dan\tDee', email='dan@test.org', password=None, last_modified=time.time())
+    >>> insert_many('testuser', [u4], method='copy')
+    1
+    >>> select_one('select * from testuser where id=%s', 3003).name
+    u'Dan\tDee'
+    >>> insert_many('testuser', [])
+    0
+    """
+    if method not in ('values', 'copy'):
+        raise ValueError('Invalid insert method: %s' % method)
+    if method == 'copy' and engine.backend.copy:
+        send = _insert_copy
+    elif method == 'values' and engine.backend.multirow_values:
+        send = _insert_values
+    else:
+        send = _insert_executemany
+    global _db_ctx
+    cols = None
+    count = 0
+    cursor = None
+    if _instrumentation is not None:
+        start, wait = time.time(), _db_ctx.connection.wait_time
+    try:
+        batch = list()
+        for row in rows:
+            if cols is None:
+                cols = tuple(row.iterkeys())
+                conn = _db_ctx.connection.get()
+                cursor = conn.cursor()
+            elif len(row) != len(cols):
+                raise DBError('Expect the same columns in all rows.')
+            batch.append(tuple([row[col] for col in cols]))
+            if len(batch) >= batch_size:
+                count += send(cursor, table, cols, batch)
+                batch = list()
+        if batch:
+            count += send(cursor, table, cols, batch)
+        if cursor and _db_ctx.transactions == 0:
+            conn.commit()
+        if cursor:
+            _db_ctx.written((table.strip('"').lower(),))
+        if _instrumentation is not None:
+            _record('insert many into %s by %s' % (table, method), (), start, count, wait)
+        return count
+    finally:
+        if cursor:
+            cursor.close()
+
+
+def _flush_batch(queue):
+    """
+    Send the queued sql of a batch as one statement and resolve the Deferred results.
+    :param queue: list of tuple (kind, sql, args, Deferred object).
+    """
+    global _db_ctx
+    if not engine.backend.json_batch:
+        return _flush_sequential(queue)
+    ctes = list()
+    cols = list()
+    cte_args = list()
+    col_args = list()
+    written = list()
+    for i, (kind, sql, args, d) in enumerate(queue):
+        if kind == 'update':
+            if not _RE_RETURNING.search(sql):
+                sql = '%s returning 1' % sql
+            ctes.append('batch_q%d as (%s)' % (i, sql))
+            cols.append('(select count(*) from batch_q%d)' % i)
+            cte_args.extend(args)
+            written.append(_written_tables(sql))
+        elif kind == 'select_int':
+            cols.append('(%s)' % sql)
+            col_args.extend(args)
+        else:
+            if kind == 'select_one':
+                sql = 'select * from (%s) batch_q%d limit 1' % (sql, i)
+            cols.append("(select coalesce(json_agg(batch_t), '[]')::text from (%s) batch_t)" % sql)
+            col_args.extend(args)
+    sql = 'select %s' % ', '.join(cols)
+    if ctes:
+        sql = 'with %s %s' % (', '.join(ctes), sql)
+    args = tuple(cte_args + col_args)
+    if _instrumentation is not None:
+        start, wait = time.time(), _db_ctx.connection.wait_time
+    conn = None
+    if not ctes and _db_ctx.is_read_routable():
+        conn = _db_ctx.connection.get_replica()
+    if conn is None:
+        conn = _db_ctx.connection.get()
+    cursor = None
+    try:
+        cursor = conn.cursor()
+        _execute(conn, cursor, sql, args)
+        values = cursor.fetchone()
+        if ctes and _db_ctx.transactions == 0:
+            conn.commit()
+    finally:
+        if cursor:
+            cursor.close()
+    for tables in written:
+        _db_ctx.written(tables)
+    if _instrumentation is not None:
+        _record(sql, args, start, len(queue), wait)
+    for (kind, sql, args, d), value in zip(queue, values):
+        if kind in ('select', 'select_one'):
+            value = _json_rows(value)
+            if kind == 'select_one':
+                value = value[0] if value else None
+        d.resolve(value)
+
+
+def _flush_sequential(queue):
+    """
+    Execute the queued sql of a batch one by one, for the backends without json_agg.
+    """
+    for kind, sql, args, d in queue:
+        if kind == 'update':
+            d.resolve(_update(sql, *args))
+        elif kind == 'select_int':
+            d.resolve(_select(sql, True, _tuple_row, *args)[0])
+        else:
+            d.resolve(_select(sql, kind == 'select_one', None, *args))
+
+
+def _json_rows(text):
+    """
+    Make the rows of the json aggregated by a batch.
+    """
+    objects = json.loads(text, object_pairs_hook=collections.OrderedDict)
+    if not objects:
+        return []
+    make_row = engine.row_factory(tuple([k.encode('utf-8') for k in objects[0].iterkeys()]))
+    return [make_row(tuple(o.itervalues())) for o in objects]
+
+
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)
-    # TODO: should be modified to your own test database
-    create_engine('test_user', 'test_pw', 'test_db')
+    # TODO: should be modified to your own test database, or run with --sqlite in memory
+    if '--sqlite' in sys.argv:
+        create_engine(backend='sqlite')
+    else:
+        create_engine('test_user', 'test_pw', 'test_db')
+    if '--sqlite' not in sys.argv:
+        update('create sequence if not exists id_node_seq')
     update('drop table if exists testuser')
     update('create table testuser (id int primary key, name text, email text, password text, last_modified real)')
     # delete the test data if needed
@@ -6,22 +6,70 @@ __author__ = 'guti'
 Database object relation mapping module.
 '''
 
+import os
+import re
+import sys
+import json
 import time
+import base64
+import functools
+import numbers
+import traceback
+import collections
 import logging
+import weakref
+import threading
+import itertools
 import db
+import aio
 
 
 _triggers = frozenset(['pre_insert', 'pre_update', 'pre_delete'])
 
+# a compiled regular expression for the where clause of count_by() kept in the count cache,
+# such as "where b_id=%s and u_id=%s".
+_RE_COUNT_WHERE = re.compile(r'^\s*where\s+(\w+\s*=\s*%s(?:\s+and\s+\w+\s*=\s*%s)*)\s*$', re.IGNORECASE)
+_RE_COUNT_AND = re.compile(r'\s+and\s+', re.IGNORECASE)
 
-def _gen_sql(table_name, mapping):
+# count cache of the models set __count_cache__, None if not enabled
+_count_cache = None
+
+# max numbers of objects sharing a lazy load, see _LoadGroup.
+_LOAD_GROUP_SIZE = 500
+
+# max numbers of primary keys in one query of get_many()
+_GET_MANY_SIZE = 1000
+
+# limit of the query with an offset but no limit
+_NO_LIMIT = 2 ** 63 - 1
+
+# marker of the related objects not loaded yet, see _Relation
+_NOT_LOADED = object()
+
+# a compiled regular expression for the where clause of find_first() by primary key, such as "u_id=%s".
+_RE_PK_WHERE = re.compile(r'^\s*(\w+)\s*=\s*%s\s*$')
+
+
+class ConflictError(db.DBError):
+    """
+    Conflict error of update
+
+    Raised by update() of the model with VersionField when the row was updated by others since loaded.
+    """
+    pass
+
+
+def _gen_sql(table_name, mapping, backend=None, indexes=()):
     """
     Generate the sql string of database operations.
 
     :param table_name: name of table in database.
     :param mapping: dict, key is the name of Field object, value is the Filed object.
+    :param backend: name of the backend, default is the backend of the engine.
+    :param indexes: list of Index objects of the table.
     :return: sql string
     """
+    backend = db.get_backend(backend)
     pk = None
     sql = ['-- generating SQL for %s:' % table_name, 'create table %s (' % table_name]
     for f in sorted(mapping.values(), lambda x, y: cmp(x.order, y.order)):
@@ -29,12 +77,686 @@ def _gen_sql(table_name, mapping):
             raise StandardError('No ddl in field %s.' % f)
         if f.primary_key:
             pk = f.name
-        sql.append(('%s %s,' if f.nullable else ' %s %s not null,') % (f.name, f.ddl))
+        sql.append(('%s %s,' if f.nullable else ' %s %s not null,') % (f.name, backend.ddl(f.ddl)))
     sql.append(' primary key(%s)' % pk)
     sql.append(');')
+    sql.extend(index.sql(table_name) + ';' for index in indexes)
     return '\n'.join(sql)
 
 
+def _gen_update_sql(table_name, pk, columns, version=None):
+    """
+    Generate the update statement of the columns by primary key.
+    The version column, if any, is increased and checked in the where clause.
+
+    >>> _gen_update_sql('t', 'id', ['name'], 'version')
+    'update t set name=%s,version=version+1 where id=%s and version=%s'
+    """
+    sets = ['%s=%%s' % c for c in columns]
+    where = '%s=%%s' % pk
+    if version is not None:
+        sets.append('%s=%s+1' % (version, version))
+        where = '%s and %s=%%s' % (where, version)
+    return 'update %s set %s where %s' % (table_name, ','.join(sets), where)
+
+
+def _gen_statements(table_name, pk, columns, insert_columns, update_columns, version=None):
+    """
+    Generate the statements of the model operations, made once per model by the metaclass.
+
+    :param table_name: name of table in database.
+    :param pk: name of the primary key.
+    :param columns: columns selected by default.
+    :param insert_columns: list of the insertable columns.
+    :param update_columns: list of the updatable columns.
+    :param version: name of the version column, see VersionField.
+    :return: dict of the statements.
+
+    >>> s = _gen_statements('t', 'id', '*', ['id', 'name'], ['name'])
+    >>> s['insert'], s['update'], s['count']
+    ('insert into t ("id","name") values (%s,%s)', 'update t set name=%s where id=%s', 'select count(id) from t ')
+    """
+    return dict(
+        select='select %s from %s' % (columns, table_name),
+        exists='select 1 from %s' % table_name,
+        get='select %s from %s where %s=%%s' % (columns, table_name, pk),
+        count='select count(%s) from %s ' % (pk, table_name),
+        delete='delete from %s where %s=%%s' % (table_name, pk),
+        insert='insert into %s (%s) values (%s)' % (table_name, ','.join('"%s"' % c for c in insert_columns),
+                                                    ','.join(['%s'] * len(insert_columns))),
+        update=_gen_update_sql(table_name, pk, update_columns, version),
+    )
+
+
+def _same_kind(a, b):
+    return isinstance(a, basestring) and isinstance(b, basestring) or \
+        isinstance(a, numbers.Number) and isinstance(b, numbers.Number)
+
+
+class _CountCache(object):
+    """
+    Counters of count_all() and the simple predicates of count_by()
+
+    A counter is kept per table, predicate columns and arguments, e.g. ('comments', ('b_id',), (1,)).
+    The inserts and deletes of the models out of transaction move the matching counters by one,
+    any other write of the table drops its counters. The counters expire after ttl seconds,
+    since the writes of the other processes are not seen.
+    """
+    def __init__(self, max_entries=10000, ttl=60.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.moves = 0
+        self._lock = threading.Lock()
+        # key -> [count, expire time]
+        self._entries = dict()
+        # table -> set of keys
+        self._tables = dict()
+
+    @staticmethod
+    def key(table, where, args):
+        """
+        Get the key of the where clause, None if it can not be counted by the cache.
+
+        >>> _CountCache.key('comments', 'where u_id=%s and b_id = %s', (2, 1))
+        ('comments', ('b_id', 'u_id'), (1, 2))
+        >>> _CountCache.key('comments', 'where b_id>%s', (1,)) is None
+        True
+        """
+        if not where:
+            return table, (), ()
+        m = _RE_COUNT_WHERE.match(where)
+        if m is None:
+            return None
+        cols = [c.split('=')[0].strip().lower() for c in _RE_COUNT_AND.split(m.group(1))]
+        if len(cols) != len(args) or len(set(cols)) != len(cols):
+            return None
+        pairs = sorted(zip(cols, args))
+        return table, tuple(c for c, _ in pairs), tuple(a for _, a in pairs)
+
+    def get(self, key):
+        with self._lock:
+            e = self._entries.get(key)
+            if e is not None and e[1] > time.time():
+                self.hits += 1
+                return e[0]
+            self.misses += 1
+            return None
+
+    def put(self, key, count):
+        with self._lock:
+            if key not in self._entries and len(self._entries) >= self.max_entries:
+                self._drop(None)
+            self._entries[key] = [count, time.time() + self.ttl]
+            self._tables.setdefault(key[0], set()).add(key)
+
+    def move(self, table, instance, delta):
+        """
+        Move the counters of the table matching the object by delta.
+        """
+        # Model.get() is the query by primary key
+        get = dict.get if isinstance(instance, dict) else instance._get_value
+        with self._lock:
+            for key in list(self._tables.get(table, ())):
+                matched = True
+                for col, arg in zip(key[1], key[2]):
+                    value = get(instance, col)
+                    if value != arg:
+                        if not _same_kind(value, arg):
+                            # such as '1' and 1, the database may match them.
+                            self._discard(key)
+                        matched = False
+                        break
+                if matched:
+                    self._entries[key][0] += delta
+                    self.moves += 1
+
+    def drop(self, table, columns=None):
+        """
+        Drop the counters of the table, or only the counters of the predicates on any of the columns.
+        """
+        with self._lock:
+            for key in list(self._tables.get(table, ())):
+                if columns is None or columns.intersection(key[1]):
+                    self._discard(key)
+
+    def written(self, tables):
+        """
+        Write listener, see db.add_write_listener().
+        """
+        # the model writes move the counters instead of dropping them
+        if _orm_ctx.model_writes > 0 and not db.in_transaction():
+            return
+        with self._lock:
+            if tables is None:
+                self._drop(None)
+            else:
+                for table in tables:
+                    self._drop(table)
+
+    def stats(self):
+        with self._lock:
+            return db.Dict(entries=len(self._entries), hits=self.hits, misses=self.misses, moves=self.moves)
+
+    def _discard(self, key):
+        del self._entries[key]
+        keys = self._tables[key[0]]
+        keys.discard(key)
+        if not keys:
+            del self._tables[key[0]]
+
+    def _drop(self, table):
+        if table is None:
+            self._entries.clear()
+            self._tables.clear()
+        else:
+            for key in self._tables.pop(table, ()):
+                del self._entries[key]
+
+
+def enable_count_cache(max_entries=10000, ttl=60.0):
+    """
+    Enable the count cache of count_all() and count_by() of the models set __count_cache__.
+    :param max_entries: max numbers of counters.
+    :param ttl: seconds the counter is kept.
+
+    >>> class TestCount(Model):
+    ...     __table__ = 'testuser'
+    ...     __count_cache__ = True
+    ...     id = IntegerField(primary_key=True)
+    ...     name = StringField()
+    ...     email = StringField(updatable=False)
+    ...     password = StringField()
+    ...     last_modified = FloatField()
+    >>> enable_count_cache()
+    >>> TestCount(id=10300, name='Count', email='count@db.org').insert().count_by('where email=%s', 'count@db.org')
+    1
+    >>> r = TestCount(id=10301, name='Count', email='count@db.org').insert()
+    >>> TestCount.count_by('where email=%s', 'count@db.org'), count_cache_stats().hits
+    (2, 1)
+    >>> r = db.update('delete from testuser where id=%s', 10301)
+    >>> TestCount.count_by('where email=%s', 'count@db.org'), count_cache_stats().misses
+    (1, 2)
+    >>> r = TestCount.get(10300).delete()
+    >>> TestCount.count_by('where email=%s', 'count@db.org')
+    0
+    >>> disable_count_cache()
+    """
+    global _count_cache
+    disable_count_cache()
+    _count_cache = _CountCache(max_entries, ttl)
+    db.add_write_listener(_count_cache.written)
+
+
+def disable_count_cache():
+    global _count_cache
+    if _count_cache is not None:
+        db.remove_write_listener(_count_cache.written)
+    _count_cache = None
+
+
+def count_cache_stats():
+    """
+    Get the statistics of the count cache.
+    :return: Dict object with entries, hits, misses and moves.
+    """
+    if _count_cache is None:
+        raise db.DBError('Count cache is not enabled.')
+    return _count_cache.stats()
+
+
+class _OrmContext(threading.local):
+    """
+    Thread local object of orm context
+    """
+    def __init__(self):
+        super(_OrmContext, self).__init__()
+        # numbers of the model writes in progress
+        self.model_writes = 0
+        # identity map, class -> dict of primary key -> object, None if not in identity_map() context
+        self.identities = None
+        # numbers of the nested identity_map() contexts
+        self.identity_depth = 0
+        # _NPlusOneContext object of detect_n_plus_one() context, None if not in the context
+        self.n_plus_one = None
+
+    def identities_of(self, cls):
+        """
+        Get the identity map of the class, None if not in identity_map() context.
+        """
+        if self.identities is None:
+            return None
+        m = self.identities.get(cls)
+        if m is None:
+            m = self.identities[cls] = dict()
+        return m
+
+    def written(self, tables):
+        """
+        Write listener, see db.add_write_listener(). The objects of the tables are dropped by other writes.
+        """
+        if self.identities is None or self.model_writes > 0:
+            return
+        if tables is None:
+            self.identities.clear()
+        else:
+            for cls in [cls for cls in self.identities if cls.__table__ in tables]:
+                del self.identities[cls]
+
+
+class _IdentityMapContext(object):
+    """
+    _IdentityMapContext object keeps one object per row in the context, see identity_map().
+    """
+    def __enter__(self):
+        if _orm_ctx.identity_depth == 0:
+            _orm_ctx.identities = dict()
+        _orm_ctx.identity_depth += 1
+        return self
+
+    def __exit__(self, exctype, excvalue, traceback):
+        _orm_ctx.identity_depth -= 1
+        if _orm_ctx.identity_depth == 0:
+            _orm_ctx.identities = None
+
+
+def identity_map():
+    """
+    Get identity map context object, the rows of the models are loaded once in the context:
+    get() and find_first() by primary key return the object loaded before without query,
+    and the finds return the objects loaded before instead of new ones.
+    The model writes keep the objects in the map, other writes of the tables drop them.
+    :return: _IdentityMapContext object
+
+    >>> class TestIdentity(Model):
+    ...     __table__ = 'testuser'
+    ...     id = IntegerField(primary_key=True)
+    ...     name = StringField()
+    ...     email = StringField()
+    ...     password = StringField()
+    ...     last_modified = FloatField()
+    >>> u = TestIdentity(id=10500, name='Identity').insert()
+    >>> with identity_map():
+    ...     a = TestIdentity.get(10500)
+    ...     a is TestIdentity.find_first('id=%s', 10500), a is TestIdentity.find_by('where name=%s', 'Identity')[0]
+    ...     r = db.update('update testuser set name=%s where id=%s', 'Changed', 10500)
+    ...     a is TestIdentity.get(10500), TestIdentity.get(10500).name
+    (True, True)
+    (False, u'Changed')
+    >>> TestIdentity.get(10500) is TestIdentity.get(10500)
+    False
+    >>> r = u.delete()
+    """
+    return _IdentityMapContext()
+
+
+class _NPlusOneContext(object):
+    """
+    _NPlusOneContext object counts the statements by fingerprint in the context, see detect_n_plus_one().
+    """
+    def __init__(self, threshold):
+        self.threshold = threshold
+        # fingerprint -> numbers of executions
+        self.counts = collections.defaultdict(int)
+        # list of Dict objects with fingerprint, count and site
+        self.reports = list()
+        self._outer = None
+
+    def __enter__(self):
+        _install_n_plus_one_listener()
+        self._outer = _orm_ctx.n_plus_one
+        _orm_ctx.n_plus_one = self
+        return self
+
+    def __exit__(self, exctype, excvalue, traceback):
+        _orm_ctx.n_plus_one = self._outer
+        self._outer = None
+
+    def count(self, fp):
+        self.counts[fp] += 1
+        if self.counts[fp] == self.threshold + 1:
+            site = _call_site()
+            self.reports.append(db.Dict(fingerprint=fp, count=self.counts[fp], site=site))
+            logging.warning('[N+1 QUERY] more than %d times in the context, SQL: %s, at %s:%d in %s',
+                            self.threshold, fp, *site)
+
+
+def _call_site():
+    """
+    Get the innermost frame out of the transwarp package: (file, line, function).
+    """
+    for filename, line, func, _ in reversed(traceback.extract_stack()):
+        if filename.startswith('<') or os.path.dirname(os.path.abspath(filename)) != _PACKAGE_DIR:
+            return filename, line, func
+    return '?', 0, '?'
+
+
+def _on_query(event):
+    ctx = _orm_ctx.n_plus_one
+    if ctx is not None:
+        ctx.count(event.fingerprint)
+
+
+def _install_n_plus_one_listener():
+    global _n_plus_one_installed
+    if not _n_plus_one_installed:
+        db.add_query_listener(_on_query)
+        _n_plus_one_installed = True
+
+
+def detect_n_plus_one(threshold=10):
+    """
+    Get N+1 detector context object, for debugging. The statements of the same fingerprint executed more than
+    threshold times in the context are logged with the call site, usually a get() in a loop to be replaced by
+    get_many(). The query instrumentation is enabled, and the queries not sampled are not counted.
+    :param threshold: max numbers of executions of a statement.
+    :return: _NPlusOneContext object, its reports is the list of Dict objects with fingerprint, count and site.
+
+    >>> with detect_n_plus_one(threshold=2) as detector:
+    ...     for i in range(5):
+    ...         r = db.select('select * from testuser where id=%s', i)
+    >>> [(r.count, r.site[2]) for r in detector.reports]
+    [(3, '<module>')]
+    """
+    return _NPlusOneContext(threshold)
+
+
+def _encode_cursor(values):
+    """
+    Encode the values of the order columns to an opaque page cursor.
+
+    >>> _decode_cursor(_encode_cursor([1475398134.988, 232061340174585856, u'a']), 3)
+    [1475398134.988, 232061340174585856, u'a']
+    """
+    return base64.urlsafe_b64encode(json.dumps(values, separators=(',', ':'))).rstrip('=')
+
+
+def _decode_cursor(cursor, n):
+    """
+    Decode the page cursor to the values of n order columns.
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(str(cursor) + '=' * (-len(cursor) % 4)))
+    except (TypeError, ValueError):
+        raise ValueError('Invalid cursor: %s' % cursor)
+    if not isinstance(values, list) or len(values) != n:
+        raise ValueError('Invalid cursor: %s' % cursor)
+    return values
+
+
+class Page(object):
+    """
+    A page of objects found by Model.page()
+
+    The cursors next and prev are opaque strings to get the page after or before, None if there is no more pages.
+    """
+    def __init__(self, items, next=None, prev=None):
+        self.items = items
+        self.next = next
+        self.prev = prev
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        return iter(self.items)
+
+
+class Query(object):
+    """
+    Lazy query of the objects of a model, made by Model.query()
+
+    The methods return new Query objects, so a query can be shared and extended. The select is executed
+    on iteration, len() or indexing, and the result is kept in the query. count(), exists() and first()
+    execute their own statements without fetching the objects.
+
+    >>> class TestQuery(Model):
+    ...     __table__ = 'testuser'
+    ...     id = IntegerField(primary_key=True)
+    ...     name = StringField()
+    ...     email = StringField()
+    ...     password = StringField()
+    ...     last_modified = FloatField()
+    >>> TestQuery.insert_all([TestQuery(id=10900 + i, name='Query', last_modified=float(i % 3)) for i in range(6)])
+    6
+    >>> q = TestQuery.query().filter(name='Query').order_by('-last_modified', 'id')
+    >>> q.filter('last_modified<%s', 2).count(), q.count(), q.limit(4).count(), q.exists()
+    (4, 6, 4, True)
+    >>> [u.id for u in q.limit(3)], [u.id for u in q[1:3]], q[0].id, q.first().id
+    ([10902, 10905, 10901], [10905, 10901], 10902, 10902)
+    >>> q.filter(id=[10900, 10903]).only('name').first().keys()
+    ['id', 'name']
+    >>> q.filter(name='Nobody').exists(), q.filter(name='Nobody').first()
+    (False, None)
+    >>> r = db.update('delete from testuser where name=%s', 'Query')
+    """
+    def __init__(self, cls):
+        self.cls = cls
+        # conditions joined by and, and their parameters
+        self._conditions = ()
+        self._args = ()
+        self._order = ()
+        self._limit = None
+        self._offset = None
+        self._fields = None
+        self._prefetch = None
+        # the objects selected, None before executed
+        self._result = None
+
+    def _clone(self, **changes):
+        q = Query(self.cls)
+        q.__dict__.update(self.__dict__)
+        q._result = None
+        for k, v in changes.iteritems():
+            setattr(q, '_' + k, v)
+        return q
+
+    def filter(self, where=None, *args, **kwargs):
+        """
+        Add the conditions to the query.
+        :param where: condition like "created_at>%s", with the parameters in args.
+        :param kwargs: the fields equal to the values, or any of the values if the value is list or tuple.
+        :return: Query object.
+        """
+        conditions, params = list(self._conditions), list(self._args)
+        if where:
+            conditions.append('(%s)' % where)
+            params.extend(args)
+        for k in sorted(kwargs):
+            if k not in self.cls.__mappings__:
+                raise ValueError('Invalid field: %s' % k)
+            v = kwargs[k]
+            if v is None:
+                conditions.append('%s is null' % k)
+            elif isinstance(v, (list, tuple)):
+                condition, values = db.get_backend().any(k, v)
+                conditions.append(condition)
+                params.extend(values)
+            else:
+                conditions.append('%s=%%s' % k)
+                params.append(v)
+        return self._clone(conditions=tuple(conditions), args=tuple(params))
+
+    def order_by(self, *fields):
+        """
+        Order by the fields, the field with '-' prefix in descending order, e.g. order_by('-created_at').
+        :return: Query object.
+        """
+        order = list()
+        for f in fields:
+            name = f.lstrip('-')
+            if name not in self.cls.__mappings__:
+                raise ValueError('Invalid field: %s' % name)
+            order.append('%s desc' % name if f.startswith('-') else name)
+        return self._clone(order=tuple(order))
+
+    def limit(self, n):
+        return self._clone(limit=int(n))
+
+    def offset(self, n):
+        return self._clone(offset=int(n))
+
+    def only(self, *fields):
+        """
+        Select only the fields, the others are loaded on the first access, see Model.get().
+        """
+        self.cls._columns(fields)
+        return self._clone(fields=fields)
+
+    def prefetch(self, *paths):
+        """
+        Load the relations of the objects, see Model.get().
+        """
+        return self._clone(prefetch=paths)
+
+    def _where(self):
+        return 'where %s' % ' and '.join(self._conditions) if self._conditions else ''
+
+    def _tail(self):
+        sql = list()
+        self._order and sql.append('order by %s' % ','.join(self._order))
+        if self._limit is not None or self._offset:
+            # sqlite needs a limit before the offset.
+            sql.append('limit %d' % (self._limit if self._limit is not None else _NO_LIMIT))
+            self._offset and sql.append('offset %d' % self._offset)
+        return ' '.join(sql)
+
+    def _sql(self, select=None):
+        """
+        Get the select statement of the query.
+        :param select: the statement of "select ... from table", default is the select of the fields.
+        """
+        if select is None:
+            if self._fields is None:
+                select = self.cls.__statements__['select']
+            else:
+                select = 'select %s from %s' % (self.cls._columns(self._fields), self.cls.__table__)
+        return ' '.join(s for s in (select, self._where(), self._tail()) if s)
+
+    def all(self):
+        """
+        Execute the query.
+        :return: list of objects.
+        """
+        if self._result is None:
+            cls = self.cls
+            self._result = cls._prefetch(cls._identities(cls._select(False, self._sql(), *self._args)),
+                                         self._prefetch)
+        return self._result
+
+    def first(self):
+        """
+        Get the first object by "limit 1".
+        :return: object or None.
+        """
+        if self._result is not None:
+            return self._result[0] if self._result else None
+        cls = self.cls
+        return cls._prefetch(cls._identities(cls._select(True, self._clone(limit=1)._sql(), *self._args)),
+                             self._prefetch)
+
+    def count(self):
+        """
+        Count the objects by "select count(pk)", kept by the count cache as count_by() if the model set it.
+        :return: int.
+        """
+        if self._result is not None:
+            return len(self._result)
+        if self._limit is None and not self._offset:
+            return int(self.cls._count(self._where(), *self._args))
+        return int(self.cls._select_int('select count(*) from (%s) q' % self._sql(self.cls.__statements__['exists']),
+                                        *self._args))
+
+    def exists(self):
+        """
+        Check any object matches by "select 1 ... limit 1".
+        :return: bool.
+        """
+        if self._result is not None:
+            return len(self._result) > 0
+        sql = self._clone(limit=1, order=())._sql(self.cls.__statements__['exists'])
+        return bool(self.cls._select_int('select exists(%s)' % sql, *self._args))
+
+    def __iter__(self):
+        return iter(self.all())
+
+    def __len__(self):
+        return len(self.all())
+
+    def __nonzero__(self):
+        return len(self.all()) > 0
+
+    def __getitem__(self, index):
+        """
+        Select the objects of the slice by limit and offset, or the object of the index.
+        """
+        if self._result is not None:
+            return self._result[index]
+        if isinstance(index, slice):
+            if index.step is not None or (index.start or 0) < 0 or (index.stop or 0) < 0:
+                raise ValueError('Invalid slice of query: %s' % index)
+            start = index.start or 0
+            q = self._clone(offset=(self._offset or 0) + start)
+            if index.stop is not None:
+                q = q._clone(limit=max(index.stop - start, 0))
+            return q.all()
+        if index < 0:
+            raise IndexError('Negative index of query: %s' % index)
+        r = self._clone(offset=(self._offset or 0) + index, limit=1).all()
+        if not r:
+            raise IndexError('Query index out of range: %s' % index)
+        return r[0]
+
+
+class _LoadGroup(object):
+    """
+    Objects selected together without some fields
+
+    The first access of a missing field of any object loads the field of all objects in the group by one select.
+    """
+    def __init__(self, cls):
+        self.cls = cls
+        # weak references, the group lives no longer than its objects need it
+        self._refs = list()
+
+    def add(self, instance):
+        self._refs.append(weakref.ref(instance))
+        instance._set_state('_load_group', self)
+
+    def is_full(self):
+        return len(self._refs) >= _LOAD_GROUP_SIZE
+
+    def load(self, name):
+        """
+        Load the field of the objects missing it.
+        """
+        cls = self.cls
+        pk = cls.__primary_key__.name
+        missing = dict()
+        for ref in self._refs:
+            instance = ref()
+            if instance is not None and name not in instance:
+                missing[instance[pk]] = instance
+        if not missing:
+            return
+        condition, args = db.get_backend().any(pk, missing.keys())
+        sql = 'select %s from %s where %s' % (cls._columns((name,)), cls.__table__, condition)
+        for loaded in cls._select(False, sql, *args):
+            missing[loaded[pk]]._set_value(name, loaded[name])
+
+
+# thread local orm context
+_orm_ctx = _OrmContext()
+db.add_write_listener(_orm_ctx.written)
+
+# the query listener of detect_n_plus_one() is added to db once
+_n_plus_one_installed = False
+
+# directory of the transwarp package, the call sites are out of it
+_PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
 class ModelMetaClass(type):
     """
     MetaClass for Model.
@@ -44,23 +766,29 @@ class ModelMetaClass(type):
     Set some attributes to the Model class dynamically.
     """
     def __new__(mcs, name, bases, attrs):
-        # skip base Model class:
-        if name == 'Model':
+        # skip base Model classes:
+        if name in ('_ModelBase', 'Model', 'LeanModel'):
             return type.__new__(mcs, name, bases, attrs)
 
-        # store subclasses information.
+        # store subclasses information, name -> class.
         if not hasattr(mcs, 'subclasses'):
             mcs.subclasses = dict()
-        if name not in mcs.subclasses:
-            mcs.subclasses[name] = name
-        else:
+        if name in mcs.subclasses:
             logging.warning('Redefine class: %s' % name)
         # move the Filed object attributes to mapping.
         # record, check and modify the primary key.
         logging.info('Scan ORM %s...' % name)
         mapping = dict()
         primary_key = None
+        version = None
+        deferred = list()
+        relations = dict()
+        indexes = list()
         for k, v in attrs.items():
+            if isinstance(v, _Relation):
+                v.name = k
+                v.slot = '_related_%s' % k
+                relations[k] = v
             if isinstance(v, Field):
                 if not v.name:
                     v.name = k
@@ -77,6 +805,14 @@ class ModelMetaClass(type):
                         logging.warning('Change primary key to non-nullable.')
                         v.nullable = False
                     primary_key = v
+                if isinstance(v, VersionField):
+                    if version:
+                        raise TypeError('Cannot define more than 1 version field in class: %s' % name)
+                    version = k
+                if v.deferred:
+                    deferred.append(k)
+                if v.unique or v.index:
+                    indexes.append(Index(v.name, unique=v.unique))
                 mapping[k] = v
         # check exist of primary key.
         if not primary_key:
@@ -89,15 +825,678 @@ class ModelMetaClass(type):
             attrs['__table__'] = name.lower()
         attrs['__mappings__'] = mapping
         attrs['__primary_key__'] = primary_key
-        attrs['__sql__'] = lambda self: _gen_sql(attrs['__table__'], mapping)
+        # the columns selected by default, without the deferred fields.
+        attrs['__columns__'] = ','.join(f.name for f in sorted(mapping.values(), key=lambda f: f.order)
+                                        if not f.deferred) if deferred else '*'
+        # the indexes of the fields, then the composite or partial indexes of the class.
+        indexes.sort(key=lambda index: mapping[index.columns[0]].order)
+        indexes.extend(attrs.get('__indexes__', ()))
+        for index in indexes:
+            index.name = index.name or index.default_name(attrs['__table__'])
+        attrs['__indexes__'] = tuple(indexes)
+        attrs['__sql__'] = lambda self, backend=None, with_indexes=True: _gen_sql(
+            attrs['__table__'], mapping, backend, indexes if with_indexes else ())
+        attrs['__relations__'] = relations
+        # the plans of insert() and update(): the fields in order with their defaults,
+        # (name, default, True if the default is a function).
+        fields = sorted(mapping.items(), key=lambda (k, v): v.order)
+        if any(issubclass(b, LeanModel) for b in bases):
+            # the names of the fields in order, then the slots keeping the related objects, see _Relation.
+            attrs['__fields__'] = tuple(k for k, v in fields)
+            attrs['__slots__'] = attrs['__fields__'] + tuple(sorted(r.slot for r in relations.values()))
+        attrs['__insert_fields__'] = tuple((k, v._default, callable(v._default)) for k, v in fields if v.insertable)
+        attrs['__update_fields__'] = tuple((k, v._default, callable(v._default)) for k, v in fields if v.updatable)
+        attrs['__statements__'] = _gen_statements(attrs['__table__'], primary_key.name, attrs['__columns__'],
+                                                  [v.name for k, v in fields if v.insertable],
+                                                  [k for k, v in fields if v.updatable], version)
+        attrs['__version__'] = version
+        # the statements of update() by the changed columns, key is the tuple of the columns.
+        attrs['__update_statements__'] = dict()
+        # the statements of upsert(), key is the tuple of the conflict and update columns.
+        attrs['__upsert_statements__'] = dict()
         # set pre-operation function attributes if they are exist.
         for trigger in _triggers:
             if trigger not in attrs:
                 attrs[trigger] = None
-        return type.__new__(mcs, name, bases, attrs)
+        cls = type.__new__(mcs, name, bases, attrs)
+        mcs.subclasses[name] = cls
+        return cls
+
+
+class _ModelBase(object):
+    """
+    Base of Model and LeanModel: the finders and the writes of the objects,
+    over the storage of the fields given by the subclasses.
+    """
+    __metaclass__ = ModelMetaClass
+    # no instance dict, the state of the objects is kept by the subclasses, see _get_state().
+    __slots__ = ()
+    # set True in the subclass to answer the reads by the query cache, see db.enable_query_cache().
+    __cache__ = False
+    # set True in the subclass to answer the counts by the count cache, see enable_count_cache().
+    __count_cache__ = False
+
+    @classmethod
+    def _update_sql(cls, cols):
+        """
+        Get the statement of update() setting the columns.
+        :param cols: tuple of the columns.
+        """
+        sql = cls.__update_statements__.get(cols)
+        if sql is None:
+            sql = cls.__update_statements__[cols] = _gen_update_sql(cls.__table__, cls.__primary_key__.name, cols,
+                                                                    cls.__version__)
+        return sql
+
+    def _saved(self):
+        """
+        Start tracking the changes again after written.
+        """
+        self._del_state('_changed')
+
+    @classmethod
+    def _row_factory(cls, names):
+        """
+        Row factory building the objects straight from the raw values, see db.select_as().
+        :param names: column names.
+        :return: function making the object from the values tuple.
+        """
+        make_object = cls._object_factory(names)
+        if len(names) >= len(cls.__mappings__) and cls.__mappings__.viewkeys() <= set(names):
+            return make_object
+        # the objects missing some fields load them lazily by groups.
+        groups = [None]
+
+        def make_partial_object(values):
+            instance = make_object(values)
+            if groups[0] is None or groups[0].is_full():
+                groups[0] = _LoadGroup(cls)
+            groups[0].add(instance)
+            return instance
+        return make_partial_object
+
+    @classmethod
+    def _columns(cls, fields):
+        """
+        Get the columns of the select.
+        :param fields: names of the fields, None to select the fields not deferred.
+        The primary key is always selected.
+        """
+        if fields is None:
+            return cls.__columns__
+        pk = cls.__primary_key__.name
+        for f in fields:
+            if f not in cls.__mappings__:
+                raise ValueError('Invalid field: %s' % f)
+        return ','.join([pk] + [f for f in fields if f != pk])
+
+    @classmethod
+    def _select(cls, first, sql, *args):
+        """
+        Select the objects of the class, by the query cache if the class set __cache__.
+        :param first: boolean to check if getting one object or not.
+        """
+        select = db.select_one_as if first else db.select_as
+        if cls.__cache__:
+            with db.cached():
+                return select(cls._row_factory, sql, *args)
+        return select(cls._row_factory, sql, *args)
+
+    @classmethod
+    def _select_int(cls, sql, *args):
+        if cls.__cache__:
+            with db.cached():
+                return db.select_int(sql, *args)
+        return db.select_int(sql, *args)
+
+    @classmethod
+    def _identities(cls, result):
+        """
+        Replace the objects by the ones already in the identity map, and map the others.
+        :param result: object, list of objects or None.
+        """
+        m = _orm_ctx.identities_of(cls)
+        if m is None or result is None:
+            return result
+        pk = cls.__primary_key__.name
+        if isinstance(result, list):
+            return [m.setdefault(o[pk], o) for o in result]
+        return m.setdefault(result[pk], result)
+
+    @classmethod
+    def _count(cls, where, *args):
+        """
+        Count the objects of the class, by the count cache if the class set __count_cache__.
+        :param where: where clause, empty string to count all.
+        """
+        sql = cls.__statements__['count'] + where
+        cache = _count_cache
+        key = cache.key(cls.__table__, where, args) if cache is not None and cls.__count_cache__ else None
+        if key is None:
+            return cls._select_int(sql, *args)
+        n = cache.get(key)
+        if n is None:
+            n = int(cls._select_int(sql, *args))
+            cache.put(key, n)
+        return n
+
+    @classmethod
+    def _write(cls, func, *args):
+        """
+        Make the write of the objects by func, the count cache is updated by the objects after.
+        :return: result of func, and the count cache or None if the counters can not be updated by the objects.
+        """
+        _orm_ctx.model_writes += 1
+        try:
+            r = func(*args)
+        finally:
+            _orm_ctx.model_writes -= 1
+        cache = _count_cache
+        return r, cache if cache is not None and cls.__count_cache__ and not db.in_transaction() else None
+
+    @classmethod
+    def _prefetch(cls, result, paths):
+        """
+        Load the relations of the objects, one query per relation.
+        :param result: object, list of objects or None.
+        :param paths: names of relations, the relations of a relation are joined by '.', e.g. 'comments.user'.
+        """
+        if not paths or not result:
+            return result
+        tree = dict()
+        for path in paths:
+            node = tree
+            for name in path.split('.'):
+                node = node.setdefault(name, dict())
+        cls._prefetch_tree(result if isinstance(result, list) else [result], tree)
+        return result
+
+    @classmethod
+    def _prefetch_tree(cls, instances, tree):
+        for name, children in tree.iteritems():
+            relation = cls.__relations__.get(name)
+            if relation is None:
+                raise ValueError('Invalid relation: %s' % name)
+            related = relation.prefetch(instances)
+            if children and related:
+                relation.model._prefetch_tree(related, children)
+
+    @classmethod
+    def get(cls, pk, fields=None, prefetch=None):
+        """
+        Get by primary key
+        :param pk: primary key.
+        :param fields: names of the fields to select, default is the fields not deferred.
+        The other fields are loaded on the first access.
+        :param prefetch: names of the relations to load, e.g. ('comments', 'comments.user').
+        :return: Model object or None
+        """
+        m = _orm_ctx.identities_of(cls)
+        if m is not None and pk in m:
+            return cls._prefetch(m[pk], prefetch)
+        if fields is None:
+            sql = cls.__statements__['get']
+        else:
+            sql = 'select %s from %s where %s=%%s' % (cls._columns(fields), cls.__table__, cls.__primary_key__.name)
+        return cls._prefetch(cls._identities(cls._select(True, sql, pk)), prefetch)
+
+    @classmethod
+    def get_many(cls, pks, fields=None, prefetch=None):
+        """
+        Get by primary keys in one query.
+        :param pks: list of primary keys.
+        :param fields: names of the fields to select, see get().
+        :param prefetch: names of the relations to load, see get().
+        :return: OrderedDict of primary key -> Model object in the order of pks, the keys not found are left out.
+
+        >>> class TestMany(Model):
+        ...     __table__ = 'testuser'
+        ...     id = IntegerField(primary_key=True)
+        ...     name = StringField()
+        ...     email = StringField()
+        ...     password = StringField()
+        ...     last_modified = FloatField()
+        >>> TestMany.insert_all([TestMany(id=10600 + i, name='Many') for i in range(3)])
+        3
+        >>> [(pk, u.id) for pk, u in TestMany.get_many([10602, 10699, 10600, 10602]).items()]
+        [(10602, 10602), (10600, 10600)]
+        >>> r = db.update('delete from testuser where name=%s', 'Many')
+        """
+        m = _orm_ctx.identities_of(cls)
+        found = dict()
+        missing = list()
+        for pk in pks:
+            if m is not None and pk in m:
+                found[pk] = m[pk]
+            elif pk not in found:
+                found[pk] = None
+                missing.append(pk)
+        pk_name = cls.__primary_key__.name
+        backend = db.get_backend()
+        for start in xrange(0, len(missing), _GET_MANY_SIZE):
+            condition, args = backend.any(pk_name, missing[start:start + _GET_MANY_SIZE])
+            for instance in cls._identities(cls._select(False, 'select %s from %s where %s' % (
+                    cls._columns(fields), cls.__table__, condition), *args)):
+                found[instance[pk_name]] = instance
+        result = collections.OrderedDict()
+        for pk in pks:
+            if found.get(pk) is not None:
+                result[pk] = found[pk]
+        cls._prefetch(result.values(), prefetch)
+        return result
+
+    @classmethod
+    def find_first(cls, where, *args, **kwargs):
+        """
+        Find by where clause and return one result. If multiple results found,
+        only the first one returned. If no result found, return None.
+        :param where: string like "name='Michael'" or "name=%s"
+        :param args: parameters of "%s" in where
+        :param fields: keyword argument, names of the fields to select, see get().
+        :param prefetch: keyword argument, names of the relations to load, see get().
+         """
+        if _orm_ctx.identities is not None and len(args) == 1:
+            m = _RE_PK_WHERE.match(where)
+            if m is not None and m.group(1) == cls.__primary_key__.name:
+                return cls.get(args[0], kwargs.get('fields'), kwargs.get('prefetch'))
+        return cls._prefetch(cls._identities(cls._select(True, 'select %s from %s where %s' % (
+            cls._columns(kwargs.get('fields')), cls.__table__, where), *args)), kwargs.get('prefetch'))
+
+    @classmethod
+    def find_all(cls, fields=None, prefetch=None):
+        """
+        Find all and return list.
+        :param fields: names of the fields to select, see get().
+        :param prefetch: names of the relations to load, see get().
+        """
+        return cls._prefetch(cls._identities(cls._select(False, 'select %s from %s' % (
+            cls._columns(fields), cls.__table__))), prefetch)
+
+    @classmethod
+    def query(cls):
+        """
+        Get the lazy query of the objects of the class, see Query.
+        :return: Query object.
+        """
+        return Query(cls)
+
+    @classmethod
+    def exists(cls, where=None, *args):
+        """
+        Check any object matches the where clause by "select 1 ... limit 1", without fetching the row.
+        :param where: condition like "email=%s".
+        :return: bool.
+        """
+        return cls.query().filter(where, *args).exists()
+
+    @classmethod
+    def find_by(cls, where, *args, **kwargs):
+        """
+        Find by where clause and return list.
+        :param fields: keyword argument, names of the fields to select, see get().
+        :param prefetch: keyword argument, names of the relations to load, see get().
+        """
+        return cls._prefetch(cls._identities(cls._select(False, 'select %s from %s %s' % (
+            cls._columns(kwargs.get('fields')), cls.__table__, where), *args)), kwargs.get('prefetch'))
+
+    @classmethod
+    def page(cls, order_by, after=None, before=None, limit=20, where=None, args=(), fields=None, prefetch=None):
+        """
+        Find a page of objects by keyset pagination, the cost is the same however deep the page is.
+        The order columns, followed by the primary key to break the ties, should be indexed together.
+
+        :param order_by: field name or list of field names, prefix '-' for descending order, e.g. '-created_at'.
+        All fields must be in the same direction.
+        :param after: cursor of the page before, the next of it, to get the objects after it.
+        :param before: cursor of the page after, the prev of it, to get the objects before it.
+        :param limit: max numbers of objects in the page.
+        :param where: where clause like "u_id=%s", without 'where'.
+        :param args: parameters of "%s" in where.
+        :param fields: names of the fields to select, see get().
+        :param prefetch: names of the relations to load, see get().
+        :return: Page object with items, next and prev, the cursors are None if there is no more pages.
+
+        >>> class TestPage(Model):
+        ...     __table__ = 'testuser'
+        ...     id = IntegerField(primary_key=True)
+        ...     name = StringField()
+        ...     email = StringField()
+        ...     password = StringField()
+        ...     last_modified = FloatField()
+        >>> TestPage.insert_all([TestPage(id=10400 + i, name='Page', last_modified=float(i // 2)) for i in range(5)])
+        5
+        >>> p = TestPage.page('-last_modified', limit=2, where='name=%s', args=('Page',))
+        >>> [u.id for u in p.items], p.prev
+        ([10404, 10403], None)
+        >>> p = TestPage.page('-last_modified', after=p.next, limit=2, where='name=%s', args=('Page',))
+        >>> [u.id for u in p.items]
+        [10402, 10401]
+        >>> p = TestPage.page('-last_modified', after=p.next, limit=2, where='name=%s', args=('Page',))
+        >>> [u.id for u in p.items], p.next
+        ([10400], None)
+        >>> p = TestPage.page('-last_modified', before=p.prev, limit=2, where='name=%s', args=('Page',))
+        >>> [u.id for u in p.items]
+        [10402, 10401]
+        >>> p = TestPage.page('-last_modified', before=p.prev, limit=2, where='name=%s', args=('Page',))
+        >>> [u.id for u in p.items], p.prev
+        ([10404, 10403], None)
+        >>> r = db.update('delete from testuser where name=%s', 'Page')
+        """
+        if isinstance(order_by, basestring):
+            order_by = (order_by,)
+        desc = set(f.startswith('-') for f in order_by)
+        if len(desc) != 1:
+            raise ValueError('Mixed directions of order by: %s' % ','.join(order_by))
+        desc = desc.pop()
+        pk = cls.__primary_key__.name
+        names = [f.lstrip('-') for f in order_by]
+        for name in names:
+            if name not in cls.__mappings__:
+                raise ValueError('Invalid field: %s' % name)
+        if pk not in names:
+            names.append(pk)
+        cursor = after if after is not None else before
+        # going backward is going forward in the reverse order.
+        backward = before is not None and after is None
+        reverse = desc != backward
+        if fields is not None:
+            fields = list(fields) + [name for name in names if name not in fields]
+        sql = ['select %s from %s' % (cls._columns(fields), cls.__table__)]
+        conditions, params = list(), list()
+        if where:
+            conditions.append('(%s)' % where)
+            params.extend(args)
+        if cursor is not None:
+            conditions.append('(%s) %s (%s)' % (','.join(names), '<' if reverse else '>',
+                                                ','.join(['%s'] * len(names))))
+            params.extend(_decode_cursor(cursor, len(names)))
+        if conditions:
+            sql.append('where %s' % ' and '.join(conditions))
+        sql.append('order by %s' % ','.join('%s %s' % (name, 'desc' if reverse else 'asc') for name in names))
+        sql.append('limit %d' % (limit + 1))
+        items = cls._identities(cls._select(False, ' '.join(sql), *params))
+        more = len(items) > limit
+        items = items[:limit]
+        if backward:
+            items.reverse()
+        cls._prefetch(items, prefetch)
+        first = _encode_cursor([items[0][name] for name in names]) if items else None
+        last = _encode_cursor([items[-1][name] for name in names]) if items else None
+        if backward:
+            return Page(items, last if items else before, first if more else None)
+        return Page(items, last if more else None, first if cursor is not None else None)
+
+    @classmethod
+    def aget(cls, pk):
+        """
+        Get by primary key in a new greenlet, see aio module.
+        :return: greenlet object, get() returns Model object or None.
+        """
+        return aio.spawn(cls.get, pk)
+
+    @classmethod
+    def afind_by(cls, where, *args, **kwargs):
+        """
+        Find by where clause in a new greenlet, see aio module.
+        :return: greenlet object, get() returns list.
+        """
+        return aio.spawn(cls.find_by, where, *args, **kwargs)
+
+    @classmethod
+    def iter_by(cls, where, *args, **kwargs):
+        """
+        Find by where clause and yield the objects one by one in constant memory.
+        :param where: string like "where name=%s order by id"
+        :param args: parameters of "%s" in where
+        :param batch_size: keyword argument, numbers of rows fetched per round trip.
+        :param fields: keyword argument, names of the fields to select, see get().
+        """
+        kwargs['factory'] = cls._row_factory
+        columns = cls._columns(kwargs.pop('fields', None))
+        return db.select_iter('select %s from %s %s' % (columns, cls.__table__, where), *args, **kwargs)
+
+    @classmethod
+    def count_all(cls, approximate=False):
+        """
+        Find by 'select count(pk) from table' and return integer.
+        :param approximate: True to read the estimated numbers of rows by the statistics of the database
+        if the backend has, which costs nothing but may be off by the recent writes.
+        """
+        if approximate:
+            n = db.get_backend().estimate_rows(cls.__table__)
+            if n is not None:
+                return n
+        return cls._count('')
+
+    @classmethod
+    def count_by(cls, where, *args):
+        """
+        Find by 'select count(pk) from table where ... ' and return int.
+        The where clause like "where b_id=%s and u_id=%s" is kept in the count cache if the class set __count_cache__.
+        """
+        return cls._count(where, *args)
+
+    def _identify(self, mapped):
+        """
+        Put the object in the identity map, or remove it, after written.
+        """
+        m = _orm_ctx.identities_of(self.__class__)
+        if m is not None:
+            pk = self._get_value(self.__primary_key__.name)
+            if mapped:
+                m[pk] = self
+            else:
+                m.pop(pk, None)
+
+    def update(self):
+        """
+        Update the object in the database.
+        The object loaded from the database sets only the fields changed since loaded or written,
+        and is not sent if nothing changed. The object not loaded sets all the updatable fields.
+        :type self: Model
+
+        >>> class TestDirty(Model):
+        ...     __table__ = 'testuser'
+        ...     id = IntegerField(primary_key=True)
+        ...     name = StringField()
+        ...     email = StringField()
+        ...     password = StringField()
+        ...     last_modified = FloatField()
+        >>> u = TestDirty(id=10700, name='Dirty', email='dirty@db.org').insert()
+        >>> u = TestDirty.get(10700)
+        >>> u.name = 'Dirty'
+        >>> sorted(u._get_state('_changed', ()))
+        []
+        >>> u.name, u.email = 'Clean', 'clean@db.org'
+        >>> sorted(u._get_state('_changed'))
+        ['email', 'name']
+        >>> r = db.update('update testuser set password=%s where id=%s', 'secret', 10700)
+        >>> u.update()
+        >>> TestDirty.get(10700).password, TestDirty.get(10700).email
+        (u'secret', u'clean@db.org')
+        >>> u._get_state('_changed', 'saved')
+        'saved'
+        >>> r = u.delete()
+        """
+        self.pre_update and self.pre_update()
+        changed = self._get_state('_changed', ())
+        if changed is None:
+            for k, default, dynamic in self.__update_fields__:
+                if k not in self:
+                    self._set_value(k, default() if dynamic else default)
+            col_list = [f[0] for f in self.__update_fields__]
+            sql = self.__statements__['update']
+        else:
+            col_list = [f[0] for f in self.__update_fields__ if f[0] in changed]
+            sql = self._update_sql(tuple(col_list))
+        if not col_list:
+            return
+        args = [self[k] for k in col_list]
+        args.append(self[self.__primary_key__.name])
+        version = self.__version__
+        if version is not None:
+            args.append(self._get_value(version, 0))
+        r, cache = self._write(db.update, sql, *args)
+        if version is not None:
+            if r == 0:
+                # the next get() loads the row again, not the object in the identity map or the query cache.
+                self._identify(False)
+                db.invalidate(self.__table__)
+                raise ConflictError('%s %s is updated since loaded.' % (self.__class__.__name__, args[-2]))
+            self._set_value(version, args[-1] + 1)
+        if cache is not None:
+            cache.drop(self.__table__, set(col_list))
+        self._saved()
+        self._identify(True)
+
+    def delete(self):
+        """
+        Delete the object in the database.
+        :return: Model object itself.
+        """
+        self.pre_delete and self.pre_delete()
+        r, cache = self._write(db.update, self.__statements__['delete'], self[self.__primary_key__.name])
+        if cache is not None and r:
+            cache.move(self.__table__, self, -1)
+        self._identify(False)
+        return self
+
+    def insert(self):
+        """
+        Insert the object into the database.
+        :return: Model object itself.
+        """
+        self.pre_insert and self.pre_insert()
+        args = list()
+        for k, default, dynamic in self.__insert_fields__:
+            if k not in self:
+                self._set_value(k, default() if dynamic else default)
+            args.append(self[k])
+        r, cache = self._write(db.update, self.__statements__['insert'], *args)
+        if cache is not None:
+            cache.move(self.__table__, self, 1)
+        self._saved()
+        self._identify(True)
+        return self
+
+    @classmethod
+    def _upsert_sql(cls, conflict, update):
+        key = (conflict, update)
+        sql = cls.__upsert_statements__.get(key)
+        if sql is None:
+            if update:
+                sets = ['%s=excluded.%s' % (k, k) for k in update]
+                if cls.__version__ is not None:
+                    sets.append('%s=%s.%s+1' % (cls.__version__, cls.__table__, cls.__version__))
+                action = 'update set %s' % ','.join(sets)
+            else:
+                action = 'nothing'
+            sql = cls.__upsert_statements__[key] = '%s on conflict (%s) do %s returning *' % (
+                cls.__statements__['insert'], ','.join(conflict), action)
+        return sql
+
+    def upsert(self, conflict, update=None):
+        """
+        Insert the object, or update the row having the same values of the conflict fields, by one statement.
+        :param conflict: names of the fields of the primary key or a unique index, e.g. ('email',).
+        :param update: names of the fields to set on conflict, default is the updatable fields out of conflict,
+        empty to keep the row as it is.
+        :return: Model object itself with the fields of the row written, or None if the row is kept.
+
+        >>> class TestUpsert(Model):
+        ...     __table__ = 'testuser'
+        ...     id = IntegerField(primary_key=True)
+        ...     name = StringField()
+        ...     email = StringField()
+        ...     password = StringField()
+        ...     last_modified = FloatField()
+        >>> TestUpsert(id=11000, name='Upsert', password='first').save().password
+        u'first'
+        >>> u = TestUpsert(id=11000, name='Upsert', password='second').upsert(('id',), update=('password',))
+        >>> u.password, TestUpsert.get(11000).password
+        (u'second', u'second')
+        >>> TestUpsert(id=11000, name='Other').upsert(('id',), update=()) is None
+        True
+        >>> TestUpsert.exists('id=%s', 11000), TestUpsert.get(11000).name
+        (True, u'Upsert')
+        >>> r = TestUpsert.get(11000).delete()
+        >>> TestUpsert.exists('id=%s', 11000)
+        False
+        """
+        conflict = tuple(conflict)
+        for k in conflict:
+            if k not in self.__mappings__:
+                raise ValueError('Invalid field: %s' % k)
+        if update is None:
+            update = tuple(f[0] for f in self.__update_fields__ if f[0] not in conflict)
+        else:
+            update = tuple(update)
+            self._columns(update)
+        self.pre_insert and self.pre_insert()
+        args = list()
+        for k, default, dynamic in self.__insert_fields__:
+            if k not in self:
+                self._set_value(k, default() if dynamic else default)
+            args.append(self[k])
+        rows, cache = self._write(db.update_returning, self._upsert_sql(conflict, update), *args)
+        if cache is not None and rows:
+            # not known to be inserted or updated.
+            cache.drop(self.__table__)
+        if not rows:
+            return None
+        for k, v in rows[0].iteritems():
+            self._set_value(k, v)
+        self._saved()
+        self._identify(True)
+        return self
+
+    def save(self):
+        """
+        Insert the object, or update the row of the same primary key, by one statement, see upsert().
+        :return: Model object itself.
+        """
+        return self.upsert((self.__primary_key__.name,))
+
+    def ainsert(self):
+        """
+        Insert the object into the database in a new greenlet, see aio module.
+        :return: greenlet object, get() returns Model object itself.
+        """
+        return aio.spawn(self.insert)
+
+    @classmethod
+    def insert_all(cls, instances, batch_size=500, method='values'):
+        """
+        Insert the objects into the database in batches.
+        :param instances: list of Model objects of the class.
+        :param batch_size: numbers of rows sent per round trip.
+        :param method: 'values' or 'copy', see db.insert_many().
+        :return: int number of inserted rows.
+        """
+        instances = list(instances)
+        fields = [(k, cls.__mappings__[k].name, default, dynamic) for k, default, dynamic in cls.__insert_fields__]
+        rows = list()
+        for instance in instances:
+            instance.pre_insert and instance.pre_insert()
+            params = dict()
+            for k, name, default, dynamic in fields:
+                if k not in instance:
+                    instance._set_value(k, default() if dynamic else default)
+                params[name] = instance[k]
+            rows.append(params)
+        r, cache = cls._write(db.insert_many, cls.__table__, rows, batch_size, method)
+        if cache is not None:
+            for params in rows:
+                cache.move(cls.__table__, params, 1)
+        for instance in instances:
+            instance._saved()
+        if _orm_ctx.identities is not None:
+            for instance in instances:
+                instance._identify(True)
+        return r
 
 
-class Model(dict):
+class Model(_ModelBase, dict):
     """
     Base model class
 
@@ -115,6 +1514,8 @@ class Model(dict):
     u'******'
     >>> TestUser.find_by("where name='Michael'")[0]['email']
     u'orm@db.org'
+    >>> [t.email for t in TestUser.iter_by("where name=%s", 'Michael', batch_size=10)]
+    [u'orm@db.org']
     >>> print TestUser.__mappings__['id']
     <IntegerField: id, bigint, default(0), I>
     >>> u.email
@@ -137,10 +1538,26 @@ class Model(dict):
     >>> g = TestUser.get(10190)
     >>> g.email
     u'orm@db.org'
+    >>> r = TestUser(id=10191, name='Jane', email='jane@db.org').insert()
+    >>> sorted(TestUser.get(10191, fields=('name',)).keys())
+    ['id', 'name']
+    >>> class TestLazyUser(Model):
+    ...     __table__ = 'testuser'
+    ...     id = IntegerField(primary_key=True)
+    ...     name = StringField()
+    ...     email = StringField(updatable=False)
+    ...     password = TextField(deferred=True)
+    ...     last_modified = FloatField()
+    >>> L = TestLazyUser.find_by('order by id')
+    >>> 'password' in L[0], 'password' in L[1]
+    (False, False)
+    >>> L[0].password, 'password' in L[1]
+    (u'******', True)
+    >>> r = TestUser.get(10191).delete()
     >>> r = g.delete()
     >>> len(db.select('select * from testuser where id=10190'))
     0
-    >>> print TestUser().__sql__()
+    >>> print TestUser().__sql__('postgresql')
     -- generating SQL for testuser:
     create table testuser (
      id bigint not null,
@@ -151,118 +1568,219 @@ class Model(dict):
      primary key(id)
     );
     """
-    __metaclass__ = ModelMetaClass
-
     def __init__(self, **kwargs):
-        super(Model, self).__init__(**kwargs)
+        dict.__init__(self, **kwargs)
+        # names of the fields changed since loaded, None for the object not loaded from the database.
+        # the loaded objects have no _changed until the first change, see _row_factory().
+        self.__dict__['_changed'] = None
 
     def __getattr__(self, item):
         try:
             return self[item]
         except KeyError:
+            group = self.__dict__.get('_load_group')
+            if group is not None and item in self.__mappings__:
+                group.load(item)
+                if item in self:
+                    return self[item]
             raise AttributeError(r"'Dict' object has no attribute '%s'" % item)
 
     def __setattr__(self, key, value):
         self[key] = value
 
-    @classmethod
-    def get(cls, pk):
-        """
-        Get by primary key
-        :param pk: primary key.
-        :return: Model object or None
-        """
-        result = db.select_one('select * from %s where %s=%%s' % (cls.__table__, cls.__primary_key__.name), pk)
-        return cls(**result) if result else None
+    def __setitem__(self, key, value):
+        changed = self.__dict__.get('_changed', ())
+        if changed is not None and (key not in self or dict.__getitem__(self, key) != value):
+            if not changed:
+                changed = self.__dict__['_changed'] = set()
+            changed.add(key)
+        dict.__setitem__(self, key, value)
 
-    @classmethod
-    def find_first(cls, where, *args):
-        """
-        Find by where clause and return one result. If multiple results found,
-        only the first one returned. If no result found, return None.
-        :param where: string like "name='Michael'" or "name=%s"
-        :param args: parameters of "%s" in where
-         """
-        result = db.select_one('select * from %s where %s' % (cls.__table__, where), *args)
-        return cls(**result) if result else None
+    # the storage of the fields, see LeanModel.
+    _get_value = dict.get
+    _set_value = dict.__setitem__
 
-    @classmethod
-    def find_all(cls):
-        """
-        Find all and return list.
-        """
-        result = db.select('select * from %s' % cls.__table__)
-        return [cls(**r) for r in result]
+    # the state of the object: _changed, _load_group and the related objects, see LeanModel.
+    def _get_state(self, name, default=None):
+        return self.__dict__.get(name, default)
 
-    @classmethod
-    def find_by(cls, where, *args):
-        """
-        Find by where clause and return list.
-        """
-        result = db.select('select * from %s %s' % (cls.__table__, where), *args)
-        return [cls(**r) for r in result]
+    def _set_state(self, name, value):
+        self.__dict__[name] = value
 
-    @classmethod
-    def count_all(cls):
-        """
-        Find by 'select count(pk) from table' and return integer.
-        """
-        return db.select_int('select count(%s) from %s' % (cls.__primary_key__.name, cls.__table__))
+    def _del_state(self, name):
+        self.__dict__.pop(name, None)
+
+    def _cache_related(self, relation, value):
+        # the instance dict hides the relation, so the later reads get the value at once.
+        self.__dict__[relation.name] = value
 
     @classmethod
-    def count_by(cls, where, *args):
-        """
-        Find by 'select count(pk) from table where ... ' and return int.
-        """
-        return db.select_int('select count(%s) from %s %s' %
-                             (cls.__primary_key__.name, cls.__table__, where), *args)
+    def _object_factory(cls, names):
+        def make_object(values):
+            instance = cls.__new__(cls)
+            dict.update(instance, itertools.izip(names, values))
+            return instance
+        return make_object
 
-    def update(self):
-        """
-        Update the object in the database.
-        :type self: Model
-        """
-        self.pre_update and self.pre_update()
-        col_list = list()
-        args = list()
-        for k, v in self.__mappings__.iteritems():
-            if v.updatable:
-                if hasattr(self, k):
-                    arg = getattr(self, k)
-                else:
-                    arg = v.default
-                    setattr(self, k, arg)
-                col_list.append('%s=%%s' % k)
-                args.append(arg)
-        pk = self.__primary_key__.name
-        args.append(getattr(self, pk))
-        db.update('update %s set %s where %s=%%s' % (self.__table__, ','.join(col_list), pk), *args)
 
-    def delete(self):
-        """
-        Delete the object in the database.
-        :return: Model object itself.
-        """
-        self.pre_delete and self.pre_delete()
-        pk = self.__primary_key__.name
-        args = (getattr(self, pk),)
-        db.update('delete from %s where %s=%%s' % (self.__table__, pk), *args)
-        return self
+class LeanModel(_ModelBase):
+    """
+    Base model class keeping the fields in __slots__ instead of a dict
 
-    def insert(self):
-        """
-        Insert the object into the database.
-        :return: Model object itself.
-        """
-        self.pre_insert and self.pre_insert()
-        params = dict()
-        for k, v in self.__mappings__.iteritems():
-            if v.insertable:
-                if not hasattr(self, k):
-                    setattr(self, k, v.default)
-                params[v.name] = getattr(self, k)
-        db.insert('%s' % self.__table__, **params)
-        return self
+    The metaclass makes a slot, which is a data descriptor, for every field and every relation. The state
+    of the object is kept in the slots of LeanModel, so the objects have no instance dict: an object takes
+    a fraction of the memory of a Model object and the fields are read faster. The columns selected other
+    than the fields are not kept. The objects keep the dict-style access of the fields, and are dumped
+    by apis.json_dump() as the dict of their fields.
+
+    >>> class TestLeanUser(LeanModel):
+    ...     __table__ = 'testuser'
+    ...     id = IntegerField(primary_key=True)
+    ...     name = StringField()
+    ...     email = StringField(updatable=False)
+    ...     password = TextField(deferred=True)
+    ...     last_modified = FloatField()
+    >>> TestLeanUser.__slots__
+    ('id', 'name', 'email', 'password', 'last_modified')
+    >>> u = TestLeanUser(id=10800, name='Lean', email='lean@db.org', password='secret').insert()
+    >>> u = TestLeanUser.find_first('id=%s', 10800)
+    >>> u.name, u['email'], 'password' in u, len(u), hasattr(u, '__dict__')
+    (u'Lean', u'lean@db.org', False, 4, False)
+    >>> u.password, 'password' in u
+    (u'secret', True)
+    >>> u['name'] = 'Changed'
+    >>> u.update()
+    >>> sorted(TestLeanUser.get(10800, fields=('name',)).iteritems())
+    [('id', 10800), ('name', u'Changed')]
+    >>> u.phone
+    Traceback (most recent call last):
+      ...
+    AttributeError: 'TestLeanUser' object has no attribute 'phone'
+    >>> r = u.delete()
+    """
+    # the state of the object, see Model.
+    __slots__ = ('_changed', '_load_group', '__weakref__')
+
+    def __init__(self, **kwargs):
+        for k, v in kwargs.iteritems():
+            self._set_value(k, v)
+        # see Model.__init__().
+        self._set_state('_changed', None)
+
+    def _get_state(self, name, default=None):
+        try:
+            return object.__getattribute__(self, name)
+        except AttributeError:
+            return default
+
+    _set_state = object.__setattr__
+
+    def _del_state(self, name):
+        try:
+            object.__delattr__(self, name)
+        except AttributeError:
+            pass
+
+    def _cache_related(self, relation, value):
+        object.__setattr__(self, relation.slot, value)
+
+    def __getattr__(self, item):
+        # called for the fields not loaded, and the attributes not defined.
+        group = self._get_state('_load_group')
+        if group is not None and item in self.__mappings__:
+            group.load(item)
+            try:
+                return object.__getattribute__(self, item)
+            except AttributeError:
+                pass
+        raise AttributeError("'%s' object has no attribute '%s'" % (self.__class__.__name__, item))
+
+    def __setattr__(self, key, value):
+        if key in self.__mappings__:
+            changed = self._get_state('_changed', ())
+            if changed is not None:
+                try:
+                    same = object.__getattribute__(self, key) == value
+                except AttributeError:
+                    same = False
+                if not same:
+                    if not changed:
+                        changed = set()
+                        object.__setattr__(self, '_changed', changed)
+                    changed.add(key)
+        object.__setattr__(self, key, value)
+
+    __setitem__ = __setattr__
+
+    def __getitem__(self, key):
+        if key in self.__mappings__:
+            try:
+                return object.__getattribute__(self, key)
+            except AttributeError:
+                pass
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        if key not in self.__mappings__:
+            return False
+        try:
+            object.__getattribute__(self, key)
+            return True
+        except AttributeError:
+            return False
+
+    def _get_value(self, key, default=None):
+        if key not in self.__mappings__:
+            return default
+        try:
+            return object.__getattribute__(self, key)
+        except AttributeError:
+            return default
+
+    _set_value = object.__setattr__
+
+    def iteritems(self):
+        for k in self.__fields__:
+            try:
+                yield k, object.__getattribute__(self, k)
+            except AttributeError:
+                pass
+
+    def items(self):
+        return list(self.iteritems())
+
+    def keys(self):
+        return [k for k, _ in self.iteritems()]
+
+    def values(self):
+        return [v for _, v in self.iteritems()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __repr__(self):
+        return '<%s %r>' % (self.__class__.__name__, dict(self.iteritems()))
+
+    @classmethod
+    def _object_factory(cls, names):
+        setters = list()
+        for name in names:
+            if name in cls.__mappings__:
+                setters.append(cls.__dict__[name].__set__)
+            else:
+                # no slot for the column.
+                setters.append(lambda instance, value: None)
+        new = object.__new__
+
+        def make_object(values):
+            instance = new(cls)
+            for setter, value in itertools.izip(setters, values):
+                setter(instance, value)
+            return instance
+        return make_object
 
 
 class Field(object):
@@ -280,6 +1798,11 @@ class Field(object):
         self.nullable = kwargs.get('nullable', False)
         self.updatable = kwargs.get('updatable', True)
         self.insertable = kwargs.get('insertable', True)
+        # deferred field is not selected by default, but loaded on the first access.
+        self.deferred = kwargs.get('deferred', False)
+        # index the column, a unique index if unique, see Index for the composite or partial indexes.
+        self.index = kwargs.get('index', False)
+        self.unique = kwargs.get('unique', False)
         self.ddl = kwargs.get('ddl', '')
         self._order = Field._count
         Field._count += 1
@@ -298,6 +1821,7 @@ class Field(object):
         self.nullable and s.append('N')
         self.updatable and s.append('U')
         self.insertable and s.append('I')
+        self.deferred and s.append('D')
         s.append('>')
         return ''.join(s)
 
@@ -339,6 +1863,9 @@ class BooleanField(Field):
 
 
 class TextField(Field):
+    """
+    Text column, TextField(deferred=True) is not selected by default but loaded on the first access.
+    """
     def __init__(self, **kwargs):
         if 'default' not in kwargs:
             kwargs['default'] = False
@@ -348,14 +1875,290 @@ class TextField(Field):
 
 
 class VersionField(Field):
+    """
+    Version of the row for the optimistic concurrency control.
+
+    update() increases the version, and raises ConflictError if the row of the version loaded is not found,
+    which means the row is updated by others since loaded. The writers do not hold any lock between
+    the load and the update, see retry_on_conflict() to load and update again.
+
+    >>> r = db.update('create table testversion (id int primary key, name text, version bigint)')
+    >>> class TestVersion(Model):
+    ...     __table__ = 'testversion'
+    ...     id = IntegerField(primary_key=True)
+    ...     name = StringField()
+    ...     version = VersionField()
+    >>> r = TestVersion(id=1, name='First').insert()
+    >>> a, b = TestVersion.get(1), TestVersion.get(1)
+    >>> a.name = 'A'
+    >>> a.update()
+    >>> int(a.version), int(TestVersion.get(1).version)
+    (1, 1)
+    >>> b.name = 'B'
+    >>> b.update()
+    Traceback (most recent call last):
+      ...
+    ConflictError: TestVersion 1 is updated since loaded.
+    >>> @retry_on_conflict(retries=2)
+    ... def rename(pk, name):
+    ...     t = TestVersion.get(pk)
+    ...     t.name = name
+    ...     t.update()
+    ...     return int(t.version)
+    >>> rename(1, 'B')
+    2
+    >>> r = db.update('drop table testversion')
+    """
     def __init__(self, name=None):
-        super(VersionField, self).__init__(name=name, default=0, ddl='bigint')
+        # the version is set by update() only.
+        super(VersionField, self).__init__(name=name, default=0, ddl='bigint', updatable=False)
+
+
+def retry_on_conflict(retries=3, delay=0.01):
+    """
+    Decorate the function loading and updating the objects with VersionField,
+    to call it again on ConflictError, which loads the objects updated by others.
+    :param retries: max numbers of calls again.
+    :param delay: seconds to wait before the first call again, doubled for the next one.
+
+    usage:
+    @retry_on_conflict()
+    def rename_blog(blog_id, name):
+        blog = Blog.get(blog_id)
+        blog.name = name
+        blog.update()
+    """
+    def _decorator(func):
+        @functools.wraps(func)
+        def _wrapper(*args, **kwargs):
+            wait = delay
+            for _ in xrange(retries):
+                try:
+                    return func(*args, **kwargs)
+                except ConflictError, e:
+                    logging.info('Retry %s on conflict: %s' % (func.__name__, e))
+                    time.sleep(wait)
+                    wait *= 2
+            return func(*args, **kwargs)
+        return _wrapper
+    return _decorator
+
+
+class Index(object):
+    """
+    Index of the model table, set in __indexes__ of the model for the composite or partial indexes.
+
+    >>> Index('created_at desc', 'b_id').sql('blogs')
+    'create index blogs_created_at_b_id_idx on blogs (created_at desc,b_id)'
+    >>> Index('email', unique=True, where='admin', name='admins_email').sql('users', concurrently=True)
+    'create unique index concurrently admins_email on users (email) where admin'
+    """
+    def __init__(self, *columns, **kwargs):
+        if not columns:
+            raise ValueError('No columns of index.')
+        self.columns = columns
+        self.unique = kwargs.get('unique', False)
+        # condition of the partial index
+        self.where = kwargs.get('where', None)
+        self.name = kwargs.get('name', None)
+
+    def default_name(self, table_name):
+        return '%s_%s_%s' % (table_name, '_'.join(c.split()[0] for c in self.columns), 'key' if self.unique else 'idx')
+
+    def sql(self, table_name, concurrently=False):
+        """
+        Get the statement creating the index.
+        :param concurrently: create the index without blocking the writes of the table, PostgreSQL only.
+        """
+        sql = ['create', 'unique index' if self.unique else 'index']
+        concurrently and sql.append('concurrently')
+        sql.append('%s on %s (%s)' % (self.name or self.default_name(table_name), table_name, ','.join(self.columns)))
+        self.where and sql.append('where %s' % self.where)
+        return ' '.join(sql)
+
+
+def sync_indexes(models, concurrently=True, dry_run=False):
+    """
+    Create the indexes of the models missing in the database, the existing ones are kept as they are.
+    :param models: list of Model classes.
+    :param concurrently: create the indexes without blocking the writes of the tables if the backend can,
+    which runs out of transaction and keeps serving the live database.
+    :param dry_run: True to get the statements without execution.
+    :return: list of the statements.
+
+    >>> class TestIndex(Model):
+    ...     __table__ = 'testuser'
+    ...     __indexes__ = (Index('name', 'last_modified desc'),)
+    ...     id = IntegerField(primary_key=True)
+    ...     name = StringField()
+    ...     email = StringField(unique=True)
+    ...     password = StringField()
+    ...     last_modified = FloatField()
+    >>> for sql in sync_indexes([TestIndex]):
+    ...     print sql
+    create unique index testuser_email_key on testuser (email)
+    create index testuser_name_last_modified_idx on testuser (name,last_modified desc)
+    >>> sync_indexes([TestIndex])
+    []
+    >>> for index in TestIndex.__indexes__:
+    ...     r = db.update('drop index %s' % index.name)
+    """
+    backend = db.get_backend()
+    concurrently = concurrently and backend.concurrent_index
+    statements = list()
+    for model in models:
+        existing = backend.index_names(model.__table__)
+        for index in model.__indexes__:
+            if index.name in existing:
+                continue
+            sql = index.sql(model.__table__, concurrently)
+            statements.append(sql)
+            if dry_run:
+                continue
+            if concurrently:
+                # drop the invalid index left by a failed try before.
+                db.update_autocommit('drop index concurrently if exists %s' % index.name)
+                db.update_autocommit(sql)
+            else:
+                db.update(sql)
+            logging.info('Create index: %s' % sql)
+    return statements
+
+
+class _Relation(object):
+    """
+    Base relation to the objects of another model
+
+    The related objects are loaded on the first access and kept in the object, or loaded for many objects
+    at once by the prefetch of the finders.
+    """
+    def __init__(self, model, column):
+        # name of the model class, resolved on the first use
+        self._model = model
+        self.column = column
+        # set by the metaclass, slot is the slot of LeanModel keeping the related objects.
+        self.name = None
+        self.slot = None
+
+    @property
+    def model(self):
+        if isinstance(self._model, basestring):
+            self._model = ModelMetaClass.subclasses[self._model]
+        return self._model
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        # the Model objects hide the relation by the value in the instance dict, see Model._cache_related().
+        value = instance._get_state(self.slot, _NOT_LOADED)
+        if value is _NOT_LOADED:
+            value = self.load(instance)
+            instance._cache_related(self, value)
+        return value
+
+    def load(self, instance):
+        raise NotImplementedError
+
+    def prefetch(self, instances):
+        """
+        Load the related objects of the objects and keep them in the objects.
+        :return: list of the related objects.
+        """
+        raise NotImplementedError
+
+
+class ForeignKey(_Relation):
+    """
+    Relation to the object whose primary key is in the column of this object.
+
+    class Comment(Model):
+        b_id = IntegerField(updatable=False)
+        blog = ForeignKey('Blog', 'b_id')
+    """
+    def load(self, instance):
+        key = instance._get_value(self.column)
+        return None if key is None else self.model.get(key)
+
+    def prefetch(self, instances):
+        keys = set(i._get_value(self.column) for i in instances)
+        keys.discard(None)
+        related = self.model.get_many(list(keys))
+        for instance in instances:
+            instance._cache_related(self, related.get(instance._get_value(self.column)))
+        return related.values()
+
+
+class HasMany(_Relation):
+    """
+    Relation to the objects which have the primary key of this object in their column.
+
+    class Blog(Model):
+        comments = HasMany('Comment', 'b_id', order_by='created_at')
+
+    >>> r = db.update('create table testnote (id int primary key, u_id int, name text)')
+    >>> class TestNote(Model):
+    ...     __table__ = 'testnote'
+    ...     id = IntegerField(primary_key=True)
+    ...     u_id = IntegerField()
+    ...     name = StringField()
+    ...     user = ForeignKey('TestNoteUser', 'u_id')
+    >>> class TestNoteUser(Model):
+    ...     __table__ = 'testuser'
+    ...     id = IntegerField(primary_key=True)
+    ...     name = StringField()
+    ...     email = StringField()
+    ...     password = StringField()
+    ...     last_modified = FloatField()
+    ...     notes = HasMany('TestNote', 'u_id', order_by='id')
+    >>> TestNoteUser.insert_all([TestNoteUser(id=10600 + i, name='Note%d' % i) for i in range(2)])
+    2
+    >>> TestNote.insert_all([TestNote(id=i, u_id=10600 + i % 2, name='n%d' % i) for i in range(5)])
+    5
+    >>> users = TestNoteUser.find_by('where name like %s order by id', 'Note%', prefetch=('notes', 'notes.user'))
+    >>> [(u.name, [n.name for n in u.notes]) for u in users]
+    [(u'Note0', [u'n0', u'n2', u'n4']), (u'Note1', [u'n1', u'n3'])]
+    >>> [n.user.name for n in users[1].__dict__['notes']]
+    [u'Note1', u'Note1']
+    >>> TestNote.get(3).user.id
+    10601
+    >>> r = db.update('delete from testuser where name like %s', 'Note%')
+    >>> r = db.update('drop table testnote')
+    """
+    def __init__(self, model, column, order_by=None):
+        super(HasMany, self).__init__(model, column)
+        self.order_by = order_by
+
+    def _order(self):
+        return ' order by %s' % self.order_by if self.order_by else ''
+
+    def load(self, instance):
+        pk = instance._get_value(instance.__primary_key__.name)
+        return self.model.find_by('where %s=%%s%s' % (self.column, self._order()), pk)
+
+    def prefetch(self, instances):
+        if not instances:
+            return list()
+        pks = list(set(i._get_value(i.__primary_key__.name) for i in instances))
+        backend = db.get_backend()
+        groups = collections.defaultdict(list)
+        related = list()
+        for start in xrange(0, len(pks), _GET_MANY_SIZE):
+            condition, args = backend.any(self.column, pks[start:start + _GET_MANY_SIZE])
+            for r in self.model.find_by('where %s%s' % (condition, self._order()), *args):
+                groups[r._get_value(self.column)].append(r)
+                related.append(r)
+        for instance in instances:
+            instance._cache_related(self, groups.get(instance._get_value(instance.__primary_key__.name), []))
+        return related
 
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)
-    # TODO: should be modified to your own test database
-    db.create_engine('test_user', 'test_pw', 'test_db')
+    # TODO: should be modified to your own test database, or run with --sqlite in memory
+    if '--sqlite' in sys.argv:
+        db.create_engine(backend='sqlite')
+    else:
+        db.create_engine('test_user', 'test_pw', 'test_db')
     db.update('drop table if exists testuser')
     db.update('create table testuser (id int primary key, name text, email text, password text, last_modified real)')
     import doctest
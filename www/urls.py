@@ -12,8 +12,9 @@ import base64
 import hashlib
 import logging
 
-from transwarp.web import get, post, context, view, see_other, not_found, interceptor
+from transwarp.web import get, post, context, view, see_other, not_found, bad_request, interceptor
 from transwarp.apis import api, APIError, APIValueError, APIPermissionError, APIResourceNotFoundError
+from transwarp.orm import identity_map, detect_n_plus_one
 from models import User, Blog, Comment
 from config import configs
 
@@ -22,11 +23,14 @@ _RE_MD5 = re.compile(r'^[0-9a-f]{32}$')
 _RE_EMAIL = re.compile(r'^[a-z0-9\.\-\_]+\@[a-z0-9\-\_]+(\.[a-z0-9\-\_]+){1,4}$')
 _COOKIE_NAME = 'wheels_session'
 _COOKIE_KEY = configs
+_PAGE_SIZE = 10
+_MAX_PAGE_SIZE = 100
 
 
 def make_signed_cookie(u_id, password, max_age):
     expires = str(int(time.time() + (max_age or 86400)))
-    return '-'.join([u_id, expires, hashlib.md5('%s-%s-%s-%s' % (u_id, password, expires, _COOKIE_KEY)).hexdigest()])
+    md5 = hashlib.md5('%s-%s-%s-%s' % (u_id, password, expires, _COOKIE_KEY)).hexdigest()
+    return '-'.join([str(u_id), expires, md5])
 
 
 def parse_signed_cookie(cookie_str):
@@ -37,7 +41,7 @@ def parse_signed_cookie(cookie_str):
         u_id, expires, md5 = cookie_list
         if int(expires) < time.time():
             return None
-        user = User.get(u_id)
+        user = User.get(int(u_id))
         if user is None:
             return None
         if md5 != hashlib.md5('%s-%s-%s-%s' % (u_id, user.password, expires, _COOKIE_KEY)).hexdigest():
@@ -54,6 +58,18 @@ def assert_admin():
     raise APIPermissionError('No permission')
 
 
+@interceptor('/')
+def identity_map_interceptor(next):
+    with identity_map():
+        return next()
+
+
+@interceptor('/')
+def n_plus_one_interceptor(next):
+    with detect_n_plus_one(configs.n_plus_one.threshold):
+        return next()
+
+
 @interceptor('/')
 def user_interceptor(next):
     logging.info('Try to bind user from session cookie...')
@@ -79,8 +95,12 @@ def manage_interceptor(next):
 @view('blogs.html')
 @get('/')
 def index():
-    blogs = Blog.find_all()
-    return dict(blogs=blogs, user=context.request.user)
+    try:
+        page = Blog.page('-created_at', after=context.request.get('after'), before=context.request.get('before'),
+                         limit=_PAGE_SIZE)
+    except ValueError:
+        raise bad_request()
+    return dict(blogs=page.items, next=page.next, prev=page.prev, user=context.request.user)
 
 
 @view('signin.html')
@@ -133,12 +153,11 @@ def api_register_user():
         raise APIValueError('email')
     if not password or not _RE_MD5.match(password):
         raise APIValueError('password')
-    user = User.find_first('email=%s', email)
-    if user:
-        raise APIError('register:failed', 'email', 'Email is already in use.')
     user = User(name=name, email=email, password=password,
                 image='http://www.gravatar.com/avatar/%s?d=mm&s=120' % hashlib.md5(email).hexdigest())
-    user.insert()
+    # one statement keeps the concurrent signups of the same email from both passing.
+    if user.upsert(('email',), update=()) is None:
+        raise APIError('register:failed', 'email', 'Email is already in use.')
     print user
     cookie = make_signed_cookie(user.u_id, user.password, None)
     context.response.set_cookie(_COOKIE_NAME, cookie)
@@ -148,7 +167,36 @@ def api_register_user():
 @api
 @get('/api/users')
 def api_get_users():
-    users = User.find_by('order by created_at desc')
-    for u in users:
+    i = context.request.input(after=None, before=None, limit=str(_PAGE_SIZE))
+    try:
+        limit = int(i.limit)
+    except ValueError:
+        raise APIValueError('limit')
+    if not 0 < limit <= _MAX_PAGE_SIZE:
+        raise APIValueError('limit')
+    try:
+        page = User.page('-created_at', after=i.after, before=i.before, limit=limit)
+    except ValueError:
+        raise APIValueError('after' if i.after is not None else 'before')
+    for u in page.items:
         u.password = '******'
-    return dict(users=users)
+    return dict(users=page.items, next=page.next, prev=page.prev)
+
+
+@api
+@get('/api/blogs/:blog_id')
+def api_get_blog(blog_id):
+    try:
+        blog_id = int(blog_id)
+    except ValueError:
+        raise APIValueError('blog_id')
+    blog = Blog.get(blog_id, fields=Blog.__mappings__.keys(), prefetch=('comments', 'comments.user'))
+    if blog is None:
+        raise APIResourceNotFoundError('blog_id', 'blog not found')
+    comments = list()
+    for c in blog.comments:
+        comment = dict(c)
+        if c.user is not None:
+            comment.update(user_name=c.user.name, user_image=c.user.image)
+        comments.append(comment)
+    return dict(blog=blog, comments=comments)
@@ -9,7 +9,7 @@ import logging
 import os
 
 import urls
-from transwarp import db
+from transwarp import db, orm
 from transwarp.web import WSGIApplication, Jinja2TemplateEngine
 from config import configs
 
@@ -32,6 +32,10 @@ logging.basicConfig(level=logging.DEBUG)
 
 # initialize the database
 db.create_engine(**configs.db)
+db.set_id_node(configs.id_node)
+db.enable_query_cache(**configs.query_cache)
+orm.enable_count_cache(**configs.count_cache)
+db.enable_instrumentation(**configs.instrumentation)
 
 current_path = os.path.dirname(os.path.abspath(__file__))
 # create a wsgi application
@@ -42,8 +46,13 @@ template_engine = Jinja2TemplateEngine(os.path.join(current_path, 'templates'))
 template_engine.add_filter('datetime', datetime_filter)
 wsgi_app.template_engine = template_engine
 
-# add the urls module
+# add the urls module, the identity map is the outermost interceptor to cover the others
 wsgi_app.add_module(urls)
+wsgi_app.add_interceptor(urls.identity_map_interceptor)
+if configs.n_plus_one.enabled:
+    wsgi_app.add_interceptor(urls.n_plus_one_interceptor)
+wsgi_app.add_interceptor(urls.user_interceptor)
+wsgi_app.add_interceptor(urls.manage_interceptor)
 
 if __name__ == '__main__':
     wsgi_app.run(9000, host='0.0.0.0')